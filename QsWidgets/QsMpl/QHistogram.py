@@ -52,14 +52,18 @@ class QHistogramWindow(QtWidgets.QGroupBox):
 	def updatePlot(self):
 		self.windowUpdated.emit(self.range[0].value(), self.range[1].value())
 
-	def setData(self,data):
+	def setData(self,data,histogram=None,dataRange=None):
+		""" Show the histogram of an image, a histogram as (counts, edges) and the (min, max) of the image can be given instead of calculating them. """
 		# Set enabled to true - we have data.
 		self.setEnabled(True)
 		# Give histogram the data to work with.
-		self.histogram.loadImage(data)
+		self.histogram.loadImage(data,histogram=histogram,dataRange=dataRange)
 		# Give the slider widgets a max and min value to work with.
-		vmin = np.min(data)
-		vmax = np.max(data)
+		if dataRange is None:
+			vmin = np.min(data)
+			vmax = np.max(data)
+		else:
+			vmin, vmax = dataRange
 		for i in range(len(self.range)):
 			self.range[i].setMinimum(vmin)
 			self.range[i].setMaximum(vmax)
@@ -93,11 +97,19 @@ class Histogram:
 		# Clear the axes and start again.
 		self.clear()
 		# Data min and max.
-		dmin = np.min(data)
-		dmax = np.max(data)
-		# Take the data and make a histogram.
-		nbins = kwargs.get('nbins',64)
-		histogramValues,_,_ = self.ax.hist(data.ravel(),facecolor='k',alpha=0.5,bins=nbins)
+		if kwargs.get('dataRange') is None:
+			dmin = np.min(data)
+			dmax = np.max(data)
+		else:
+			dmin, dmax = kwargs['dataRange']
+		if kwargs.get('histogram') is None:
+			# Take the data and make a histogram.
+			nbins = kwargs.get('nbins',64)
+			histogramValues,_,_ = self.ax.hist(data.ravel(),facecolor='k',alpha=0.5,bins=nbins)
+		else:
+			# Draw a precomputed histogram (the counts are the weights of one value in each bin).
+			counts, edges = kwargs['histogram']
+			histogramValues,_,_ = self.ax.hist(edges[:-1],facecolor='k',alpha=0.5,bins=edges,weights=counts)
 		self.hmax = np.max(histogramValues)
 		# Draw lines over the plot.
 		self.ax.plot([dmin,dmax],[0,self.hmax],'k-',lw=1)
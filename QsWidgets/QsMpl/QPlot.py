@@ -151,14 +151,15 @@ class QPlot(QtWidgets.QWidget):
 			del self.markers[ax][:]
 
 		for i, image in enumerate(images):
-			# Load the image. Assumes 2D array, forces 32-bit floats.
-			self.images[self.ax[i]] = self.ax[i].imshow(np.array(image.pixelArray,dtype=np.float32), cmap='bone', extent=image.extent)
+			# Load the image (or its preview, see refineImages()). Assumes 2D array, forces 32-bit floats.
+			data = image.pixelArray if image.preview is None else image.preview
+			self.images[self.ax[i]] = self.ax[i].imshow(np.array(data,dtype=np.float32), cmap='bone', extent=image.extent)
 			# Setup the axes.
 			self.ax[i].set_xlim(image.extent[0:2])
 			self.ax[i].set_ylim(image.extent[2:4])
 			self.ax[i].set_aspect("equal", "datalim")
 			# Setup the histogram data.
-			self.histograms[self.ax[i]].setData(image.pixelArray)
+			self.histograms[self.ax[i]].setData(image.pixelArray,image.histogram,image.dataRange)
 			self.histograms[self.ax[i]].setTitle('View: '+image.view['title'])
 
 		if i == 0:
@@ -174,6 +175,26 @@ class QPlot(QtWidgets.QWidget):
 
 		self.canvas.draw()
 
+	def refineImages(self,images):
+		"""
+		Replace the data of the loaded images with a refined version of the same images (e.g. full resolution in place of a preview).
+		The axes limits (zoom) and markers are kept.
+
+		Parameters
+		----------
+		images : list
+			A list containing up to two items of syncmrt.file.image.Image2D
+		"""
+		for i, image in enumerate(images):
+			if self.ax[i] not in self.images:
+				continue
+			self.images[self.ax[i]].set_data(np.array(image.pixelArray,dtype=np.float32))
+			self.images[self.ax[i]].set_extent(image.extent)
+			if image.histogram is None:
+				self.histograms[self.ax[i]].setData(image.pixelArray)
+			# Otherwise the histogram was already of the full image, the window is kept.
+		self.canvas.draw()
+
 	def pickIsocenter(self):
 		""" Trigger the pick isocenter tool. """
 		self.toolbarManager.trigger_tool('pickIso')
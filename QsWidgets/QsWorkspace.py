@@ -200,6 +200,10 @@ class QPlotEnvironment(QtWidgets.QSplitter):
 			# Two plots, show both.
 			self.tableView[1].setVisible(True)
 
+	def refineImages(self,images):
+		""" Replace the images in the plot with refined versions of the same images, markers and zoom are kept. """
+		self.plot.refineImages(images)
+
 	def clearPlot(self):
 		"""
 		Clears the plot environment of all data.
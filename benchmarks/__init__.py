@@ -0,0 +1,8 @@
+'''
+Benchmarks of the compute heavy paths (CT import, views, rotations and RTPLAN projections).
+	phantom: Writes synthetic DICOM CT series and RTPLANs of any size.
+	run: Times each stage on every available compute backend and saves the results as JSON.
+Run them with:
+	python -m benchmarks.run --shape 256 256 256 --output results.json
+'''
+from . import phantom
@@ -0,0 +1,141 @@
+import os
+import numpy as np
+import pydicom as dicom
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+'''
+Synthetic DICOM datasets for benchmarks.
+	ct: A CT series of a water cylinder (along the slices) in air with a
+		lung insert and two bone rods, written one slice at a time so a
+		series of any size can be made without holding the volume.
+	rtplan: An RTPLAN with a single isocenter and a beam for each gantry angle.
+'''
+
+# Stored values are HU + 1024.
+_intercept = -1024
+
+def _save(ds,fn):
+	""" Save a dataset as explicit VR little endian (the transfer syntax in its file meta). """
+	if int(dicom.__version__.split('.')[0]) < 3:
+		ds.is_little_endian = True
+		ds.is_implicit_VR = False
+		ds.save_as(fn,write_like_original=False)
+	else:
+		ds.save_as(fn,enforce_file_format=True)
+
+def hounsfield(shape,k=0):
+	""" The Hounsfield Units of slice k of a phantom of shape (rows,columns,slices). """
+	rows, cols = shape[0], shape[1]
+	y, x = np.ogrid[:rows,:cols]
+	y = (y-(rows-1)/2)/min(rows,cols)
+	x = (x-(cols-1)/2)/min(rows,cols)
+	hu = np.full((rows,cols),-1000,dtype=np.int16)
+	hu[x**2 + y**2 < 0.4**2] = 0
+	# The lung insert only runs through the middle half of the slices.
+	if shape[2]/4 <= k < 3*shape[2]/4:
+		hu[(x+0.15)**2/0.12**2 + y**2/0.2**2 < 1] = -700
+	for cx in (0.2,0.12):
+		hu[(x-cx)**2 + (y-cx+0.1)**2 < 0.04**2] = 1000
+	return hu
+
+def ct(folder,shape=(256,256,256),pixelSize=(1.0,1.0,1.0)):
+	"""
+	Write a phantom CT series into a folder.
+
+	Parameters
+	----------
+	folder : str
+		The folder for the series, it is created if it does not exist.
+	shape : tuple
+		The (rows,columns,slices) of the volume.
+	pixelSize : tuple
+		The (row,column,slice) spacing in mm.
+
+	Returns
+	-------
+	list
+		The files of the series, sorted by slice position.
+	"""
+	os.makedirs(folder,exist_ok=True)
+	series = generate_uid()
+	frame = generate_uid()
+	files = []
+	for k in range(shape[2]):
+		meta = FileMetaDataset()
+		meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+		meta.MediaStorageSOPInstanceUID = generate_uid()
+		meta.TransferSyntaxUID = ExplicitVRLittleEndian
+		fn = os.path.join(folder,'CT{:05d}.dcm'.format(k))
+		ds = FileDataset(fn,{},file_meta=meta,preamble=b'\0'*128)
+		ds.SOPClassUID = meta.MediaStorageSOPClassUID
+		ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+		ds.Modality = 'CT'
+		ds.SeriesInstanceUID = series
+		ds.FrameOfReferenceUID = frame
+		ds.InstanceNumber = k+1
+		ds.PatientPosition = 'HFS'
+		ds.Rows, ds.Columns = shape[0], shape[1]
+		ds.PixelSpacing = [pixelSize[0],pixelSize[1]]
+		ds.SliceThickness = pixelSize[2]
+		ds.ImageOrientationPatient = [1,0,0,0,1,0]
+		# Centre the volume on the origin.
+		ds.ImagePositionPatient = [-(shape[1]-1)/2*pixelSize[1],-(shape[0]-1)/2*pixelSize[0],(k-(shape[2]-1)/2)*pixelSize[2]]
+		ds.RescaleSlope = 1
+		ds.RescaleIntercept = _intercept
+		ds.SamplesPerPixel = 1
+		ds.PhotometricInterpretation = 'MONOCHROME2'
+		ds.BitsAllocated = 16
+		ds.BitsStored = 16
+		ds.HighBit = 15
+		ds.PixelRepresentation = 1
+		ds.PixelData = (hounsfield(shape,k)-_intercept).astype(np.int16).tobytes()
+		_save(ds,fn)
+		files.append(fn)
+	return files
+
+def rtplan(fn,gantry=(0,45,90,180,270),patientSupport=0,isocenter=(0,0,0)):
+	"""
+	Write a phantom RTPLAN.
+
+	Parameters
+	----------
+	fn : str
+		The file to write.
+	gantry : tuple
+		The gantry angle of each beam (degrees).
+	patientSupport : float
+		The patient support angle of every beam (degrees).
+	isocenter : tuple
+		The isocenter (mm, DICOM patient coordinates).
+	"""
+	meta = FileMetaDataset()
+	meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.481.5'
+	meta.MediaStorageSOPInstanceUID = generate_uid()
+	meta.TransferSyntaxUID = ExplicitVRLittleEndian
+	ds = FileDataset(fn,{},file_meta=meta,preamble=b'\0'*128)
+	ds.SOPClassUID = meta.MediaStorageSOPClassUID
+	ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+	ds.Modality = 'RTPLAN'
+	ds.SeriesInstanceUID = generate_uid()
+	fractionGroup = Dataset()
+	fractionGroup.NumberOfBeams = len(gantry)
+	ds.FractionGroupSequence = Sequence([fractionGroup])
+	beams = []
+	for i, angle in enumerate(gantry):
+		beam = Dataset()
+		beam.BeamNumber = i+1
+		beam.NumberOfBlocks = 0
+		controlPoint = Dataset()
+		controlPoint.IsocenterPosition = list(map(float,isocenter))
+		controlPoint.GantryAngle = angle
+		controlPoint.PatientSupportAngle = patientSupport
+		controlPoint.BeamLimitingDeviceAngle = 0
+		controlPoint.TableTopPitchAngle = 0
+		controlPoint.TableTopRollAngle = 0
+		beam.ControlPointSequence = Sequence([controlPoint])
+		beams.append(beam)
+	ds.BeamSequence = Sequence(beams)
+	_save(ds,fn)
+	return fn
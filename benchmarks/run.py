@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+from PyQt5 import QtCore
+from resources import config
+from file import importer
+from tools.cpu import cpu
+from tools import projection
+from benchmarks import phantom
+import logging
+
+'''
+Time the compute heavy paths on synthetic phantoms.
+	For each volume shape a phantom CT series and RTPLAN are written, then:
+		decode: The slices are decoded into a volume (importer.readSlices).
+		rescale: The sum projections of the volume are converted to Hounsfield
+			Units (ct.rescale(), the volume itself stays in its stored type),
+			timed once with the first CT import.
+	And on each compute backend (the CPU and every OpenCL device):
+		upload: The volume is loaded into the backend.
+		rotate: The volume is rotated by a right angle and by an oblique angle (rotateOblique).
+		project: The volume is rotated and flattened along two axes.
+		projectBatch: The volume is flattened for each of the beams of the plan in one batch.
+		importCt: A full CT import (importer.ct), without the volume cache.
+		calculateView: The AP, LR and SI views of the CT (ct.calculateView), without the view cache.
+		rtplan: The plan is imported and the projections of every beam are calculated (importer.rtplan).
+	Every stage is run a number of times (the first run includes building
+	the kernels), the results are written as JSON.
+'''
+
+# The rest of the application logs to the root logger, only the benchmarks are reported by default.
+log = logging.getLogger('benchmarks')
+
+def timings(function,repeat=1,setup=None):
+	""" Run a function a number of times (after an untimed setup), returns the times in seconds and the last result. """
+	seconds = []
+	result = None
+	for i in range(repeat):
+		if setup is not None:
+			setup()
+		start = time.perf_counter()
+		result = function()
+		seconds.append(time.perf_counter()-start)
+	return seconds, result
+
+def backends(names=('cpu','opencl')):
+	""" The compute backends to run as a list of (backend, device, factory). """
+	found = []
+	if 'cpu' in names:
+		found.append(('cpu',platform.processor() or platform.machine(),cpu))
+	if 'opencl' in names:
+		try:
+			from tools.opencl import gpu, context
+			for device in context.devices():
+				found.append(('opencl','{} ({})'.format(device.name.strip(),device.platform.name.strip()),lambda device=device: gpu(device)))
+		except Exception as e:
+			log.warning("Skipping the OpenCL backends: {}".format(e))
+	return found
+
+def environment():
+	""" A description of the machine and software the benchmarks ran on. """
+	info = {
+		'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+		'platform': platform.platform(),
+		'processor': platform.processor() or platform.machine(),
+		'cpuCount': os.cpu_count(),
+		'python': platform.python_version(),
+		'numpy': np.__version__,
+	}
+	try:
+		info['commit'] = subprocess.check_output(['git','rev-parse','HEAD'],cwd=os.path.dirname(os.path.abspath(__file__)),stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError,subprocess.CalledProcessError):
+		info['commit'] = None
+	try:
+		import pyopencl
+		info['pyopencl'] = pyopencl.VERSION_TEXT
+	except ImportError:
+		info['pyopencl'] = None
+	return info
+
+def run(shape,names=('cpu','opencl'),repeat=3,directory=None,pixelSize=(1.0,1.0,1.0),beams=None):
+	"""
+	Benchmark a phantom of a shape.
+
+	Parameters
+	----------
+	shape : tuple
+		The (rows,columns,slices) of the phantom CT.
+	names : tuple
+		The backends to run, 'cpu' and/or 'opencl' (every OpenCL device).
+	repeat : int
+		The number of times each stage is run.
+	directory : str
+		Where the phantom is written, a temporary directory (that is removed afterwards) if None.
+	pixelSize : tuple
+		The voxel size of the phantom in mm.
+	beams : int
+		The number of beams of the phantom RTPLAN (evenly spaced gantry angles), the phantom's default five if None.
+
+	Returns
+	-------
+	list
+		A record of each stage on each backend.
+	"""
+	shape = tuple(int(n) for n in shape)
+	temporary = directory is None
+	if temporary:
+		directory = tempfile.mkdtemp(prefix='syncmrt-benchmark-')
+	records = []
+	def record(backend,device,stage,seconds):
+		records.append({
+			'shape': list(shape),
+			'backend': backend,
+			'device': device,
+			'stage': stage,
+			'seconds': seconds,
+			'best': min(seconds),
+			'median': float(np.median(seconds)),
+			'voxelsPerSecond': int(np.prod(shape))/min(seconds) if min(seconds) > 0 else None,
+		})
+		log.info("{} {} {}: {:.3f} s".format(shape,device,stage,min(seconds)))
+	# Views are calculated synchronously and nothing is served from the caches.
+	cacheCt, previewLevels, prefetch = config.cache.ct, config.ct.previewLevels, config.rtplan.prefetch
+	config.cache.ct = False
+	config.ct.previewLevels = []
+	config.rtplan.prefetch = False
+	try:
+		log.info("Writing a {} phantom to {}.".format(shape,directory))
+		files = phantom.ct(os.path.join(directory,'ct'),shape,pixelSize)
+		gantry = {} if beams is None else {'gantry':tuple(float(angle) for angle in np.linspace(0,360,beams,endpoint=False))}
+		plan = phantom.rtplan(os.path.join(directory,'rtplan.dcm'),**gantry)
+		# Backend independent stages.
+		array = np.zeros(shape,dtype=np.int16)
+		seconds, _ = timings(lambda: importer.readSlices(files,array,workers=config.ct.workers,pool=config.ct.pool),repeat)
+		record('host','',"decode",seconds)
+		for backend, device, factory in backends(names):
+			try:
+				compute = factory()
+				load = lambda: compute.loadData(array,fill=-1000-phantom._intercept)
+				seconds, _ = timings(load,repeat)
+				record(backend,device,'upload',seconds)
+				rightAngle = np.array([[0,0,1],[0,1,0],[-1,0,0]])
+				oblique = importer.activeRotation(np.identity(3),[30,20],['z','x'])
+				# Reloading the volume drops the rotated volumes kept on the device, so every run rotates.
+				seconds, _ = timings(lambda: compute.rotate(rightAngle),repeat,load)
+				record(backend,device,'rotate',seconds)
+				seconds, _ = timings(lambda: compute.rotate(oblique),repeat,load)
+				record(backend,device,'rotateOblique',seconds)
+				seconds, _ = timings(lambda: compute.project(oblique),repeat,load)
+				record(backend,device,'project',seconds)
+				seconds, ct = timings(lambda: importer.ct(files,compute),repeat)
+				record(backend,device,'importCt',seconds)
+				if not any(r.get('stage') == 'rescale' for r in records):
+					flats = [(projection.flatten(ct.pixelArray,axis,'sum'),ct.pixelArray.shape[axis]) for axis in (2,1)]
+					seconds, _ = timings(lambda: [ct.rescale(flat,n) for flat, n in flats],repeat)
+					record('host','','rescale',seconds)
+				def views():
+					for view in ('AP','LR','SI'):
+						ct.invalidateViews()
+						ct.calculateView(view)
+				seconds, _ = timings(views,repeat)
+				record(backend,device,'calculateView',seconds)
+				def beams():
+					rtplan = importer.rtplan([plan],ct,compute)
+					return [beam.image for beam in rtplan.beam]
+				seconds, _ = timings(beams,repeat)
+				record(backend,device,'rtplan',seconds)
+				rotations = [beam.W for beam in importer.rtplan([plan],ct,compute).beam]
+				seconds, _ = timings(lambda: compute.rotateBatch(rotations),repeat)
+				record(backend,device,'projectBatch',seconds)
+			except Exception as e:
+				# A backend may not have the memory (or features) for a volume, the other backends still run.
+				log.exception("The {} benchmark failed on {}.".format(backend,device))
+				records.append({'shape':list(shape),'backend':backend,'device':device,'error':repr(e)})
+	finally:
+		config.cache.ct, config.ct.previewLevels, config.rtplan.prefetch = cacheCt, previewLevels, prefetch
+		if temporary:
+			shutil.rmtree(directory,ignore_errors=True)
+	return records
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog='python -m benchmarks.run',description="Benchmark the compute heavy paths on synthetic phantoms.")
+	parser.add_argument('--shape',nargs=3,type=int,action='append',metavar=('ROWS','COLUMNS','SLICES'),help="The shape of a phantom CT, may be given more than once (default 256 256 256).")
+	parser.add_argument('--pixel-size',nargs=3,type=float,default=(1.0,1.0,1.0),metavar=('ROW','COLUMN','SLICE'),help="The voxel size in mm.")
+	parser.add_argument('--backend',choices=['cpu','opencl'],action='append',help="A backend to run, may be given more than once (default all of them).")
+	parser.add_argument('--beams',type=int,default=None,help="The number of beams of the phantom RTPLAN, at evenly spaced gantry angles (default 5 beams at 0, 45, 90, 180 and 270 degrees).")
+	parser.add_argument('--repeat',type=int,default=3,help="The number of times each stage is run.")
+	parser.add_argument('--directory',default=None,help="Write (and keep) the phantoms here instead of a temporary directory.")
+	parser.add_argument('--output',default='benchmarks.json',help="The JSON file for the results.")
+	parser.add_argument('--verbose',action='store_true',help="Show the log of the application as well.")
+	args = parser.parse_args(argv)
+	logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,format='%(asctime)s %(levelname)-8s %(message)s',datefmt='%H:%M:%S')
+	log.setLevel(logging.INFO)
+	# The importers are QObjects.
+	app = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication(sys.argv[:1])
+	results = environment()
+	results['repeat'] = args.repeat
+	results['settings'] = {'rotation':config.gpu.rotation,'ctWorkers':config.ct.workers,'ctPool':config.ct.pool,'projectionWorkers':config.ct.projectionWorkers,'beams':args.beams or 5}
+	results['results'] = []
+	for shape in (args.shape or [(256,256,256)]):
+		directory = None if args.directory is None else os.path.join(args.directory,'x'.join(map(str,shape)))
+		results['results'] += run(shape,tuple(args.backend or ('cpu','opencl')),args.repeat,directory,args.pixel_size,args.beams)
+	with open(args.output,'w') as f:
+		json.dump(results,f,indent=1)
+	log.info("Saved the results to {}.".format(args.output))
+
+if __name__ == '__main__':
+	main()
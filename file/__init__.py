@@ -3,4 +3,5 @@
 # Submodules
 from . import image
 from . import importer
+from . import scanner
 # from . import dicom
\ No newline at end of file
@@ -1,7 +1,38 @@
 import h5py as h5
+import numpy as np
+import os
 from datetime import datetime as dt
+from resources import config
+from tools.math import resample
 import logging
 
+'''
+Patient HDF5 files of x-ray image sets.
+	Images are stored in chunks of whole rows, compressed with lzf or gzip
+	(after shuffling the bytes of the pixel values). The storage settings
+	are saved in the attributes of each file so every set in a file is
+	written the same way, files created without them use config.hdf5.
+	Files written before images were compressed can be rewritten with
+	migrate() (or scripts/migrate-hdf5.py).
+	The /Index dataset is a table with a row for every image (its set,
+	index, angle, time, detector, comment and shape) so sets can be listed
+	and searched with a single read. It is kept up to date by
+	addImageSet(), files without one are indexed when they are loaded.
+	Files can be shared between the process acquiring images and any
+	number of readers (HDF5 single writer multiple reader, SWMR). In SWMR
+	mode no groups, datasets or attributes can be created, so image sets
+	are appended to the /Stream datasets instead: the pixels of every image
+	in Stream/Pixels (one frame each) and a row for every image (its index
+	row and the attributes used to show it) in Stream/Images. Readers open
+	the file with read() and call refresh() to see new sets.
+	Each image also has a /Display/<set>/<index> group with downsampled
+	copies of it (Level2, Level4...), a histogram and its range (the Min
+	and Max attributes), so sets can be browsed and windowed from a few
+	small reads. Images written in SWMR mode (or before there were display
+	groups) get theirs from buildDisplays() once the file is written to
+	outside of SWMR mode.
+'''
+
 _xrayImageAttributes = [
 		"Date",
 		"Time",
@@ -25,27 +56,261 @@ _xrayImageAttributes = [
 		"Mi",
 	]
 
-def new(fp):
+# The columns of the index. Every field has a fixed size so the table can be appended to while it is read (SWMR).
+indexType = np.dtype([
+		('set','S8'),
+		('index','<i4'),
+		('angle','<f8'),
+		('timestamp','<f8'),
+		('detector','S32'),
+		('comment','S128'),
+		('shape','<i4',(2,)),
+	])
+
+# The rows of the images of the stream (files in SWMR mode), the index columns and the attributes of the image.
+streamType = np.dtype(indexType.descr + [
+		('frame','<i8'),
+		('extent','<f8',(4,)),
+		('isocenter','<f8',(2,)),
+		('position','<f8',(3,)),
+		('supportAngle','<f8',(3,)),
+		('M','<f8',(3,3)),
+		('Mi','<f8',(3,3)),
+	])
+
+def _fixed(value,shape):
+	""" A value as an array of a fixed shape (NaN if it is missing). """
+	try:
+		return np.asarray(value,dtype=float).reshape(shape)
+	except (TypeError,ValueError):
+		return np.full(shape,np.nan)
+
+def _timestamp(attrs):
+	""" The time an image was acquired (seconds since the epoch) from its Date and Time attributes, NaN if they are missing. """
+	try:
+		return dt.strptime("{} {}".format(_string(attrs['Date']),_string(attrs['Time'])),"%d/%m/%Y %H:%M:%S").timestamp()
+	except (KeyError,ValueError):
+		return np.nan
+
+def _string(value):
+	if isinstance(value,bytes):
+		return value.decode('utf-8',errors='ignore')
+	return str(value)
+
+def _encode(value,size):
+	""" Encode a string for a fixed size field, it is cut to fit (on a character boundary). """
+	encoded = _string(value).encode('utf-8')
+	if len(encoded) > size:
+		encoded = encoded[:size].decode('utf-8',errors='ignore').encode('utf-8')
+	return encoded
+
+def display(data):
+	"""
+	The display levels, histogram and range of an image.
+
+	Returns
+	-------
+	levels : dict
+		The image downsampled by each factor of config.hdf5.displayLevels (that leaves at least one pixel).
+	histogram : ndarray
+		The counts of config.hdf5.histogramBins equal bins over the range.
+	range : tuple
+		The (min,max) of the image.
+	"""
+	data = np.asarray(data)
+	vmin, vmax = float(np.min(data)), float(np.max(data))
+	histogram, _ = np.histogram(data,bins=config.hdf5.histogramBins,range=(vmin,vmax if vmax > vmin else vmin+1))
+	levels = {}
+	level = data
+	previous = 1
+	for factor in sorted(config.hdf5.displayLevels):
+		if min(data.shape) < factor:
+			break
+		# Each level is made from the previous one.
+		level = resample.downsample(level[:,:,np.newaxis],factor//previous)[:,:,0]
+		previous = factor
+		levels[factor] = level
+	return levels, histogram, (vmin,vmax)
+
+def _indexRow(setName,index,shape,attrs):
+	""" The index row of an image. """
+	row = np.zeros((),dtype=indexType)
+	row['set'] = _encode(setName,indexType['set'].itemsize)
+	row['index'] = index
+	row['angle'] = float(attrs.get('Image Angle',np.nan))
+	row['timestamp'] = _timestamp(attrs)
+	row['detector'] = _encode(attrs.get('Detector',''),indexType['detector'].itemsize)
+	row['comment'] = _encode(attrs.get('Comment',''),indexType['comment'].itemsize)
+	row['shape'] = (tuple(shape)+(0,0))[:2]
+	return row
+
+def _streamAttributes(row):
+	""" The attributes of an image of the stream (as they are named on images written as datasets). """
+	return {
+		'Image Angle': row['angle'],
+		'Comment': row['comment'].decode('utf-8',errors='ignore'),
+		'Detector': row['detector'].decode('utf-8',errors='ignore'),
+		'Extent': row['extent'],
+		'Image Isocenter': row['isocenter'],
+		'Patient Support Position': row['position'],
+		'Patient Support Angle': row['supportAngle'],
+		'M': row['M'],
+		'Mi': row['Mi'],
+	}
+
+class _streamSet(list):
+	""" The index rows of the images of a set that is being appended to the stream. """
+	def __init__(self,setName):
+		super().__init__()
+		self.setName = setName
+
+def new(fp,compression=None,compressionLevel=None,shuffle=None):
+	""" Create a new file, images are stored with the given settings (the defaults are in config.hdf5). """
 	logging.info("Creating {}".format(fp))
-	f = file(fp,'w') #: Create a new HDF5 file.
+	f = file(fp,'w',libver=_libver()) #: Create a new HDF5 file.
 	#: Set the file up.
+	f.setStorage(compression,compressionLevel,shuffle)
 	f.create_group('Patient') 
 	f.create_group('Image')
+	f.createIndex()
 	# Save it.
 	f.flush()
+	if config.hdf5.swmr:
+		f.startSwmr()
 	#: Return the file.
 	return f
 
 # Load a HDF5 file.
 def load(fp):
 	logging.info("Loading {}".format(fp))
-	return file(fp,'a')
+	try:
+		f = file(fp,'a',libver=_libver())
+	except OSError:
+		# The file is locked by another process that is writing to it.
+		logging.warning("{} is open in another process, it is opened read only.".format(fp))
+		return read(fp)
+	if ('Image' in f) and ('Index' not in f):
+		# Files written before there was an index.
+		f.reindex()
+	if config.hdf5.swmr:
+		try:
+			f.startSwmr()
+		except Exception as e:
+			logging.warning("Could not start SWMR mode for {}, it is opened without it: {}".format(fp,e))
+	return f
+
+def read(fp):
+	""" Open a file for reading while another process writes to it (SWMR), call file.refresh() to see new image sets. """
+	logging.info("Reading {}".format(fp))
+	return file(fp,'r',libver='latest',swmr=True)
+
+def _libver():
+	# SWMR needs the latest file format (files can not be read by HDF5 before 1.10).
+	return 'latest' if config.hdf5.swmr else None
 
 class file(h5.File):
 	""" A reclass of the H5Py module. Added specific functionality for reading and writing image sets. """
 	def __init__(self,fp,mode,*args,**kwargs):
 		super().__init__(fp,mode,*args,**kwargs)
 
+	def setStorage(self,compression=None,compressionLevel=None,shuffle=None):
+		""" Set how images are stored in this file, the settings are saved in the file (the defaults are in config.hdf5). """
+		compression = config.hdf5.compression if compression is None else compression
+		if compression not in ('lzf','gzip','none'):
+			raise ValueError("Unknown compression {}.".format(compression))
+		self.attrs['Compression'] = compression
+		self.attrs['CompressionLevel'] = config.hdf5.compressionLevel if compressionLevel is None else int(compressionLevel)
+		self.attrs['Shuffle'] = config.hdf5.shuffle if shuffle is None else bool(shuffle)
+
+	def storage(self,data):
+		""" The chunks and filters (as arguments to create_dataset()) for storing an array in this file. """
+		compression = str(self.attrs.get('Compression',config.hdf5.compression))
+		data = np.asarray(data)
+		if (compression == 'none') or (data.ndim == 0) or (data.size == 0):
+			return {}
+		# Chunks of whole rows of about config.hdf5.chunkSize bytes.
+		rowBytes = int(np.prod(data.shape[1:]))*data.itemsize
+		rows = int(np.clip(config.hdf5.chunkSize//max(1,rowBytes),1,data.shape[0]))
+		kwargs = {
+			'chunks': (rows,)+data.shape[1:],
+			'compression': compression,
+			'shuffle': bool(self.attrs.get('Shuffle',config.hdf5.shuffle)),
+		}
+		if compression == 'gzip':
+			kwargs['compression_opts'] = int(self.attrs.get('CompressionLevel',config.hdf5.compressionLevel))
+		return kwargs
+
+	def createIndex(self,rows=None):
+		""" Create the (empty) index of the images in the file, or fill it with rows. """
+		rows = np.zeros(0,dtype=indexType) if rows is None else rows
+		if 'Index' in self:
+			del self['Index']
+		self.create_dataset('Index',data=rows,maxshape=(None,),chunks=(256,))
+
+	def indexRows(self,setName,group):
+		""" The index rows of the images in a set. """
+		rows = np.zeros(len(group),dtype=indexType)
+		for i in range(len(group)):
+			image = group[str(i+1)]
+			rows[i] = _indexRow(setName,i+1,image.shape,image.attrs)
+		return rows
+
+	def reindex(self):
+		""" Rebuild the index from the image sets in the file. """
+		if self.swmr_mode:
+			raise RuntimeError("The index of a file in SWMR mode can not be rebuilt.")
+		logging.info("Indexing the image sets of {}.".format(self.filename))
+		rows = [self.indexRows(name,group) for name, group in self.get('Image',{}).items()]
+		if 'Stream' in self:
+			stream = self['Stream/Images'][()]
+			rows.append(np.array([tuple(row[name] for name in indexType.names) for row in stream],dtype=indexType))
+		rows = np.concatenate(rows) if len(rows) > 0 else np.zeros(0,dtype=indexType)
+		# Sets in the order they were written ('99' before '100').
+		order = sorted(range(len(rows)),key=lambda i: (len(rows[i]['set']),rows[i]['set'],rows[i]['index']))
+		self.createIndex(rows[order])
+
+	def index(self):
+		""" The index of the images in the file as a structured array (see indexType), read in one go. """
+		if 'Index' not in self:
+			return np.zeros(0,dtype=indexType)
+		return self['Index'][()]
+
+	def findImages(self,sets=None,angle=None,start=None,end=None,detector=None):
+		"""
+		Search the index for images, returns the matching rows.
+
+		Parameters
+		----------
+		sets : list
+			Only images in these sets (names, e.g. '01').
+		angle : float or tuple
+			Images taken at an angle (within 0.01 degrees) or at an angle in a (min,max) range.
+		start, end : datetime or float
+			Images taken at or after start and/or at or before end (a datetime or seconds since the epoch).
+		detector : str
+			Images taken with a detector.
+		"""
+		rows = self.index()
+		match = np.ones(len(rows),dtype=bool)
+		if sets is not None:
+			match &= np.isin(rows['set'],[_encode(name,indexType['set'].itemsize) for name in sets])
+		if angle is not None:
+			if np.ndim(angle) == 0:
+				match &= np.isclose(rows['angle'],float(angle),rtol=0,atol=0.01)
+			else:
+				match &= (rows['angle'] >= angle[0]) & (rows['angle'] <= angle[1])
+		if start is not None:
+			match &= rows['timestamp'] >= (start.timestamp() if isinstance(start,dt) else start)
+		if end is not None:
+			match &= rows['timestamp'] <= (end.timestamp() if isinstance(end,dt) else end)
+		if detector is not None:
+			match &= rows['detector'] == _encode(detector,indexType['detector'].itemsize)
+		return rows[match]
+
+	def findImageSets(self,**kwargs):
+		""" The names of the sets that hold an image matching the search (see findImages()), in the order they were written. """
+		return list(dict.fromkeys(name.decode('utf-8') for name in self.findImages(**kwargs)['set']))
+
 	def getImageSet(self,index=-1):
 		logging.debug("Reading image set {}.".format(index))
 		if index == -1:
@@ -55,19 +320,232 @@ class file(h5.File):
 		except:
 			return []
 
+	def readImageSet(self,index=-1):
+		"""
+		The images of a set (written as a group or to the stream) without reading their pixels.
+		Returns the name of the set and a list of (pixels, attributes) for each image, the pixels are a dataset and the region (a tuple of slices) of it that holds the image.
+		"""
+		if index == -1:
+			index = self.setCount()
+		name = str(index).zfill(2)
+		if name in self['Image']:
+			group = self['Image'][name]
+			return name, [((group[str(i+1)],None),dict(group[str(i+1)].attrs)) for i in range(len(group))]
+		images = []
+		if 'Stream' in self:
+			for row in self.streamRows(name):
+				region = (int(row['frame']),slice(0,int(row['shape'][0])),slice(0,int(row['shape'][1])))
+				images.append(((self['Stream/Pixels'],region),_streamAttributes(row)))
+		return name, images
+
+	def setCount(self):
+		""" The number of image sets in the file. """
+		n = len(self['Image'])
+		if 'Stream' in self:
+			n += len(np.unique(self['Stream/Images']['set']))
+		return n
+
+	def streamRows(self,setName):
+		""" The stream rows (see streamType) of the images in a set. """
+		rows = self['Stream/Images'][()]
+		return rows[rows['set'] == _encode(setName,streamType['set'].itemsize)]
+
+	def createStream(self):
+		""" Create the (empty) stream datasets that image sets are appended to in SWMR mode. """
+		stream = self.create_group('Stream')
+		# One frame per image, frames grow to hold the largest image. Chunks are square tiles of about config.hdf5.chunkSize bytes.
+		dtype = np.dtype(config.hdf5.streamType)
+		side = max(16,int(np.sqrt(config.hdf5.chunkSize/dtype.itemsize)))
+		kwargs = self.storage(np.zeros((1,side,side),dtype=dtype))
+		kwargs['chunks'] = (1,side,side)
+		stream.create_dataset('Pixels',shape=(0,0,0),maxshape=(None,None,None),dtype=dtype,**kwargs)
+		stream.create_dataset('Images',shape=(0,),maxshape=(None,),dtype=streamType,chunks=(256,))
+
+	def startSwmr(self):
+		""" Start SWMR mode, readers in other processes can then follow the image sets as they are written. Returns whether the file is in SWMR mode. """
+		if self.mode != 'r+':
+			return False
+		# SWMR needs the latest file format, older files are left untouched.
+		if self.id.get_create_plist().get_version()[0] < 3:
+			logging.warning("{} was written in an older HDF5 format and can not be shared while it is written (SWMR), rewrite it with scripts/migrate-hdf5.py --swmr.".format(self.filename))
+			return False
+		if 'Stream' not in self:
+			self.createStream()
+		if 'Index' not in self:
+			self.reindex()
+		self.flush()
+		self.swmr_mode = True
+		logging.info("{} is in SWMR mode.".format(self.filename))
+		return True
+
+	def refresh(self):
+		""" Read the changes made by the writer of a file opened with read(), returns the names of any new image sets. """
+		before = self.findImageSets()
+		for name in ('Index','Stream/Images','Stream/Pixels'):
+			if name in self:
+				self[name].refresh()
+		return [name for name in self.findImageSets() if name not in before]
+
+	def createImageSet(self):
+		""" Create a new (empty) image set, returns its name and the group (a list of the index rows of its images in SWMR mode). """
+		_setName = str(self.setCount()+1).zfill(2)
+		if self.swmr_mode:
+			return _setName, _streamSet(_setName)
+		return _setName, self['Image'].create_group(_setName)
+
+	def addImage(self,group,data,metadata):
+		""" Add an image and its attributes (metadata) to the end of an image set. """
+		if self.swmr_mode:
+			return self._appendImage(group,data,metadata)
+		image = group.create_dataset(str(len(group)+1),data=data,**self.storage(data))
+		for key, val in metadata.items():
+			logging.debug("Image {}: {} = {}".format(image.name,key,val))
+			image.attrs[key] = val
+		self.addDisplay(group.name.split('/')[-1],len(group),data)
+		return image
+
+	def addDisplay(self,_setName,index,data):
+		""" Store the display levels, histogram and range (see display()) of an image, replacing any it had. """
+		name = 'Display/{}/{}'.format(_setName,index)
+		levels, histogram, dataRange = display(data)
+		# The display is built under a temporary name and moved into place once it is complete, it may be read (readDisplay()) from another thread meanwhile.
+		partial = name+'.partial'
+		if partial in self:
+			del self[partial]
+		group = self.create_group(partial)
+		for factor, level in levels.items():
+			group.create_dataset('Level{}'.format(factor),data=level,**self.storage(level))
+		group.create_dataset('Histogram',data=histogram)
+		group.attrs['Min'], group.attrs['Max'] = dataRange
+		group.attrs['Levels'] = sorted(levels)
+		if name in self:
+			del self[name]
+		self.move(partial,name)
+
+	def readDisplay(self,_setName,index):
+		"""
+		The display of an image without reading its levels, None if it does not have one (or it is being replaced).
+		Returns a dict of the levels (datasets by factor), the histogram as (counts, edges) and the range as (min, max).
+		"""
+		name = 'Display/{}/{}'.format(_setName,index)
+		try:
+			group = self[name]
+			dataRange = (float(group.attrs['Min']),float(group.attrs['Max']))
+			counts = group['Histogram'][()]
+			levels = {int(factor): group['Level{}'.format(factor)] for factor in group.attrs['Levels']}
+		except KeyError:
+			return None
+		edges = np.linspace(dataRange[0],dataRange[1] if dataRange[1] > dataRange[0] else dataRange[0]+1,len(counts)+1)
+		return {
+			'levels': levels,
+			'histogram': (counts,edges),
+			'range': dataRange,
+		}
+
+	def buildDisplays(self):
+		""" Store the displays of any images that do not have one (images written in SWMR mode or before there were displays). """
+		if self.swmr_mode or (self.mode != 'r+'):
+			return 0
+		n = 0
+		for _setName in self.findImageSets():
+			_, images = self.readImageSet(_setName)
+			for i, ((dataset, region), _) in enumerate(images):
+				if 'Display/{}/{}'.format(_setName,i+1) not in self:
+					self.addDisplay(_setName,i+1,dataset[() if region is None else region])
+					n += 1
+		if n > 0:
+			logging.info("Stored the display of {} images.".format(n))
+		return n
+
+	def _appendImage(self,rows,data,metadata):
+		""" Append an image to the stream, its index row is added to rows (the images of the set so far). """
+		data = np.asarray(data)
+		if data.ndim != 2:
+			raise ValueError("Only 2D images can be written in SWMR mode.")
+		pixels = self['Stream/Pixels']
+		frame = pixels.shape[0]
+		pixels.resize((frame+1,max(pixels.shape[1],data.shape[0]),max(pixels.shape[2],data.shape[1])))
+		pixels[frame,:data.shape[0],:data.shape[1]] = data
+		row = np.zeros((),dtype=streamType)
+		index = _indexRow(rows.setName,len(rows)+1,data.shape,metadata)
+		for key in indexType.names:
+			row[key] = index[key]
+		row['frame'] = frame
+		row['extent'] = _fixed(metadata.get('Extent'),4)
+		row['isocenter'] = _fixed(metadata.get('Image Isocenter'),2)
+		row['position'] = _fixed(metadata.get('Patient Support Position'),3)
+		row['supportAngle'] = _fixed(metadata.get('Patient Support Angle'),3)
+		row['M'] = _fixed(metadata.get('M'),(3,3))
+		row['Mi'] = _fixed(metadata.get('Mi'),(3,3))
+		images = self['Stream/Images']
+		images.resize((len(images)+1,))
+		images[-1] = row
+		rows.append(index)
+		return row
+
+	def indexImageSet(self,_setName,group):
+		""" Add the images of a completed set to the index. """
+		if 'Index' not in self:
+			self.reindex()
+			return
+		rows = np.array(group,dtype=indexType) if self.swmr_mode else self.indexRows(_setName,group)
+		if len(rows) == 0:
+			return
+		index = self['Index']
+		index.resize((len(index)+len(rows),))
+		index[-len(rows):] = rows
+
 	def addImageSet(self,_set):
 		logging.debug("Writing image set to HDF5 file {}".format(self))
-		_setName = str(len(self['Image'])+1).zfill(2)
-		_nims = len(_set)
 		# Create the group set.
-		newSet = self['Image'].create_group(_setName)
+		_setName, newSet = self.createImageSet()
 		# Add the images to the set one by one.
-		for i in range(_nims):
-			image = newSet.create_dataset(str(i+1),data=_set[i][0])
-			# Add the image attributes (metadata).
-			for key, val in _set[i][1].items():
-				logging.debug("Image {}: {} = {}".format(i,key,val))
-				image.attrs[key] = val
+		for data, metadata in _set:
+			self.addImage(newSet,data,metadata)
+		self.indexImageSet(_setName,newSet)
 		# Write changes to disk.
 		self.flush()
-		return _setName, _nims
\ No newline at end of file
+		return _setName, len(_set)
+
+def migrate(source,destination=None,compression=None,compressionLevel=None,shuffle=None,swmr=None):
+	"""
+	Rewrite a file with new storage settings (the defaults are in config.hdf5), e.g. to compress a file written before images were compressed.
+	Every group, dataset and attribute is copied. Without a destination the source is replaced, once the copy is complete.
+	With swmr (default config.hdf5.swmr) the file is written in the latest HDF5 format so it can be opened in SWMR mode.
+	Returns the size of the file in bytes (before, after).
+	"""
+	swmr = config.hdf5.swmr if swmr is None else swmr
+	target = destination if destination is not None else source+'.migrating'
+	logging.info("Migrating {} to {}".format(source,destination or source))
+	with h5.File(source,'r') as src, file(target,'w',libver='latest' if swmr else None) as dst:
+		dst.attrs.update(src.attrs)
+		dst.setStorage(compression,compressionLevel,shuffle)
+		def copy(name,obj):
+			if (name == 'Index') or (name.split('/')[0] in ('Stream','Display')):
+				return
+			if isinstance(obj,h5.Group):
+				dst.require_group(name).attrs.update(obj.attrs)
+			else:
+				data = obj[()]
+				dst.create_dataset(name,data=data,**dst.storage(data)).attrs.update(obj.attrs)
+		src.visititems(copy)
+		# Sets written in SWMR mode become groups.
+		if 'Stream' in src:
+			pixels = src['Stream/Pixels']
+			for row in src['Stream/Images'][()]:
+				setName = row['set'].decode()
+				group = dst.require_group('Image').require_group(setName)
+				data = pixels[int(row['frame']),:row['shape'][0],:row['shape'][1]]
+				image = dst.addImage(group,data,_streamAttributes(row))
+				# The timestamp is kept as the Date and Time the acquisition wrote.
+				if np.isfinite(row['timestamp']):
+					image.attrs['Date'] = dt.fromtimestamp(row['timestamp']).strftime("%d/%m/%Y")
+					image.attrs['Time'] = dt.fromtimestamp(row['timestamp']).strftime("%H:%M:%S")
+		# The index is resizable, it is rebuilt rather than copied. The displays are rebuilt with the storage settings.
+		dst.reindex()
+		dst.buildDisplays()
+	before = os.path.getsize(source)
+	after = os.path.getsize(target)
+	if destination is None:
+		os.replace(target,source)
+	return before, after
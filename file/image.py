@@ -1,4 +1,111 @@
-__all__ = ['Image2d']
+import threading
+import numpy as np
+import logging
+
+__all__ = ['Image2d','lazyArray']
+
+class lazyArray:
+	"""
+	A read only array that is decoded from a HDF5 dataset the first time it is used.
+	Slicing it before then reads only the region that is asked for (e.g. a region of interest) and does not decode the whole image.
+	The array can be a region of a dataset, a tuple of indices and slices (with a start and stop), e.g. one frame of a stack of images.
+	"""
+	def __init__(self,dataset,region=None):
+		self._dataset = dataset
+		self._region = region
+		self._array = None
+		self._lock = threading.Lock()
+		if region is None:
+			self.shape = tuple(dataset.shape)
+		else:
+			self.shape = tuple(r.stop-r.start for r in region if isinstance(r,slice))
+		self.dtype = np.dtype(dataset.dtype)
+
+	@property
+	def ndim(self):
+		return len(self.shape)
+
+	@property
+	def size(self):
+		return int(np.prod(self.shape))
+
+	@property
+	def nbytes(self):
+		""" The size of the decoded array (whether it has been decoded yet or not). """
+		return self.size*self.dtype.itemsize
+
+	@property
+	def loaded(self):
+		return self._array is not None
+
+	def read(self):
+		""" Decode the whole array, it is kept for later use. """
+		with self._lock:
+			if self._array is None:
+				logging.debug("Decoding {}.".format(self._dataset.name))
+				self._array = np.asarray(self._dataset[() if self._region is None else self._region])
+				self._array.flags.writeable = False
+			return self._array
+
+	def __array__(self,dtype=None,copy=None):
+		array = self.read()
+		if dtype is not None:
+			array = array.astype(dtype,copy=False)
+		if copy:
+			array = array.copy()
+		return array
+
+	def __getitem__(self,key):
+		if self._array is not None:
+			return self._array[key]
+		try:
+			# Only the chunks holding the region are read.
+			return self._dataset[self._select(key)]
+		except (TypeError,ValueError,IndexError):
+			# Indexing that HDF5 does not support (e.g. unsorted indices or masks).
+			return self.read()[key]
+
+	def _select(self,key):
+		""" The selection of the dataset for a key (of this array). Raises a TypeError for keys that are not basic slices of a region. """
+		if self._region is None:
+			return key
+		key = key if isinstance(key,tuple) else (key,)
+		if any(k is Ellipsis or k is None for k in key) or (len(key) > self.ndim):
+			raise TypeError("Unsupported key for a region.")
+		key = key + (slice(None),)*(self.ndim-len(key))
+		select = []
+		keys = iter(key)
+		for r in self._region:
+			if not isinstance(r,slice):
+				select.append(r)
+				continue
+			k = next(keys)
+			n = r.stop-r.start
+			if isinstance(k,slice):
+				start, stop, step = k.indices(n)
+				if step < 1:
+					raise TypeError("Unsupported step for a region.")
+				select.append(slice(r.start+start,r.start+max(start,stop),step))
+			elif isinstance(k,(int,np.integer)):
+				if not -n <= k < n:
+					raise IndexError("Index {} is out of bounds for size {}.".format(k,n))
+				select.append(r.start+(k % n))
+			else:
+				raise TypeError("Unsupported key for a region.")
+		return tuple(select)
+
+	def __len__(self):
+		return self.shape[0]
+
+	def __getattr__(self,name):
+		# Anything else (min, max, ravel...) is taken from the decoded array.
+		if name.startswith('_'):
+			raise AttributeError(name)
+		return getattr(self.read(),name)
+
+	def __repr__(self):
+		return "lazyArray(shape={}, dtype={}, loaded={})".format(self.shape,self.dtype,self.loaded)
+
 
 class Image2d:
 	def __init__(self):
@@ -23,6 +130,11 @@ class Image2d:
 		self.Mi = None
 		# Comment saving.
 		self.comment = None
+		# A downsampled copy of the image to show until the full image is needed (None shows the full image).
+		self.preview = None
+		# A histogram of the image as (counts, edges) and its (min, max), None if they have to be calculated from the image.
+		self.histogram = None
+		self.dataRange = None
 
 # class image3d:
 # 	def __init__(self):
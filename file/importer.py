@@ -1,12 +1,17 @@
 import os
+import sys
 import pydicom as dicom
 import numpy as np
-from file.image import Image2d
-from file import hdf5
-from tools.opencl import gpu as gpuInterface
-from tools.math import wcs2wcs
+from file.image import Image2d, lazyArray
+from file import hdf5, scanner, volumeCache, writer
+from tools.math import wcs2wcs, permutation, resample
+from tools import projection, cache
+from tools import drr as drrInterface
 from natsort import natsorted
 from PyQt5 import QtCore, QtWidgets
+from resources import config
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed
+from functools import partial
 import csv
 import logging
 
@@ -31,31 +36,77 @@ class sync_dx:
 			self.file = hdf5.new(dataset)
 		else:
 			self.file = hdf5.load(dataset)
+		# Recently used image sets. Sets are never changed once written so they stay valid until the file is closed.
+		self.setCache = cache.lru(config.hdf5.setCache)
+		# Acquired images are written in the background. Files that another process is writing to are only read.
+		self.readOnly = (self.file.mode == 'r')
+		self.writer = None if self.readOnly else writer.writer(self.file)
+		if (self.writer is not None) and (not self.file.swmr_mode):
+			# Sets written in SWMR mode (or before there were displays) get theirs in the background.
+			self.writer.buildDisplays()
+
+	def close(self):
+		""" Finish writing any acquired images and close the file. """
+		if self.writer is not None:
+			self.writer.close()
+		self.setCache.invalidate()
+		self.file.close()
+
+	def refresh(self):
+		""" Check a file that another process is writing to (SWMR) for new image sets, returns their names. """
+		if not self.readOnly:
+			return []
+		return self.file.refresh()
 			
-	def getImageList(self):
-		""" Reads the image names in the HDF5 file. Return as list. """
-		return list(self.file['Image'].keys())
+	def getImageList(self,**kwargs):
+		""" The names of the image sets in the HDF5 file as a list, optionally only those with images matching a search (see hdf5.file.findImages()). """
+		return self.file.findImageSets(**kwargs)
+
+	def getImageDetails(self,idx):
+		""" The index rows (set, index, angle, timestamp, detector, comment and shape) of the images in a set, without reading the images. """
+		return self.file.findImages(sets=[str(idx).zfill(2)])
 
 	def getImageSet(self,idx):
+		"""
+		Get the images of a set as a list of Image2d.
+		The pixel arrays are file.image.lazyArray's, an image is only decoded when it is first used (and slicing it reads only that region).
+		"""
 		logging.debug("Reading image set {}.".format(idx))
-		_set = self.file.getImageSet(idx)
+		name = str(self.file.setCount() if idx == -1 else idx).zfill(2)
+		key = (name,len(self.getImageDetails(name)))
+		imageSet = self.setCache.get(key)
+		if imageSet is not None:
+			return list(imageSet)
+		_, _set = self.file.readImageSet(name)
 		imageSet = []
-		for i in range(len(_set)):
+		for (dataset, region), attrs in _set:
 			# Get the image and its attributes.
 			image = Image2d()
-			image.pixelArray = _set[str(i+1)][()]
-			image.extent = _set[str(i+1)].attrs.get('Extent',default=None)
-			image.patientIsocenter = _set[str(i+1)].attrs.get('Image Isocenter',default=None)
-			image.patientPosition = list(_set[str(i+1)].attrs.get('Patient Support Position',default=None)) + list(_set[str(i+1)].attrs.get('Patient Support Angle',default=None))
-			image.view['title'] = str(_set[str(i+1)].attrs.get('Image Angle',default="None"))+"\u00B0"
-			image.imagingAngle = _set[str(i+1)].attrs.get('Image Angle',default=None)
-			image.M = _set[str(i+1)].attrs.get('M',default=None)
-			image.Mi = _set[str(i+1)].attrs.get('Mi',default=None)
-			image.comment = _set[str(i+1)].attrs.get('Comment',default=None)
+			image.pixelArray = lazyArray(dataset,region)
+			image.extent = attrs.get('Extent',None)
+			image.patientIsocenter = attrs.get('Image Isocenter',None)
+			image.patientPosition = list(attrs.get('Patient Support Position',None)) + list(attrs.get('Patient Support Angle',None))
+			image.view['title'] = str(attrs.get('Image Angle',"None"))+"\u00B0"
+			image.imagingAngle = attrs.get('Image Angle',None)
+			image.M = attrs.get('M',None)
+			image.Mi = attrs.get('Mi',None)
+			image.comment = attrs.get('Comment',None)
+			# The display levels, histogram and range stored with the image.
+			display = self.file.readDisplay(name,len(imageSet)+1)
+			if display is not None:
+				image.histogram = display['histogram']
+				image.dataRange = display['range']
+				# The smallest level that is still large enough to preview the image.
+				for factor in sorted(display['levels'],reverse=True):
+					if max(display['levels'][factor].shape) >= config.hdf5.previewSize:
+						image.preview = lazyArray(display['levels'][factor])
+						break
 			# Append the image.
 			imageSet.append(image)
-		
-		return imageSet
+		if (len(imageSet) > 0) and (key[1] == len(imageSet)):
+			# Only complete (indexed) sets are kept.
+			self.setCache.put(key,imageSet)
+		return list(imageSet)
 
 class csvPlan(QtCore.QObject):
 	newSequence = QtCore.pyqtSignal()
@@ -121,30 +172,90 @@ class csvPlan(QtCore.QObject):
 
 def checkDicomModality(dataset,modality):
 	""" Check the modality of each dicom file and return only the files that match the desired modality. """
-	# Start with empty list of files.
+	# Read the file headers only, grouped into series and sorted by slice location.
+	series = [entries for (_modality,_), entries in scanner.scan(dataset).items() if _modality == modality]
+	if len(series) == 0:
+		return []
+	elif len(series) > 1:
+		logging.warning("Found {} {} series, using the largest one.".format(len(series),modality))
+	# Save in dict where the key is the slice position.
 	files = {}
-	for i in range(len(dataset)):
-		# Read the file in.
-		testFile = dicom.dcmread(dataset[i])
-		if testFile.Modality == modality:
-			# Save in dict where the key is the slice position.
-			# files[int(testFile.SliceLocation)] = dataset[i]
-			files[list(map(float,testFile.ImagePositionPatient))[2]] = dataset[i]
-		else:
-			pass
-
-	# Sort the files based on slice location.
-	sortedFiles = []
-	for key in sorted(files.keys()):
-		sortedFiles.append(files[key])
+	for fn, header in max(series,key=len):
+		position = header['ImagePositionPatient']
+		files[position[2] if position is not None else fn] = fn
 
 	# Return the sorted file list.
-	return sortedFiles
+	return list(files.values())
+
+def storedType(ref):
+	""" The numpy type of the stored pixel values of a DICOM image. """
+	bits = int(ref.get('BitsAllocated',16))
+	signed = int(ref.get('PixelRepresentation',1)) == 1
+	return np.dtype('{}int{}'.format('' if signed else 'u',bits))
+
+def peakMemory():
+	""" The peak resident memory of the process in bytes, None if the platform does not report it. """
+	try:
+		import resource
+	except ImportError:
+		return None
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Linux reports kilobytes, macOS reports bytes.
+	return rss if sys.platform == 'darwin' else rss*1024
+
+def _readSlice(fn):
+	""" Read the pixel data of a single DICOM file. """
+	return dicom.dcmread(fn).pixel_array
+
+def readSlices(dataset,array,workers=1,pool='thread',progress=None):
+	"""
+	Decode a list of DICOM files into a preallocated volume. Slice `i` of the dataset is written into `array[:,:,i]`.
+
+	Parameters
+	----------
+	dataset : list
+		The DICOM files, sorted by slice position.
+	array : ndarray
+		A preallocated array of shape (rows,columns,len(dataset)).
+	workers : int
+		The number of workers to decode with. 0 uses all available cores and 1 decodes serially in the calling thread.
+	pool : str
+		The type of worker pool, either 'thread' or 'process'.
+	progress : callable
+		Called as `progress(n,total)` each time a slice has been written into the array.
+	"""
+	total = len(dataset)
+	if workers == 0:
+		workers = os.cpu_count() or 1
+	workers = min(workers,total)
+	if workers <= 1:
+		# Serial decoding.
+		for index,fn in enumerate(dataset):
+			array[:,:,index] = _readSlice(fn)
+			if progress is not None: progress(index+1,total)
+		return array
+	# Parallel decoding, each slice is written into the array as soon as it is available.
+	if pool == 'process':
+		executor = ProcessPoolExecutor(max_workers=workers)
+	else:
+		executor = ThreadPoolExecutor(max_workers=workers)
+	with executor:
+		futures = {executor.submit(_readSlice,fn): index for index,fn in enumerate(dataset)}
+		for n,future in enumerate(as_completed(futures)):
+			array[:,:,futures[future]] = future.result()
+			if progress is not None: progress(n+1,total)
+	return array
 
 class ct(QtCore.QObject):
 	newCtView = QtCore.pyqtSignal()
-
-	def __init__(self,dataset,gpu):
+	# A preview has been replaced by the full resolution view.
+	refinedCtView = QtCore.pyqtSignal()
+	# A view has been calculated in the background (request, view).
+	_viewCalculated = QtCore.pyqtSignal(int,object)
+	# Attributes describing the volume geometry, these are stored alongside the volume in the cache.
+	_geometry = ['patientPosition','RCS','pixelSize','TLF','M','extent','rescaleSlope','rescaleIntercept']
+
+	def __init__(self,dataset,gpu,progress=None):
 		super().__init__()
 		# Hold a reference to the gpu instance.
 		self.gpu = gpu
@@ -155,25 +266,114 @@ class ct(QtCore.QObject):
 		if len(dataset) is 0:
 			# If the dataset has no CT files, then exit this function.
 			return
+
+		# Python coordinate system.
+		self.PCS = np.array([[0,1,0],[1,0,0],[0,0,1]])
+		# Look for a previously decoded copy of the dataset in the cache before reading it.
+		cacheKey = volumeCache.key(dataset) if config.cache.ct else None
+		cached = volumeCache.load(cacheKey) if cacheKey is not None else None
+		if cached is not None:
+			self.pixelArray, geometry = cached
+			for key in self._geometry:
+				setattr(self,key,geometry[key])
 		else:
-			# Else, read the first one as a reference point.
-			ref = dicom.dcmread(dataset[0])
+			self.readDataset(dataset,progress)
+			if cacheKey is not None:
+				volumeCache.save(cacheKey,dataset,self.pixelArray,{key:getattr(self,key) for key in self._geometry})
+
+		# Placeholder for a view extent.
+		self.viewExtent = np.zeros(self.extent.shape)
+
+		# Calculate the base extent.
+		self.baseExtent = np.concatenate([sorted(self.extent[i:i+2]) for i in range(0,6,2)])
+		# Find the (0,0,0) mm as an 'index' (float).
+		# self.zeroIndex = np.linalg.inv(self.M)@np.array([0,0,0,1])
+
+		# Load array onto GPU for future reference. Voxels outside of the volume are filled with air.
+		self.gpu.loadData(self.pixelArray,fill=self.stored(-1000))
+		# Create a 2d image list for plotting.
+		self.image = [Image2d(),Image2d()]
+		# Cache of computed views.
+		self.viewCache = cache.lru(config.ct.viewCache)
+		# Downsampled copies of the volume keyed by the downsampling factor, these are built in the background for large volumes.
+		self.levels = {}
+		self._pyramidRequest = 0
+		# Full resolution views of large volumes are calculated on a background worker, only the latest request is shown.
+		self._worker = ThreadPoolExecutor(max_workers=1)
+		self._viewRequest = 0
+		# The request whose preview is shown (see calculateView()).
+		self._previewRequest = None
+		self._viewCalculated.connect(self._showRefinedView)
+
+		# Create an isocenter for treatment if desired. This must be in DICOM XYZ.
+		self.isocenter = None
+
+		# Set the default.
+		self.calculateView('AP')
+		self._startPyramid()
+		logging.info("CT memory usage (MB): {}".format({key:round(value/1024**2,1) for key,value in self.memoryReport().items()}))
+
+	def rescale(self,array,n=1):
+		"""
+		Convert stored values into Hounsfield Units.
+
+		Parameters
+		----------
+		array : ndarray
+			Stored values, or a sum projection of stored values.
+		n : int
+			The number of voxels summed into each value of `array`.
+		"""
+		return self.rescaleSlope*array + n*self.rescaleIntercept
+
+	def stored(self,hu):
+		""" Convert a Hounsfield Unit into the nearest stored value. """
+		value = int(np.rint((hu-self.rescaleIntercept)/self.rescaleSlope))
+		info = np.iinfo(self.pixelArray.dtype)
+		return int(np.clip(value,info.min,info.max))
+
+	def memoryReport(self):
+		"""
+		Report the memory used by the CT in bytes.
+			volume: The host volume (stored values).
+			device: The volume on the compute device (int32).
+			deviceAllocated: Everything allocated by the compute backend (the volume, rotated volumes and buffers kept for reuse).
+			projections: The current 2D images.
+			viewCache: The cached views.
+			pyramid: The downsampled volumes used for previews.
+			importPeak: The expected peak memory of an import, the volume plus the largest chunk staged for the device.
+			peakRSS: The peak resident memory of the process (if the platform reports it).
+		"""
+		report = {}
+		report['volume'] = self.pixelArray.nbytes
+		report['device'] = int(np.prod(self.pixelArray.shape))*np.dtype(np.int32).itemsize
+		report['deviceAllocated'] = self.gpu.memoryUsage()['allocated']
+		report['projections'] = sum(np.asarray(image.pixelArray).nbytes for image in self.image if image.pixelArray is not None)
+		report['importPeak'] = report['volume'] + min(report['device'],self.gpu.chunkSize)
+		rss = peakMemory()
+		if rss is not None:
+			report['peakRSS'] = rss
+		report['viewCache'] = self.viewCache.nbytes
+		report['pyramid'] = sum(level.nbytes for level in self.levels.values())
+		return report
+
+	def readDataset(self,dataset,progress=None):
+		""" Decode the CT volume from a sorted list of DICOM files and calculate its geometry. """
+		# Read the header of the first one as a reference point.
+		ref = dicom.dcmread(dataset[0],stop_before_pixels=True)
 
 		# Get the 3D CT array shape.
 		shape = np.array([int(ref.Rows), int(ref.Columns), len(dataset)])
-		# Create an empty python array to dump the CT data into.
-		self.pixelArray = np.zeros(shape, dtype=np.int32)
-		# Read array in one slice at a time.
-		for index,fn in enumerate(dataset):
-			ctSlice = dicom.dcmread(fn)
-			self.pixelArray[:,:,dataset.index(fn)] = ctSlice.pixel_array
-
-		# Rescale the Hounsfield Units.
-		self.pixelArray = (self.pixelArray*ref.RescaleSlope) + ref.RescaleIntercept
+		# Create an empty python array (of the type the values are stored as) to dump the CT data into.
+		self.pixelArray = np.zeros(shape, dtype=storedType(ref))
+		# Decode the slices into the array.
+		readSlices(dataset,self.pixelArray,workers=config.ct.workers,pool=config.ct.pool,progress=progress)
+
+		# Hounsfield Units are calculated from the stored values when needed (see ct.rescale()).
+		self.rescaleSlope = float(ref.get('RescaleSlope',1))
+		self.rescaleIntercept = float(ref.get('RescaleIntercept',0))
 		# Get current CT orientation.
-		self.patientPosition = ref.PatientPosition
-		# Python coordinate system.
-		self.PCS = np.array([[0,1,0],[1,0,0],[0,0,1]])
+		self.patientPosition = str(ref.PatientPosition)
 		# Patient reference coordinate system (RCS).
 		dcmAxes =  np.array(list(map(float,ref.ImageOrientationPatient)))
 		x = dcmAxes[:3]
@@ -182,7 +382,7 @@ class ct(QtCore.QObject):
 		self.RCS = np.vstack((x,y,z))
 		# Calculate spacing between slices as it isn't always provided.
 		z1 = list(map(float,ref.ImagePositionPatient))[2]
-		z2 = list(map(float,dicom.dcmread(dataset[-1]).ImagePositionPatient))[2]
+		z2 = list(map(float,dicom.dcmread(dataset[-1],stop_before_pixels=True).ImagePositionPatient))[2]
 		spacingBetweenSlices = (z2-z1)/(len(dataset)-1)
 		# Get the pixel size.
 		self.pixelSize = np.append(np.array(list(map(float,ref.PixelSpacing))),spacingBetweenSlices)
@@ -210,25 +410,6 @@ class ct(QtCore.QObject):
 		_z = [voxelPosition1[2],voxelPosition2[2]]
 		self.extent = np.array(_x+_y+_z).reshape((6,))
 
-		# Placeholder for a view extent.
-		self.viewExtent = np.zeros(self.extent.shape)
-
-		# Calculate the base extent.
-		# self.baseExtent = np.array(sorted(_x)+sorted(_y)+sorted(_z)).reshape((6,))
-		# Find the (0,0,0) mm as an 'index' (float).
-		# self.zeroIndex = np.linalg.inv(self.M)@np.array([0,0,0,1])
-
-		# Load array onto GPU for future reference.
-		self.gpu.loadData(self.pixelArray)
-		# Create a 2d image list for plotting.
-		self.image = [Image2d(),Image2d()]
-
-		# Create an isocenter for treatment if desired. This must be in DICOM XYZ.
-		self.isocenter = None
-
-		# Set the default.
-		self.calculateView('AP')
-
 	def calculateView(self,view,roi=None,flatteningMethod='sum'):
 		""" Rotate the CT array for a new view of the dataset. """
 		# Make the RCS for each view. 
@@ -266,11 +447,6 @@ class ct(QtCore.QObject):
 
 		# Calculate a transform, W, that takes us from the original CT RCS to the new RCS.
 		W = wcs2wcs(self.RCS,RCS)
-		# Rotate the CT if required.
-		if np.array_equal(W,np.identity(3)):
-			pixelArray = self.pixelArray
-		else:
-			pixelArray = self.gpu.rotate(W)
 		# Calculate the new extent.
 		# Find Origin
 		origin = (np.linalg.inv(self.M)@np.array([0,0,0,1]))[:3]
@@ -313,6 +489,8 @@ class ct(QtCore.QObject):
 		self.viewM[:3,3] = TLF
 		self.viewM[3,3] = 1
 
+		# The box of the view array to flatten (None is the whole array).
+		box = None
 		if np.array_equal(roi,self.viewExtent):
 			# This does not work...
 			temporary_extent = self.viewExtent
@@ -333,26 +511,195 @@ class ct(QtCore.QObject):
 			x1,x2 = sorted([x1,x2])
 			y1,y2 = sorted([y1,y2])
 			z1,z2 = sorted([z1,z2])
-			# Slice the array.
-			pixelArray = pixelArray[y1:y2,x1:x2,z1:z2]
+			# The box of the array to flatten.
+			box = (slice(y1,y2),slice(x1,x2),slice(z1,z2))
 		else:
 			temporary_extent = self.viewExtent
 
+		# Views are cached by the view, the ROI (as array indices) and the flattening method.
+		key = (view,None if box is None else tuple((b.start,b.stop) for b in box),flatteningMethod)
+		# Any view still being calculated in the background is now out of date.
+		self._viewRequest += 1
+		cached = self.viewCache.get(key)
+		if cached is not None:
+			logging.debug("Using the cached {} view.".format(view))
+			self._applyView(cached)
+			self.newCtView.emit()
+			return
+
 		# Split up into x, y and z extents for 2D image.
 		x,y,z = [temporary_extent[i:i+2] for i in range(0,len(temporary_extent),2)]
-		# Get the first flattened image.
-		if flatteningMethod == 'sum': self.image[0].pixelArray = np.sum(pixelArray,axis=2)
-		elif flatteningMethod == 'max': self.image[0].pixelArray = np.amax(pixelArray,axis=2)
-		self.image[0].extent = np.array(list(x)+list(y))
-		self.image[0].view = { 'title':t1 }
-		# Get the second flattened image.
-		if flatteningMethod == 'sum': self.image[1].pixelArray = np.sum(pixelArray,axis=1)
-		elif flatteningMethod == 'max': self.image[1].pixelArray = np.amax(pixelArray,axis=1)
-		self.image[1].extent = np.array(list(z)+list(y))
-		self.image[1].view = { 'title':t2 }
-
-		# Emit a signal to say a new view has been loaded.
-		self.newCtView.emit()
+		extents = [np.array(list(x)+list(y)),np.array(list(z)+list(y))]
+		titles = [t1,t2]
+		# Rotations that only reorder and flip the axes are strided views of the CT (no copy).
+		P = permutation.signedPermutation(self.gpu.arrayRotation(W))
+
+		# The pyramid is replaced as a whole once it has been built on the worker, take it once.
+		levels = self.levels
+		if len(levels) == 0:
+			# Calculate the view at full resolution.
+			self._applyView(self._calculateView(key,W,P,box,extents,titles,self.viewExtent,self.viewM))
+			self.newCtView.emit()
+			return
+
+		# Show the coarsest level of the pyramid then calculate the full resolution view in the background.
+		# Rotated views have no preview, the full resolution view is loaded as a new view once it has been calculated.
+		self._previewRequest = self._viewRequest if P is not None else None
+		if P is not None:
+			factor = max(levels)
+			coarse = permutation.permute(levels[factor],P)
+			coarseBox = None if box is None else tuple(slice(b.start//factor,-(-b.stop//factor)) for b in box)
+			self._applyView({
+					'images': [(self.preview(coarse,coarseBox,axis,flatteningMethod,factor),extent,title) for axis,extent,title in zip([2,1],extents,titles)],
+					'viewExtent': self.viewExtent,
+					'viewM': self.viewM,
+				})
+			self.newCtView.emit()
+		self._worker.submit(self._refineView,self._viewRequest,key,W,P,box,extents,titles,self.viewExtent,self.viewM)
+
+	def _calculateView(self,key,W,P,box,extents,titles,viewExtent,viewM):
+		""" Rotate the CT and flatten it into the two images of a view, the result is added to the view cache. """
+		view, _, flatteningMethod = key
+		if P is not None:
+			# Flatten a strided view of the CT.
+			pixelArray = permutation.permute(self.pixelArray,P)
+			flat = [self.project(view,pixelArray,box,axis,flatteningMethod) for axis in [2,1]]
+		else:
+			# Rotate and flatten the CT on the device, only the images are copied back.
+			shape = self.gpu.rotatedShape(W)
+			_box = box if box is not None else (slice(None),)*3
+			flat = []
+			for axis, image in zip([2,1],self.gpu.project(W,flatteningMethod,axes=(2,1),box=box)):
+				if flatteningMethod == 'sum': flat.append(self.rescale(image,len(range(*_box[axis].indices(shape[axis])))))
+				else: flat.append(self.rescale(image))
+		entry = {
+				'images': [(image,extent,title) for image,extent,title in zip(flat,extents,titles)],
+				'viewExtent': viewExtent,
+				'viewM': viewM,
+			}
+		self.viewCache.put(key,entry)
+		return entry
+
+	def _refineView(self,request,key,W,P,box,extents,titles,viewExtent,viewM):
+		""" Calculate a full resolution view on the background worker. """
+		if request != self._viewRequest:
+			# A newer view has been requested.
+			return
+		try:
+			entry = self._calculateView(key,W,P,box,extents,titles,viewExtent,viewM)
+		except Exception as e:
+			logging.error("Could not calculate the {} view: {}".format(key[0],e))
+			return
+		self._viewCalculated.emit(request,entry)
+
+	# A Qt slot, so it runs on the thread the CT lives in even when the CT was created (and connected) on another thread.
+	@QtCore.pyqtSlot(int,object)
+	def _showRefinedView(self,request,entry):
+		""" Replace the preview with the full resolution view (if it is still the current view). """
+		if request != self._viewRequest:
+			return
+		self._applyView(entry)
+		if request == self._previewRequest:
+			self.refinedCtView.emit()
+		else:
+			# No preview of this view was shown, the images (titles, histograms...) are loaded from scratch.
+			self.newCtView.emit()
+
+	def _applyView(self,entry):
+		""" Set the images, view extent and view matrix from a calculated view. """
+		for image, (pixelArray,imageExtent,title) in zip(self.image,entry['images']):
+			image.pixelArray = pixelArray
+			image.extent = imageExtent
+			image.view = { 'title':title }
+		self.viewExtent = entry['viewExtent']
+		self.viewM = entry['viewM']
+
+	def preview(self,pixelArray,box,axis,flatteningMethod,factor):
+		""" Flatten a box of a downsampled view array, the result approximates the full resolution image in Hounsfield Units. """
+		if box is not None:
+			pixelArray = pixelArray[box]
+		if flatteningMethod == 'sum':
+			# Each voxel stands in for `factor` voxels along the axis.
+			return factor*self.rescale(np.sum(pixelArray,axis=axis,dtype=np.int64),pixelArray.shape[axis])
+		elif flatteningMethod == 'max':
+			return self.rescale(np.amax(pixelArray,axis=axis))
+
+	def _startPyramid(self):
+		""" Build the pyramid of a large volume on the background worker. """
+		if config.ct.previewLevels and (self.pixelArray.size > config.ct.previewVoxels):
+			self._worker.submit(self._buildPyramid,self._pyramidRequest)
+
+	def _buildPyramid(self,request):
+		""" Downsample the volume for previews, each level is made from the previous one. """
+		try:
+			levels = {}
+			level = self.pixelArray
+			previous = 1
+			for factor in sorted(config.ct.previewLevels):
+				level = resample.downsample(level,factor//previous)
+				previous = factor
+				levels[factor] = level
+				logging.debug("Built the {}x downsampled CT volume {}.".format(factor,level.shape))
+			# Views read the levels on the GUI thread, they only ever see a complete pyramid (and never one of a volume that has since changed).
+			if request == self._pyramidRequest:
+				self.levels = levels
+		except Exception as e:
+			logging.error("Could not build the downsampled CT volumes: {}".format(e))
+
+	def project(self,view,pixelArray,box,axis,flatteningMethod):
+		"""
+		Flatten a box of the view array along an axis and return the image in Hounsfield Units.
+		If a box is given (a ROI) the projection is taken from precomputed tables of the view, these are calculated on the first request.
+		"""
+		if box is None:
+			n = pixelArray.shape[axis]
+			flat = projection.flatten(pixelArray,axis,flatteningMethod,workers=config.ct.projectionWorkers)
+		else:
+			n = len(range(*box[axis].indices(pixelArray.shape[axis])))
+			if config.ct.roiTables:
+				flat = self._projectionTable(view,pixelArray,axis,flatteningMethod).project(box)
+			else:
+				flat = projection.flatten(pixelArray[box],axis,flatteningMethod,workers=config.ct.projectionWorkers)
+		if flatteningMethod == 'sum': return self.rescale(flat,n)
+		else: return self.rescale(flat)
+
+	def _projectionTable(self,view,pixelArray,axis,flatteningMethod):
+		""" Get the summed volume table or max pyramid for a view. Only the tables of the current view are kept. """
+		if getattr(self,'_tablesView',None) != view:
+			self._tables = {}
+			self._tablesView = view
+		key = (flatteningMethod,axis)
+		if key not in self._tables:
+			logging.debug("Calculating the {} table for axis {} of the {} view.".format(flatteningMethod,axis,view))
+			if flatteningMethod == 'sum': self._tables[key] = projection.summedVolumeTable(pixelArray,axis)
+			elif flatteningMethod == 'max': self._tables[key] = projection.maxPyramid(pixelArray,axis)
+		return self._tables[key]
+
+	def drr(self):
+		""" Get a DRR generator for the volume (see tools.drr), it is created on first use. """
+		if getattr(self,'_drr',None) is None:
+			# Map array indices to voxel centres in the patient. The row index runs along the column direction (y) and the column index along the row direction (x).
+			x, y, z = self.RCS
+			M = np.identity(4)
+			M[:3,0] = self.pixelSize[0]*y
+			M[:3,1] = self.pixelSize[1]*x
+			M[:3,2] = self.pixelSize[2]*z
+			M[:3,3] = self.TLF - np.sign(self.TLF)*(self.pixelSize/2)
+			self._drr = drrInterface.drr(self.pixelArray,M,self.rescaleSlope,self.rescaleIntercept)
+		return self._drr
+
+	def invalidateViews(self):
+		""" Discard all computed views, projection tables and downsampled volumes, this must be called whenever the volume changes. """
+		self._viewRequest += 1
+		self._previewRequest = None
+		self._drr = None
+		self.viewCache.invalidate()
+		self._tables = {}
+		self._tablesView = None
+		# The pyramid (and any being built) is of the old volume, previews wait for the pyramid of the new one.
+		self._pyramidRequest += 1
+		self.levels = {}
+		self._startPyramid()
 
 	def calculateIndices(self,extent):
 		""" Calculate the indices of the CT array for a given ROI. """
@@ -368,7 +715,9 @@ class ct(QtCore.QObject):
 
 class beamClass:
 	def __init__(self):
-		self.image = None
+		self._image = None
+		# A callable that returns the projections of the beam (see rtplan).
+		self._calculate = None
 		self.mask = None
 		self.maskThickness = None
 		self.gantry = None
@@ -381,14 +730,32 @@ class beamClass:
 		self._arr2bcs = None
 		self._dcm2bcs = None
 
-class rtplan:
+	@property
+	def image(self):
+		""" The two beam's eye view projections. They are calculated on first use, or waited for if they are being prefetched. """
+		if (self._image is None) and (self._calculate is not None):
+			self._image = self._calculate()
+		return self._image
+
+	@image.setter
+	def image(self,image):
+		self._image = image
+
+class rtplan(QtCore.QObject):
+	# The projections of a beam (index) have been calculated.
+	beamCalculated = QtCore.pyqtSignal(int)
+
 	def __init__(self,rtplan,ct,gpu):
 		"""
 			RCS: Reference Coordinate System (Patient)
 			BCS: Beam Coordinate System (Linac)
 			PCS: Pyhon Coordinate System (DICOM to Python)
+		The beam's eye view projections are calculated on demand (see beamClass.image) and prefetched in beam order in the background.
 		"""
+		super().__init__()
 		self.PCS = np.array([[0,1,0],[1,0,0],[0,0,1]])
+		self.ct = ct
+		self.gpu = gpu
 
 		# Firstly, read in DICOM rtplan file.
 		ref = dicom.dcmread(rtplan[0])
@@ -468,17 +835,11 @@ class rtplan:
 			logging.info("\nBEV RCS:\n {}".format(self.beam[i].RCS))
 			logging.info("\nW:\n {}".format(self.beam[i].W))
 
-			# Rotate the CT.
-			self.beam[i].pixelArray = gpu.rotate(self.beam[i].W)
-
 			# Calculate the new pixel size.
 			self.beam[i].pixelSize = np.absolute(self.beam[i].W@ct.pixelSize)
 
 			logging.info("\nPixelSize: {}".format(self.beam[i].pixelSize))
 
-			# Create the 2d projection images.
-			self.beam[i].image = [Image2d(),Image2d()]
-
 			# testAxes = np.absolute(self.beam[i].W)
 			# Find the RCS of the beam view.
 			testAxes = np.absolute(self.beam[i].RCS)
@@ -519,11 +880,75 @@ class rtplan:
 
 			logging.info("\nIsocenter: {}".format(self.beam[i].isocenter))
 
-			# Flatten the 3d image to the two 2d images.
-			self.beam[i].image[0].pixelArray = np.sum(self.beam[i].pixelArray,axis=2)
-			self.beam[i].image[0].extent = np.array([self.beam[i].extent[0],self.beam[i].extent[1],self.beam[i].extent[3],self.beam[i].extent[2]])
-			self.beam[i].image[1].pixelArray = np.sum(self.beam[i].pixelArray,axis=1)
-			self.beam[i].image[1].extent = np.array([self.beam[i].extent[4],self.beam[i].extent[5],self.beam[i].extent[3],self.beam[i].extent[2]])
+		# Calculate the projections of each beam in the background, in beam order.
+		if config.rtplan.prefetch:
+			futures = [Future() for _ in self.beam]
+			for i in range(len(self.beam)):
+				self.beam[i]._calculate = futures[i].result
+			self._worker = ThreadPoolExecutor(max_workers=1)
+			self._worker.submit(self._prefetch,futures)
+		else:
+			for i in range(len(self.beam)):
+				self.beam[i]._calculate = partial(self.calculateBeam,i)
+
+	def _prefetch(self,futures):
+		""" Calculate all beams, each future is completed as soon as its beam is ready. """
+		try:
+			self.calculateBeams(range(len(self.beam)),callback=lambda i,image: futures[i].set_result(image))
+		except Exception as e:
+			logging.error("Could not calculate the beam projections: {}".format(e))
+			for future in futures:
+				if not future.done():
+					future.set_exception(e)
+
+	def calculateBeam(self,index):
+		""" Calculate the projections of a single beam, see calculateBeams(). """
+		return self.calculateBeams([index])[0]
+
+	def calculateBeams(self,indices,callback=None):
+		"""
+		Rotate the CT into the beam's eye view of each beam and flatten it into two images (in Hounsfield Units). The rotated volumes are discarded.
+		Rotations that only reorder and flip the axes are strided views of the CT (no copy), the rest are rotated on the device in a single batch.
+
+		Parameters
+		----------
+		indices : list
+			The beams to calculate, in the order they are wanted.
+		callback : function
+			Called with (index, images) as each beam is completed.
+		"""
+		indices = list(indices)
+		P = {i: permutation.signedPermutation(self.gpu.arrayRotation(self.beam[i].W)) for i in indices}
+		rotated = [i for i in indices if P[i] is None]
+		images = {}
+		for i in indices:
+			if P[i] is not None:
+				pixelArray = permutation.permute(self.ct.pixelArray,P[i])
+				flat = [projection.flatten(pixelArray,axis,workers=config.ct.projectionWorkers) for axis in (2,1)]
+				images[i] = self._setBeamImages(i,flat,pixelArray.shape)
+				if callback is not None: callback(i,images[i])
+			elif i == rotated[0]:
+				for j, flat in zip(rotated,self.gpu.rotateBatch([self.beam[j].W for j in rotated],axes=(2,1))):
+					images[j] = self._setBeamImages(j,flat,self.gpu.rotatedShape(self.beam[j].W))
+					if callback is not None: callback(j,images[j])
+		return [images[i] for i in indices]
+
+	def _setBeamImages(self,index,flat,shape):
+		""" Make the beam images from the (stored value) sums along axes 2 and 1 of the rotated CT. """
+		beam = self.beam[index]
+		image = [Image2d(),Image2d()]
+		image[0].pixelArray = self.ct.rescale(flat[0],shape[2])
+		image[0].extent = np.array([beam.extent[0],beam.extent[1],beam.extent[3],beam.extent[2]])
+		image[1].pixelArray = self.ct.rescale(flat[1],shape[1])
+		image[1].extent = np.array([beam.extent[4],beam.extent[5],beam.extent[3],beam.extent[2]])
+		beam.image = image
+		logging.debug("Calculated the projections of beam {}.".format(index+1))
+		self.beamCalculated.emit(index)
+		return image
+
+	def isCalculated(self,index):
+		""" Whether the projections of a beam are available without waiting. """
+		return self.beam[index]._image is not None
 
 	def getIsocenter(self,beamIndex):
 		return self.PCS@self.beam[beamIndex].isocenter
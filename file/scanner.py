@@ -0,0 +1,139 @@
+import os
+import json
+import hashlib
+import pydicom as dicom
+from pydicom.errors import InvalidDicomError
+from resources import config
+import logging
+
+'''
+Single pass, header only scanning of DICOM files.
+	Only the tags required to sort a dataset into series are read and
+	parsing stops before the pixel data. The headers are kept in an on
+	disk index (one per folder) keyed by the file path, modification time
+	and size. Reopening a folder that has already been scanned then costs
+	a stat per file instead of a parse.
+'''
+
+# Tags required to group and sort the files.
+_tags = [
+		'Modality',
+		'SeriesInstanceUID',
+		'ImagePositionPatient',
+		'InstanceNumber',
+	]
+
+def _indexFile(folder):
+	""" The location of the on disk index for a folder. """
+	name = hashlib.sha1(os.path.abspath(folder).encode()).hexdigest()
+	return os.path.join(config.cache.directory,'dicomIndex',name+'.json')
+
+def _loadIndex(folder):
+	""" Load the on disk index for a folder, returns an empty index if there is none. """
+	try:
+		with open(_indexFile(folder)) as f:
+			return json.load(f)
+	except (OSError,ValueError):
+		return {}
+
+def _saveIndex(folder,index):
+	""" Save the on disk index for a folder. """
+	fp = _indexFile(folder)
+	try:
+		os.makedirs(os.path.dirname(fp),exist_ok=True)
+		# Write to a temporary file first so an interrupted write never leaves a corrupt index.
+		with open(fp+'.tmp','w') as f:
+			json.dump(index,f)
+		os.replace(fp+'.tmp',fp)
+	except OSError as e:
+		logging.warning("Could not save the DICOM index for {}: {}".format(folder,e))
+
+def readHeader(fn):
+	""" Read the tags required for sorting from a DICOM file without reading the pixel data. """
+	try:
+		ds = dicom.dcmread(fn,stop_before_pixels=True,specific_tags=_tags)
+	except (InvalidDicomError,OSError) as e:
+		logging.debug("Skipping {}: {}".format(fn,e))
+		return {'Modality':None}
+	header = {}
+	header['Modality'] = str(ds.get('Modality',''))
+	header['SeriesInstanceUID'] = str(ds.get('SeriesInstanceUID',''))
+	if 'ImagePositionPatient' in ds:
+		header['ImagePositionPatient'] = list(map(float,ds.ImagePositionPatient))
+	else:
+		header['ImagePositionPatient'] = None
+	if ds.get('InstanceNumber',None) is not None:
+		header['InstanceNumber'] = int(ds.InstanceNumber)
+	else:
+		header['InstanceNumber'] = None
+	return header
+
+def scan(dataset,useCache=True):
+	"""
+	Read the headers of a list of DICOM files and group them by modality and series.
+
+	Parameters
+	----------
+	dataset : list
+		A list of DICOM files.
+	useCache : bool
+		Use (and update) the on disk index.
+
+	Returns
+	-------
+	series : dict
+		Keyed by (Modality, SeriesInstanceUID). Each value is a list of (file, header) tuples sorted by slice position.
+	"""
+	# Group the files by folder, each folder has its own index.
+	folders = {}
+	for fn in dataset:
+		folders.setdefault(os.path.dirname(os.path.abspath(fn)),[]).append(fn)
+	series = {}
+	for folder, files in folders.items():
+		index = _loadIndex(folder) if useCache else {}
+		changed = False
+		for fn in files:
+			key = os.path.basename(fn)
+			try:
+				stat = os.stat(fn)
+			except OSError:
+				continue
+			entry = index.get(key)
+			if (entry is None) or (entry['mtime'] != stat.st_mtime_ns) or (entry['size'] != stat.st_size):
+				# New or modified file, read the header.
+				entry = readHeader(fn)
+				entry['mtime'] = stat.st_mtime_ns
+				entry['size'] = stat.st_size
+				index[key] = entry
+				changed = True
+			if entry['Modality'] is None:
+				continue
+			series.setdefault((entry['Modality'],entry['SeriesInstanceUID']),[]).append((fn,entry))
+		if useCache and changed:
+			_saveIndex(folder,index)
+	# Sort each series by slice position (or instance number if there is no position).
+	for key in series:
+		series[key].sort(key=_sortKey)
+	return series
+
+def scanFolder(folder,useCache=True):
+	""" Scan all DICOM files in a folder (and its subfolders) in a single pass. See scan(). """
+	dataset = []
+	for root, subdir, fp in os.walk(folder):
+		for fn in fp:
+			if fn.endswith('.dcm'):
+				dataset.append(os.path.join(root,fn))
+	return scan(dataset,useCache)
+
+def getSeries(series,modality):
+	""" Return the file lists of all series of a given modality, largest series first. """
+	files = [[fn for fn,_ in entries] for (_modality,_), entries in series.items() if _modality == modality]
+	return sorted(files,key=len,reverse=True)
+
+def _sortKey(item):
+	""" Sort by the slice position then the instance number. """
+	_, header = item
+	position = header['ImagePositionPatient']
+	z = position[2] if position is not None else 0
+	n = header['InstanceNumber'] if header['InstanceNumber'] is not None else 0
+	return (z,n)
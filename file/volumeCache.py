@@ -0,0 +1,144 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from file import scanner
+from resources import config
+import logging
+
+'''
+A persistent cache of decoded CT volumes.
+	Each entry is a folder in the cache directory holding the volume as
+	a .npy file (so it can be memory mapped on a reload) and a json file
+	with the geometry of the volume. Entries are keyed by the series UID
+	and a checksum of the file list (path, size and modification time of
+	every file), so any change to the files on disk invalidates the entry.
+	The total size of the cache is bounded by config.cache.ctSize, the
+	least recently used entries are evicted first.
+'''
+
+# Bump this when the stored representation changes so old entries are ignored.
+_version = 2
+
+def _directory():
+	""" The cache directory for CT volumes. """
+	return os.path.join(config.cache.directory,'ct')
+
+def _series(dataset):
+	""" The series UID of a dataset (taken from the scanner index). """
+	uids = sorted(uid for (_,uid) in scanner.scan(dataset).keys())
+	return '/'.join(uids)
+
+def key(dataset):
+	""" Calculate the cache key of a list of DICOM files. """
+	h = hashlib.sha1()
+	h.update('{}:{}'.format(_version,_series(dataset)).encode())
+	for fn in dataset:
+		stat = os.stat(fn)
+		h.update('{}:{}:{}'.format(os.path.abspath(fn),stat.st_size,stat.st_mtime_ns).encode())
+	return h.hexdigest()
+
+def load(key):
+	"""
+	Map a cached volume.
+
+	Returns
+	-------
+	(array, geometry) : (np.memmap, dict)
+		The read only volume and the dict of geometry arrays that were saved with it. None if the entry does not exist.
+	"""
+	folder = os.path.join(_directory(),key)
+	try:
+		with open(os.path.join(folder,'meta.json')) as f:
+			meta = json.load(f)
+		array = np.load(os.path.join(folder,'volume.npy'),mmap_mode='r')
+	except (OSError,ValueError):
+		return None
+	# Mark the entry as recently used, a cache on read only storage (or an entry trimmed by another instance) is still used.
+	try:
+		os.utime(os.path.join(folder,'meta.json'))
+	except OSError:
+		pass
+	geometry = {k: np.array(v) if isinstance(v,list) else v for k,v in meta['geometry'].items()}
+	logging.info("Loaded CT volume {} from the cache.".format(key))
+	return array, geometry
+
+def save(key,dataset,array,geometry):
+	"""
+	Save a volume and its geometry into the cache. Stale entries of the same series are invalidated and the cache is trimmed to size.
+
+	Parameters
+	----------
+	key : str
+		The cache key, see key().
+	dataset : list
+		The DICOM files the volume was read from.
+	array : ndarray
+		The volume.
+	geometry : dict
+		Arrays (or values) describing the volume, these are returned as numpy arrays by load().
+	"""
+	if array.nbytes > config.cache.ctSize:
+		return
+	folder = os.path.join(_directory(),key)
+	meta = {
+		'series': _series(dataset),
+		'nbytes': int(array.nbytes),
+		'geometry': {k: v.tolist() if isinstance(v,np.ndarray) else v for k,v in geometry.items()},
+	}
+	try:
+		# Write into a temporary folder then move it into place, a partially written entry is never visible.
+		tmp = folder+'.tmp'
+		shutil.rmtree(tmp,ignore_errors=True)
+		os.makedirs(tmp)
+		np.save(os.path.join(tmp,'volume.npy'),array)
+		with open(os.path.join(tmp,'meta.json'),'w') as f:
+			json.dump(meta,f)
+		shutil.rmtree(folder,ignore_errors=True)
+		os.replace(tmp,folder)
+	except OSError as e:
+		logging.warning("Could not save the CT volume to the cache: {}".format(e))
+		shutil.rmtree(folder+'.tmp',ignore_errors=True)
+		return
+	invalidate(meta['series'],keep=key)
+	trim(keep=key)
+
+def entries():
+	""" List the cache entries as (key, series, nbytes, last access). """
+	result = []
+	if not os.path.isdir(_directory()):
+		return result
+	for name in os.listdir(_directory()):
+		fp = os.path.join(_directory(),name,'meta.json')
+		try:
+			with open(fp) as f:
+				meta = json.load(f)
+			result.append((name,meta['series'],meta['nbytes'],os.stat(fp).st_mtime))
+		except (OSError,ValueError,KeyError):
+			continue
+	return result
+
+def remove(key):
+	""" Remove an entry from the cache. """
+	shutil.rmtree(os.path.join(_directory(),key),ignore_errors=True)
+
+def invalidate(series,keep=None):
+	""" Remove all entries of a series (except `keep`), these were made from files that have since changed. """
+	for name, _series, _, _ in entries():
+		if (_series == series) and (name != keep):
+			logging.debug("Removing stale CT volume {} from the cache.".format(name))
+			remove(name)
+
+def trim(keep=None):
+	""" Evict the least recently used entries until the cache fits within config.cache.ctSize. """
+	cached = sorted(entries(),key=lambda entry: entry[3])
+	total = sum(entry[2] for entry in cached)
+	for name, _, nbytes, _ in cached:
+		if total <= config.cache.ctSize:
+			break
+		if name == keep:
+			continue
+		logging.debug("Evicting CT volume {} from the cache.".format(name))
+		remove(name)
+		total -= nbytes
@@ -0,0 +1,139 @@
+import time
+import queue
+import threading
+from PyQt5 import QtCore
+from resources import config
+import logging
+
+'''
+Write acquired x-ray images to a patient HDF5 file in the background.
+	Images are queued as they are acquired and written by a dedicated
+	thread, so slow (e.g. network) storage does not hold up the GUI or
+	the next step of a scan. The thread writes everything that is waiting
+	in one go and flushes the file at most every config.hdf5.flushInterval
+	seconds. An image set is only reported (written) once it has been
+	flushed. The queue holds at most config.hdf5.writerQueue images, when
+	the storage falls behind queueing an image waits for space.
+	The displays of images that do not have one are also built here (see
+	buildDisplays()).
+'''
+
+# Queue items.
+_image, _end, _flush, _stop, _display = range(5)
+
+class writer(QtCore.QObject):
+	"""
+	A background writer of image sets for a hdf5.file.
+
+	Attributes
+	----------
+	written : pyqtSignal(str, int)
+		An image set with `name` and `n` images has been written and flushed to disk.
+	failed : pyqtSignal(str)
+		An image set could not be written, with the error.
+	"""
+	written = QtCore.pyqtSignal(str,int)
+	failed = QtCore.pyqtSignal(str)
+
+	def __init__(self,file):
+		super().__init__()
+		self.file = file
+		self._queue = queue.Queue(maxsize=max(1,config.hdf5.writerQueue))
+		self._thread = threading.Thread(target=self._run,name='hdf5 writer',daemon=True)
+		self._thread.start()
+
+	def addImage(self,data,metadata):
+		""" Queue an image and its metadata, it is added to the current set (a new set is started after endSet()). """
+		self._put((_image,data,dict(metadata)))
+
+	def endSet(self):
+		""" Finish the current set, it is reported with written() once it is on disk. """
+		self._put((_end,))
+
+	def addImageSet(self,_set):
+		""" Queue a complete set of (data, metadata) images. """
+		for data, metadata in _set:
+			self.addImage(data,metadata)
+		self.endSet()
+
+	def buildDisplays(self):
+		""" Store the displays of the images in the file that do not have one (see hdf5.file.buildDisplays()). """
+		self._put((_display,))
+
+	def flush(self):
+		""" Flush everything queued so far without waiting for the next scheduled flush. """
+		self._put((_flush,))
+
+	def close(self):
+		""" Write and flush everything that is queued, then stop the thread. """
+		if self._thread.is_alive():
+			self._put((_stop,))
+			self._thread.join()
+
+	def pending(self):
+		""" The number of items waiting to be written. """
+		return self._queue.qsize()
+
+	def _put(self,item):
+		if self._queue.full():
+			logging.warning("The HDF5 writer is falling behind, waiting for it to catch up.")
+		self._queue.put(item)
+
+	def _run(self):
+		# The set being written as (name, group), sets that are written but not flushed as (name, n).
+		current = None
+		unflushed = []
+		lastFlush = time.monotonic()
+		stopping = False
+		while not stopping:
+			timeout = max(0,config.hdf5.flushInterval-(time.monotonic()-lastFlush)) if unflushed else None
+			try:
+				items = [self._queue.get(timeout=timeout)]
+			except queue.Empty:
+				items = []
+			# Take everything else that is waiting as one batch.
+			while True:
+				try:
+					items.append(self._queue.get_nowait())
+				except queue.Empty:
+					break
+			force = False
+			for item in items:
+				try:
+					if item[0] == _image:
+						if current is None:
+							current = self.file.createImageSet()
+						self.file.addImage(current[1],item[1],item[2])
+					elif item[0] == _end:
+						try:
+							if current is not None:
+								self.file.indexImageSet(*current)
+								unflushed.append((current[0],len(current[1])))
+								logging.debug("Wrote {} images to set {}.".format(len(current[1]),current[0]))
+						finally:
+							# The next images start a new set, even if this one could not be finished.
+							current = None
+					elif item[0] == _display:
+						# A flush asked for earlier in the batch still happens.
+						force = (self.file.buildDisplays() > 0) or force
+					elif item[0] == _flush:
+						force = True
+					elif item[0] == _stop:
+						stopping = True
+				except Exception as e:
+					logging.exception("Could not write to the HDF5 file {}.".format(self.file.filename))
+					self.failed.emit(str(e))
+			if force or stopping or (unflushed and (time.monotonic()-lastFlush >= config.hdf5.flushInterval)):
+				# A failed flush is tried again at the next scheduled flush.
+				lastFlush = time.monotonic()
+				try:
+					self.file.flush()
+				except Exception as e:
+					logging.exception("Could not flush the HDF5 file {}.".format(self.file.filename))
+					self.failed.emit(str(e))
+					continue
+				for name, n in unflushed:
+					self.written.emit(name,n)
+				unflushed = []
+		if current is not None:
+			logging.warning("The HDF5 writer stopped with the unfinished image set {}.".format(current[0]))
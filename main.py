@@ -1,6 +1,7 @@
 # Internal imports.
 from resources import config, ui
 import systems
+from file import scanner
 import QsWidgets
 # Core imports.
 import os
@@ -141,6 +142,13 @@ class main(QtWidgets.QMainWindow, Ui_MainWindow):
 		self.patient = systems.patient.Patient()
 		# Link the system with the patient data.
 		self.system.loadPatient(self.patient)
+		# Show the progress of patient data imports.
+		self.patient.loadProgress.connect(self.updateLoadProgress)
+		self.patient.loadFailed.connect(self.showLoadError)
+		# CTs are imported in the background, they are shown once they have loaded.
+		self.patient.ctLoaded.connect(self.showCT)
+		# An RTPLAN opened while its CT is imported, it is opened once the CT has loaded.
+		self._pendingRtplan = None
 
 		"""
 		More GUI linking from System and Patient.
@@ -156,6 +164,16 @@ class main(QtWidgets.QMainWindow, Ui_MainWindow):
 		self.system.newImageSet.connect(self.sbImaging.addImageSet)
 		# When the current xray image setlist set is changed, plot it.
 		self.sbImaging.imageSetChanged.connect(self.loadXrayImage)
+		# X-ray files that another process is writing to are checked for new image sets.
+		self._xrayRefresh = QtCore.QTimer(self)
+		self._xrayRefresh.setInterval(int(config.hdf5.refreshInterval*1000))
+		self._xrayRefresh.timeout.connect(self.refreshXray)
+		# X-ray images are shown from their previews while browsing the image sets, see loadXrayImage().
+		self._xrayImages = None
+		self._xrayRefine = QtCore.QTimer(self)
+		self._xrayRefine.setSingleShot(True)
+		self._xrayRefine.setInterval(int(config.hdf5.refineDelay*1000))
+		self._xrayRefine.timeout.connect(self.refineXrayImages)
 		# Tell the system to acquire an x-ray.
 		self.sbImaging.acquire.connect(self.system.acquireXray)
 		# When the image mode changes tell the system.
@@ -198,6 +216,7 @@ class main(QtWidgets.QMainWindow, Ui_MainWindow):
 			if file.endswith('.hdf5') is False:
 				file += '.hdf5'
 			self.patient.new(file,'DX')
+			self._xrayRefresh.stop()
 			# Create an xray workspace.
 			if self._isXrayOpen:
 				# We have one. Reset it.
@@ -227,13 +246,11 @@ class main(QtWidgets.QMainWindow, Ui_MainWindow):
 			fileDialogue = QtWidgets.QFileDialog()
 			fileDialogue.setFileMode(QtWidgets.QFileDialog.Directory)
 			folder = fileDialogue.getExistingDirectory(self, "Open CT dataset", "")
-			dataset = []
-			for root, subdir, fp in os.walk(folder):
-				for fn in fp:
-					if (fn.endswith(tuple('.dcm'))) & (fn[:len(modality)] == 'CT'):
-						dataset.append(os.path.join(root,fn))
+			if folder == '': return
+			# Sort the DICOM files into series by reading their headers.
+			dataset = scanner.getSeries(scanner.scanFolder(folder),'CT')
 			if len(dataset) > 0:
-				self.openCT(dataset)
+				self.openCT(dataset[0])
 
 		elif modality == 'xray':
 			fileFormat = 'HDF5 (*.hdf5)'
@@ -263,35 +280,29 @@ class main(QtWidgets.QMainWindow, Ui_MainWindow):
 			fileDialogue.setFileMode(QtWidgets.QFileDialog.Directory)
 			folder = fileDialogue.getExistingDirectory(self, "Open dataset folder", "")
 			if folder != '':
-				dataset = []
-				modality = 'xray'
+				# Walk the folder once, reading only the headers of the DICOM files.
+				xray = []
+				dicomFiles = []
 				for root, subdir, fp in os.walk(folder):
 					for fn in fp:
-						if (fn.endswith(tuple('.hdf5'))) & (fn[:len(modality)] == modality):
-							dataset.append(os.path.join(root,fn))
-				if len(dataset) > 0:
-					self.patient.load(dataset,'DX')
-					self.openXray(dataset[0])
+						if fn.endswith('.hdf5') & fn.startswith('xray'):
+							xray.append(os.path.join(root,fn))
+						elif fn.endswith('.dcm'):
+							dicomFiles.append(os.path.join(root,fn))
+				series = scanner.scan(dicomFiles)
 
-				dataset = []
-				modality = 'CT'
-				for root, subdir, fp in os.walk(folder):
-					for fn in fp:
-						if (fn.endswith(tuple('.dcm'))) & (fn[:len(modality)] == modality):
-							dataset.append(os.path.join(root,fn))
+				if len(xray) > 0:
+					self.openXray(xray[0])
+
+				dataset = scanner.getSeries(series,'CT')
 				if len(dataset) > 0:
-					self.openCT(dataset)	
-				
-				dataset = []
-				modality = 'RP'
-				for root, subdir, fp in os.walk(folder):
-					for fn in fp:
-						if (fn.endswith(tuple('.dcm'))) & (fn[:len(modality)] == modality):
-							dataset.append(os.path.join(root,fn))
+					self.openCT(dataset[0])
+
+				dataset = scanner.getSeries(series,'RTPLAN')
 				if len(dataset) > 0:
-					self.openRTP(dataset)
+					self.openRTP(dataset[0])
 
-				self.environment.button['CT'].clicked.emit()
+				# A CT opens its workspace once it has been imported (see showCT()).
 
 	def openXray(self,files):
 		"""Open XR (x-ray) modality files."""
@@ -320,9 +331,24 @@ class main(QtWidgets.QMainWindow, Ui_MainWindow):
 		# Finalise import. Set open status to true and open the workspace.
 		self._isXrayOpen = True
 		# self.sbImaging.enableAcquisition()
+		if self.patient.dx.readOnly:
+			# Another process is acquiring into the file, follow it.
+			self.sbImaging.disableAcquisition()
+			self._xrayRefresh.start()
+		else:
+			self._xrayRefresh.stop()
 		self.environment.button['X-RAY'].clicked.emit()
 		self.sidebar.linkPages('ImageProperties','xrayImageProperties')
 
+	def refreshXray(self):
+		""" Add any new image sets in an x-ray file that another process is writing to. """
+		if (self.patient.dx is None) or (not self.patient.dx.readOnly):
+			self._xrayRefresh.stop()
+			return
+		_list = self.patient.dx.refresh()
+		if len(_list) > 0:
+			self.sbImaging.addImageSet(_list)
+
 	def createWorkEnvironmentXray(self):
 		# Create the base widgets for x-rays.
 		logging.debug('Creating X-RAY Work Environment')
@@ -352,6 +378,7 @@ class main(QtWidgets.QMainWindow, Ui_MainWindow):
 		"""
 		if _set == "":
 			# No valid image is selected, assume the file is empty, so reset the plot environment and return.
+			self._xrayRefine.stop()
 			self.envXray.reset()
 			# Connect the settings mask size to the plot.
 			self.sbSettings.maskSizeChanged.connect(self.envXray.setMaskSize)
@@ -360,12 +387,36 @@ class main(QtWidgets.QMainWindow, Ui_MainWindow):
 			return
 		# When the current image set is changed, get images and plot them.
 		images = self.patient.dx.getImageSet(_set)
-		# Update the sidebar comment label.
-		self.sbImaging.updateCurrentImageDetails(images[0].comment)
+		# Update the sidebar comment label (the comment stored with the image, the index only holds the start of it).
+		if len(images) > 0:
+			self.sbImaging.updateCurrentImageDetails(images[0].comment)
 		# Set the amount of images required.
 		self.envXray.loadImages(images)
 		# Toggle the ovelrays on and off to refresh them.
 		self.sidebar.widget['xrayImageProperties'].refreshOverlays()
+		# Images shown from their previews are refined once the set has been selected for a while.
+		self._xrayRefine.stop()
+		if any(image.preview is not None for image in images):
+			self._xrayImages = images
+			self._xrayRefine.start()
+
+	def refineXrayImages(self):
+		""" Replace the previews of the current x-ray images with the full images. """
+		if self._xrayImages is not None:
+			self.envXray.refineImages(self._xrayImages)
+			self._xrayImages = None
+
+	def updateLoadProgress(self,modality,n,total):
+		""" Show the progress of a patient data import in the status bar. """
+		self.statusBar.showMessage("Loading {}: {}/{}".format(modality,n,total))
+		if n == total:
+			self.statusBar.clearMessage()
+
+	def showLoadError(self,modality,error):
+		""" Show that a patient data import failed in the status bar. """
+		self.statusBar.showMessage("Could not load the {}: {}".format(modality,error))
+		if modality == 'CT':
+			self._pendingRtplan = None
 
 	def openSyncPlan(self,file):
 		""" Open Synchrotron Treatment Plan. """
@@ -375,8 +426,11 @@ class main(QtWidgets.QMainWindow, Ui_MainWindow):
 	def openCT(self,files):
 		"""Open CT modality files."""
 		logging.info('Loading CT')
-		# Load CT Dataset.
+		# Load CT Dataset, it is shown by showCT() once it has been imported.
 		self.patient.load(files,'CT')
+
+	def showCT(self):
+		""" Show a CT that has been imported. """
 		# Create new CT workspace if required.
 		if self._isCTOpen == False:
 			self.createWorkEnvironmentCT()
@@ -386,10 +440,15 @@ class main(QtWidgets.QMainWindow, Ui_MainWindow):
 		# Update the CT view.
 		self.sidebar.widget['ctImageProperties'].updateCtView.connect(self.patient.ct.calculateView)
 		self.patient.ct.newCtView.connect(self.updateCTEnv)
+		self.patient.ct.refinedCtView.connect(self.refineCTEnv)
 		# Load the CT images and get the histograms.
 		self.updateCTEnv()
 		# Force marker update for table.
 		self.envCt.set('maxMarkers',config.markers.quantity)
+		# Open an RTPLAN that was waiting for the CT.
+		if self._pendingRtplan is not None:
+			files, self._pendingRtplan = self._pendingRtplan, None
+			self.openRTP(files)
 		# Finalise import. Set open status to true and open the workspace.
 		self._isCTOpen = True
 		self.environment.button['CT'].clicked.emit()
@@ -405,6 +464,10 @@ class main(QtWidgets.QMainWindow, Ui_MainWindow):
 		histogram = self.envCt.getPlotHistogram()
 		self.sidebar.widget['ctImageProperties'].addPlotHistogramWindow(histogram)
 
+	def refineCTEnv(self):
+		# Swap the preview images for the full resolution ones.
+		self.envCt.refineImages(self.patient.ct.image)
+
 	def createWorkEnvironmentCT(self):
 		# Make a widget for plot stuff.
 		self.envCt = self.environment.addPage('CT',QsWidgets.QPlotEnvironment())
@@ -427,6 +490,10 @@ class main(QtWidgets.QMainWindow, Ui_MainWindow):
 	def openRTP(self,files):
 		"""Open CT modality files."""
 		logging.info('Loading RTPLAN')
+		if self.patient.importing():
+			# The plan is calculated on the CT that is being imported.
+			self._pendingRtplan = files
+			return
 		# Load CT Dataset.
 		self.patient.load(files,'RTPLAN')
 		# Create new CT workspace if required.
@@ -438,6 +505,8 @@ class main(QtWidgets.QMainWindow, Ui_MainWindow):
 			return
 		# Create an RTPLAN environment for every beam.
 		self.envRtplan = np.empty(len(self.patient.rtplan.beam),dtype=object)
+		# Beam images are loaded as they are calculated in the background.
+		self.patient.rtplan.beamCalculated.connect(self.loadBeamImages)
 		# Iterate through each planned beam.
 		for i in range(len(self.patient.rtplan.beam)):
 			""" CREATE WORK ENV """
@@ -453,7 +522,8 @@ class main(QtWidgets.QMainWindow, Ui_MainWindow):
 			# Signals and slots.
 			widget.toggleOverlay.connect(partial(self.envRtplan[i].toggleOverlay))
 			""" POPULATE WORK ENV """
-			self.envRtplan[i].loadImages(self.patient.rtplan.beam[i].image)
+			if self.patient.rtplan.isCalculated(i):
+				self.loadBeamImages(i)
 			# Set the mask data and isocenter data in the plots.
 			self.envRtplan[i].set('patMask',self.patient.rtplan.beam[i].mask)
 			self.envRtplan[i].set('patIso',self.patient.rtplan.getIsocenter(i))
@@ -471,6 +541,11 @@ class main(QtWidgets.QMainWindow, Ui_MainWindow):
 		self.environment.button['BEV1'].clicked.emit()
 		self.sidebar.linkPages('ImageProperties','bev1ImageProperties')
 
+	def loadBeamImages(self,index):
+		# Load the projections of a beam into its work environment.
+		if self.envRtplan[index] is not None:
+			self.envRtplan[index].loadImages(self.patient.rtplan.beam[index].image)
+
 	def updateSettings(self,mode,origin,idx=0):
 		"""Update variable based of changed data in property model (in some cases, external sources)."""
 		if (mode == 'xr') & (self._isXrayOpen):
@@ -623,6 +698,13 @@ class main(QtWidgets.QMainWindow, Ui_MainWindow):
 		# Do the alignment.
 		self.system.applyAlignment()
 
+	def closeEvent(self,event):
+		""" Finish writing the patient files before the application quits. """
+		self._xrayRefresh.stop()
+		self._xrayRefine.stop()
+		self.patient.close()
+		super().closeEvent(event)
+
 if __name__ == "__main__":
 	# QApp 
 	app = QtWidgets.QApplication(sys.argv)
@@ -631,4 +713,6 @@ if __name__ == "__main__":
 	window.show()
 	# App wide event filter.
 	app.installEventFilter(window)
+	# Finish writing the patient files however the application quits.
+	app.aboutToQuit.connect(window.patient.close)
 	sys.exit(app.exec_())
\ No newline at end of file
@@ -1,3 +1,5 @@
+import os
+
 class markers:
 	""" Marker settings for fiducials. """
 	quantity = 3
@@ -8,6 +10,86 @@ class files:
 	patientSupports = '/database/patientSupports.csv'
 	detectors = '/database/detectors.csv'
 
+class cache:
+	""" Local cache locations. """
+	directory = os.path.join(os.path.expanduser('~'),'.syncmrt')
+	# Cache decoded CT volumes and the maximum size of the cache in bytes.
+	ct = True
+	ctSize = 16*1024**3
+
+class hdf5:
+	""" Storage of x-ray image sets in patient HDF5 files. New files keep these settings (see file.hdf5.file.setStorage()). """
+	# The compression of images: 'lzf' (fast), 'gzip' (smaller but slower) or 'none'.
+	compression = 'lzf'
+	# The gzip level (0-9), low levels keep writes fast.
+	compressionLevel = 1
+	# Shuffle the bytes of the pixel values before compressing them (this improves the compression of images).
+	shuffle = True
+	# The target size of a chunk in bytes, each chunk holds whole rows of an image.
+	chunkSize = 1024**2
+	# Maximum size in bytes of the image sets kept in memory once read (the size of the images, whether they have been decoded yet or not).
+	setCache = 256*1024**2
+	# Acquired images are written by a background thread (see file.writer). The number of images that may wait to be written, acquisition waits for the writer when it is full.
+	writerQueue = 16
+	# Written images are flushed to disk at most this often (seconds), new image sets are shown once they have been flushed.
+	flushInterval = 2.0
+	# Open patient files in single writer multiple reader (SWMR) mode so other processes (e.g. a review station) can read a session while it is acquired.
+	# Files are then written in the latest HDF5 format (1.10 or later is needed to read them) and new image sets are appended to the stream datasets (see file.hdf5).
+	swmr = False
+	# The pixel type of images in the stream.
+	streamType = 'float32'
+	# How often (seconds) a file opened for reading while another process writes it is checked for new image sets.
+	refreshInterval = 2.0
+	# Each image is stored with display levels (downsampled by each factor), a histogram and its range so it can be shown without reading it all (see file.hdf5.display()).
+	displayLevels = [2,4,8,16]
+	histogramBins = 256
+	# Images are first shown from the smallest display level that is at least this many pixels along its longest side (a few tens of KB for a 1-2k detector).
+	previewSize = 96
+	# The full resolution images are shown once an image set has been selected for this long (seconds), browsing sets only reads the display levels.
+	refineDelay = 0.5
+
+class ct:
+	""" Settings for the CT importer. """
+	# Number of workers used to decode slices (0 uses all available cores, 1 decodes serially).
+	workers = 0
+	# Worker pool type, 'thread' or 'process'.
+	pool = 'thread'
+	# Precompute summed volume tables and max pyramids of a view for fast ROI projections (these use several times the memory of the volume).
+	roiTables = True
+	# Number of threads used to flatten volumes into projections (0 uses all available cores).
+	projectionWorkers = 0
+	# Maximum size in bytes of the cache of computed views (projections for a view, ROI and flattening method).
+	viewCache = 256*1024**2
+	# Volumes with more voxels than previewVoxels are downsampled (by each of previewLevels) in the background after loading.
+	# Views of these are shown from the coarsest level first and refined to full resolution once they have been calculated.
+	previewLevels = [2,4]
+	previewVoxels = 256**3
+
+class rtplan:
+	""" Settings for the RT plan importer. """
+	# Calculate the beam's eye view projections in the background (in beam order) rather than when they are first shown.
+	prefetch = True
+
+class drr:
+	""" Settings for digitally reconstructed radiographs. """
+	# Linear attenuation coefficient of water (per mm).
+	muWater = 0.02
+	# Sampling distance along each ray as a fraction of the smallest voxel dimension.
+	step = 1.0
+	# Number of rays processed at once.
+	chunkSize = 16384
+
+class gpu:
+	""" Settings for the compute backend (see tools/backend.py). """
+	# The backend: 'opencl', 'cpu' or 'auto' (OpenCL if there is a device for it, otherwise the CPU).
+	backend = 'auto'
+	# How rotated volumes are sampled: 'linear' (trilinear), 'nearest' or 'scatter' (the original kernel, this leaves holes at non right angles).
+	rotation = 'linear'
+	# The most device memory (in bytes) held for buffers and resident rotated volumes, 0 uses three quarters of the memory of the device.
+	memory = 0
+	# The size (in bytes) of the tiles that arrays too large for the device are rotated in, 0 picks it from the memory of the device. Arrays no larger than a tile are rotated whole.
+	tileSize = 0
+
 class imager:
 	""" Settings for the imager configuration. """
 	# Pixel size and isocenter specified as (row,col).
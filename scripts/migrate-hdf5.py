@@ -0,0 +1,31 @@
+import os, sys
+import argparse
+# Run from anywhere in the repository.
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from file import hdf5
+
+import logging, coloredlogs
+coloredlogs.install(fmt='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',datefmt='%H:%M:%S',level=logging.INFO)
+
+"""
+Rewrite patient HDF5 files with chunked, compressed image storage.
+Files are replaced in place once their copy is complete, the defaults come from config.hdf5.
+	python scripts/migrate-hdf5.py patient1.hdf5 patient2.hdf5 --compression gzip --level 4
+Files written before SWMR support must be migrated with --swmr before they can be shared while they are written.
+"""
+
+parser = argparse.ArgumentParser(description="Rewrite patient HDF5 files with chunked, compressed image storage.")
+parser.add_argument('files',nargs='+',help="The HDF5 files to migrate.")
+parser.add_argument('--compression',choices=['lzf','gzip','none'],default=None,help="The compression (default config.hdf5.compression).")
+parser.add_argument('--level',type=int,default=None,help="The gzip level, 0-9 (default config.hdf5.compressionLevel).")
+parser.add_argument('--no-shuffle',dest='shuffle',action='store_false',default=None,help="Do not shuffle the bytes of pixel values before compressing them.")
+parser.add_argument('--swmr',action='store_true',default=None,help="Write the file in the latest HDF5 format so it can be shared while it is written (default config.hdf5.swmr).")
+parser.add_argument('--output',default=None,help="Write the migrated file here instead of replacing it (only for a single file).")
+args = parser.parse_args()
+
+if (args.output is not None) and (len(args.files) > 1):
+	parser.error("--output can only be used with a single file.")
+
+for fp in args.files:
+	before, after = hdf5.migrate(fp,args.output,args.compression,args.level,args.shuffle,args.swmr)
+	logging.info("{}: {:.1f} MB -> {:.1f} MB".format(fp,before/1024**2,after/1024**2))
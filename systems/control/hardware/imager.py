@@ -28,8 +28,10 @@ class Imager(QtCore.QObject):
 		A synctools.hardware.detector object.
 	file : object
 		A synctools.fileHandler.hdf5.file object. Patient HDF5 file for storing x-ray images in.
+	writer : object
+		A file.writer.writer object. Writes the images to the file in the background, images are sent to it as soon as they are acquired.
 	buffer : list
-		A buffer for image frames, these later get released as a image set (1 or 2 images).
+		A buffer for image frames, these later get released as a image set (1 or 2 images). Only used when there is no writer.
 	sid : float
 		Source to Imager Distance in mm.
 	sad : float 
@@ -50,6 +52,7 @@ class Imager(QtCore.QObject):
 		self.name = None
 		# File.
 		self.file = None
+		self.writer = None
 		self.config = config
 		# Image buffer for set.
 		self.buffer = []
@@ -144,7 +147,7 @@ class Imager(QtCore.QObject):
 				'Mi':np.linalg.inv(M),
 			})
 		# Append the image and metada to to the buffer.
-		self.buffer.append((_data[0],metadata))
+		self._bufferImage(_data[0],metadata)
 		# Emit a signal saying we have acquired an image.
 		self.imageAcquired.emit(index)
 
@@ -249,22 +252,40 @@ class Imager(QtCore.QObject):
 				'Mi':np.linalg.inv(M),
 			})
 		# Append the image and metada to to the buffer.
-		self.buffer.append((image,metadata))
+		self._bufferImage(image,metadata)
 		# Clear the stitch buffer.
 		self._stitchBuffer = []
 		logging.info("Image stitched.")
 		# Emit the signal
 		self.imageAcquired.emit(index)
 
-	def setPatientDataset(self,_file):
+	def setPatientDataset(self,_file,writer=None):
+		""" Set the patient HDF5 file, images are written to it by the writer (a file.writer.writer) if there is one. """
+		if self.writer is not None:
+			self.writer.written.disconnect(self.newImageSet)
 		self.file = _file
+		self.writer = writer
+		if self.writer is not None:
+			# The GUI is told about a new set once it is on disk.
+			self.writer.written.connect(self.newImageSet)
+
+	def _bufferImage(self,image,metadata):
+		""" Send an acquired image to the writer (this waits if the writer is falling behind), or hold it in the buffer. """
+		if self.writer is not None:
+			self.writer.addImage(image,metadata)
+		else:
+			self.buffer.append((image,metadata))
 
 	def addImagesToDataset(self):
-		if self.file != None:
+		if self.writer != None:
+			# The images have already been queued, finish the set.
+			self.writer.endSet()
+			logging.debug("Finished the image set, it is being written in the background.")
+		elif self.file != None:
 			_name, _nims = self.file.addImageSet(self.buffer)
 			logging.debug("Adding {} images to set {}.".format(_nims,_name))
 			self.newImageSet.emit(_name, _nims)
 		else:
 			logging.critical("Cannot save images to dataset, no HDF5 file loaded.")
 		# Clear the buffer.
-		self.buffer = []
\ No newline at end of file
+		self.buffer = []
@@ -1,7 +1,9 @@
 from file import importer
 from file import hdf5
-from tools.opencl import gpu
+from tools import backend
 from PyQt5 import QtCore
+from functools import partial
+import threading
 import logging
 
 class Patient(QtCore.QObject):
@@ -9,6 +11,14 @@ class Patient(QtCore.QObject):
 	This holds information about the patient. Files, datasets, gpu context, imported dicom information etc.
 	"""
 	newDXfile = QtCore.pyqtSignal(str)
+	# Progress of a dataset import as (modality, n, total).
+	loadProgress = QtCore.pyqtSignal(str,int,int)
+	# A CT has been imported in the background and is now the patient's CT.
+	ctLoaded = QtCore.pyqtSignal()
+	# A dataset could not be imported as (modality, error).
+	loadFailed = QtCore.pyqtSignal(str,str)
+	# A background CT import has finished with the CT (None if it failed).
+	_ctImported = QtCore.pyqtSignal(object)
 
 	def __init__(self,name='Default'):
 		super().__init__()
@@ -18,13 +28,15 @@ class Patient(QtCore.QObject):
 		self.rtplan = None
 		# Program internals.
 		self._gpuContext = None
+		self._ctImport = None
+		self._ctImported.connect(self._setCt)
 
 	def load(self,dataset,modality):
 		""" Load Patient Data. """
 		if modality == 'DX': 
 			# Close the open one first.
 			if self.dx != None: 
-				self.dx.file.close()
+				self.dx.close()
 			# Now open the dataset.
 			self.dx = importer.sync_dx(dataset)
 			self.newDXfile.emit(dataset)
@@ -33,9 +45,15 @@ class Patient(QtCore.QObject):
 			self.rtplan = importer.csvPlan(dataset)
 			
 		elif modality == 'CT': 
-			# Create a GPU context for the ct array.
-			self._gpuContext = gpu()
-			self.ct = importer.ct(dataset,self._gpuContext)
+			# Create a compute backend for the ct array, it is reused for every CT (the new CT replaces the array on the device).
+			if self._gpuContext is None:
+				self._gpuContext = backend.create()
+			# The CT is imported on a background thread so the GUI keeps running, it replaces the current CT once it is complete (see ctLoaded).
+			if self.importing():
+				logging.warning("A CT is already being imported.")
+				return
+			self._ctImport = threading.Thread(target=self._importCt,args=(dataset,),name='ct import',daemon=True)
+			self._ctImport.start()
 			
 		elif modality == 'RTPLAN': 
 			if self.ct != None: 
@@ -54,10 +72,43 @@ class Patient(QtCore.QObject):
 			error.setText("Could not find an importer option for files of type {}.".format(modality))
 			error.exec()
 
+	def importing(self):
+		""" Whether a CT is being imported in the background. """
+		return self._ctImport is not None
+
+	def _importCt(self,dataset):
+		""" Import a CT (on the import thread), the progress is reported with loadProgress. """
+		try:
+			ct = importer.ct(dataset,self._gpuContext,progress=partial(self.loadProgress.emit,'CT'))
+			if not hasattr(ct,'pixelArray'):
+				raise ValueError("There are no CT images in the dataset.")
+		except Exception as e:
+			logging.exception("Could not import the CT.")
+			self.loadFailed.emit('CT',str(e))
+			ct = None
+		else:
+			# The CT's slots (views calculated in the background) run on the GUI thread.
+			ct.moveToThread(self.thread())
+		self._ctImported.emit(ct)
+
+	def _setCt(self,ct):
+		""" Make an imported CT the patient's CT (on the GUI thread). """
+		self._ctImport = None
+		if ct is None:
+			return
+		self.ct = ct
+		self.ctLoaded.emit()
+
 	def new(self,fp,modality):
 		""" Create a new HDF5 file for x-ray data. """
 		if modality == 'DX':
 			if self.dx != None:
-				self.dx.file.close()
+				self.dx.close()
 			self.dx = importer.sync_dx(fp,new=True)
 			self.newDXfile.emit(fp)
+
+	def close(self):
+		""" Close the patient files, any acquired images that are still being written are written and flushed first. """
+		if self.dx != None:
+			self.dx.close()
+			self.dx = None
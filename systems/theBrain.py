@@ -33,7 +33,7 @@ class Brain(QtCore.QObject):
 
 	def setLocalXrayFile(self,file):
 		""" Link the patient datafile to the imager. """
-		self.imager.file = self.patient.dx.file
+		self.imager.setPatientDataset(self.patient.dx.file,self.patient.dx.writer)
 
 	def setStage(self,name):
 		self.patientSupport.load(name)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from scipy.spatial.transform import Rotation
+from resources import config
+from tools.cpu import cpu
+
+'''
+The CPU backend against the OpenCL backend, skipped without an OpenCL device.
+'''
+
+cl = pytest.importorskip('pyopencl')
+
+# Right angle and oblique rotations (xyz euler angles in degrees).
+angles = [(0,0,0),(0,0,90),(0,0,45),(10,25,-40),(45,45,45)]
+
+@pytest.fixture(scope='module')
+def backends():
+	from tools.opencl import gpu
+	try:
+		device = gpu()
+	except (RuntimeError,cl.Error) as e:
+		pytest.skip("No OpenCL device: {}".format(e))
+	array = np.random.default_rng(0).integers(-1000,3000,(61,52,47)).astype(np.int16)
+	host = cpu()
+	device.loadData(array)
+	host.loadData(array)
+	return device, host
+
+@pytest.mark.parametrize('angle',angles)
+def test_nearest(backends,angle):
+	device, host = backends
+	R = Rotation.from_euler('xyz',angle,degrees=True).as_matrix()
+	assert np.array_equal(device.rotate(R,'nearest'),host.rotate(R,'nearest'))
+
+@pytest.mark.parametrize('angle',angles)
+def test_nearestTiles(backends,angle,monkeypatch):
+	device, host = backends
+	R = Rotation.from_euler('xyz',angle,degrees=True).as_matrix()
+	# Tiles of a few rows.
+	monkeypatch.setattr(config.gpu,'tileSize',64*1024)
+	assert np.array_equal(device.rotate(R,'nearest'),host.rotate(R,'nearest'))
+
+@pytest.mark.parametrize('angle',angles)
+def test_linear(backends,angle):
+	device, host = backends
+	R = Rotation.from_euler('xyz',angle,degrees=True).as_matrix()
+	assert np.abs(device.rotate(R,'linear').astype(np.int64)-host.rotate(R,'linear')).max() <= 1
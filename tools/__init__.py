@@ -1,2 +1,2 @@
 # tools __init__.py
-from . import opencl
\ No newline at end of file
+from . import backend
\ No newline at end of file
@@ -0,0 +1,99 @@
+import numpy as np
+from resources import config
+import logging
+
+'''
+Compute backends for rotating and flattening volumes.
+	Every backend holds one (loaded) volume and has the same interface:
+		loadData: Copy a volume to the backend.
+		rotate: Rotate the volume and return it.
+		rotatedShape: The shape of the volume after a rotation.
+		project: Rotate the volume and flatten it along some axes.
+		rotateBatch: As project, for a number of rotations.
+		copy: Return the volume (as int32).
+	There are two implementations:
+		opencl: tools.opencl.gpu, runs on an OpenCL device (requires pyopencl).
+		cpu: tools.cpu.cpu, NumPy/SciPy on the host.
+	Use create() to get the backend chosen by config.gpu.backend.
+'''
+
+# OpenCL Coordinate System w.r.t WCS.
+OCS = np.array([[0,-1,0],[-1,0,0],[0,0,-1]])
+
+def create(name=None):
+	"""
+	Create a compute backend.
+
+	Parameters
+	----------
+	name : str
+		'opencl', 'cpu' or 'auto' (OpenCL if a device is available, otherwise the CPU), defaults to config.gpu.backend.
+	"""
+	if name is None:
+		name = config.gpu.backend
+	if name in ('auto','opencl'):
+		try:
+			from tools.opencl import gpu
+			return gpu()
+		except Exception as e:
+			# A missing pyopencl, no platforms or no devices all leave us without OpenCL.
+			if name == 'opencl':
+				raise
+			logging.warning("OpenCL is not available ({}), using the CPU for computation.".format(e))
+	if name in ('auto','cpu'):
+		from tools.cpu import cpu
+		return cpu()
+	raise ValueError("Unknown compute backend {}.".format(name))
+
+class backend:
+	""" The parts of a compute backend that do not depend on where the work is done. """
+	# Maximum number of bytes staged on the host when copying data to the backend.
+	chunkSize = 64*1024**2
+
+	def rotatedShape(self,rotationMatrix):
+		""" The shape of the loaded array after a rotation (as for rotate()). """
+		return self._outputShape(self.arrayRotation(rotationMatrix))
+
+	def _outputShape(self,gpuRotationMatrix):
+		""" The shape of the array that holds the input array after it has been rotated (by a rotation in the OCL CS). """
+		# Create a basic box for calculations of a cube. Built off (row,cols,depth).
+		basicBox = np.array([
+			[0,0,0],
+			[1,0,0],
+			[0,1,0],
+			[1,1,0],
+			[0,0,1],
+			[1,0,1],
+			[0,1,1],
+			[1,1,1]
+		])
+		# Input array shape
+		inputShape =  basicBox*self._inputBufferShape
+		# Output array shape after rotation.
+		outputShape = np.empty((8,3),dtype=float)
+		for i in range(8):
+			outputShape[i,:] = gpuRotationMatrix@inputShape[i,:]
+		mins = np.absolute(np.amin(outputShape,axis=0))
+		maxs = np.absolute(np.amax(outputShape,axis=0))
+		return tuple(np.rint(mins+maxs).astype(int))
+
+	def project(self,rotationMatrix,method='sum',axes=(2,1),box=None,mode=None):
+		""" Rotate the loaded array and flatten it along each of the axes, see rotateBatch(). """
+		return self.rotateBatch([rotationMatrix],method,axes,box,mode)[0]
+
+	@staticmethod
+	def arrayRotation(rotationMatrix):
+		""" Put a rotation matrix in the context of the OCL CS, then take it back into the frame of reference of the origin RCS. This is the rotation applied to the array indices. """
+		return (OCS@rotationMatrix)@np.linalg.inv(OCS)
+
+	@staticmethod
+	def _box(shape,box=None):
+		""" The (start,stop) of a box (three slices, the whole array if None) of an array. """
+		if box is None:
+			box = (slice(None),)*3
+		start = [0,0,0]
+		stop = [0,0,0]
+		for i in range(3):
+			start[i], stop[i], _ = box[i].indices(shape[i])
+			stop[i] = max(start[i],stop[i])
+		return start, stop
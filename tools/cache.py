@@ -0,0 +1,82 @@
+from collections import OrderedDict
+import threading
+import numpy as np
+
+'''
+A memory bounded least recently used cache.
+	Values are stored against a hashable key. The size of each value is
+	the total number of bytes of the numpy arrays it holds, when the
+	cache grows past its limit the least recently used values are evicted.
+	Hits and misses are counted for reporting.
+'''
+
+def nbytes(value):
+	""" The number of bytes of the numpy arrays held in a value (arrays, lists, tuples, dicts and the attributes of objects are searched). """
+	if isinstance(value,np.ndarray):
+		return value.nbytes
+	elif isinstance(value,dict):
+		return sum(nbytes(v) for v in value.values())
+	elif isinstance(value,(list,tuple)):
+		return sum(nbytes(v) for v in value)
+	elif hasattr(value,'nbytes'):
+		# Array like objects (e.g. file.image.lazyArray).
+		return int(value.nbytes)
+	elif hasattr(value,'__dict__'):
+		return nbytes(vars(value))
+	else:
+		return 0
+
+class lru:
+	def __init__(self,maxBytes):
+		""" A cache that holds at most maxBytes of arrays. """
+		self.maxBytes = maxBytes
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+		self.nbytes = 0
+		self.hits = 0
+		self.misses = 0
+
+	def get(self,key,default=None):
+		""" Get a value and mark it as recently used. """
+		with self._lock:
+			if key not in self._entries:
+				self.misses += 1
+				return default
+			self.hits += 1
+			self._entries.move_to_end(key)
+			return self._entries[key][0]
+
+	def put(self,key,value):
+		""" Add a value to the cache. Values larger than the cache are not stored. """
+		size = nbytes(value)
+		with self._lock:
+			if key in self._entries:
+				self.nbytes -= self._entries.pop(key)[1]
+			if size > self.maxBytes:
+				return
+			self._entries[key] = (value,size)
+			self.nbytes += size
+			while self.nbytes > self.maxBytes:
+				_, (_, _size) = self._entries.popitem(last=False)
+				self.nbytes -= _size
+
+	def invalidate(self,match=None):
+		""" Remove all values, or only those whose key satisfies match(key). """
+		with self._lock:
+			if match is None:
+				self._entries.clear()
+				self.nbytes = 0
+				return
+			for key in [key for key in self._entries if match(key)]:
+				self.nbytes -= self._entries.pop(key)[1]
+
+	def stats(self):
+		""" Report the usage of the cache. """
+		with self._lock:
+			return {'entries':len(self._entries),'nbytes':self.nbytes,'maxBytes':self.maxBytes,'hits':self.hits,'misses':self.misses}
+
+	def __contains__(self,key):
+		return key in self._entries
+
+	def __len__(self):
+		return len(self._entries)
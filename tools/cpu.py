@@ -0,0 +1,185 @@
+import numpy as np
+import threading
+from scipy import ndimage
+from tools import projection
+from tools.backend import backend
+from resources import config
+import logging
+
+'''
+A NumPy/SciPy compute backend, used when there is no OpenCL device.
+It has the same interface as tools.opencl.gpu:
+	rotations are calculated in the OCL CS about the centre of the array,
+	the gather modes map every output voxel back into the input (nearest
+	in float32 as the gatherNearest kernel does, linear with
+	scipy.ndimage.affine_transform) and the scatter mode pushes every input
+	voxel to its nearest output voxel as the rotate3d kernel does.
+	Projections run on the projection thread pool.
+Nearest gathers give exactly the same results as the OpenCL kernels at any
+angle. Linear gathers can differ by 1 in some voxels (rounding of the
+interpolation), scatter rotations at oblique angles can differ where
+several input voxels land on the same output voxel (the device keeps
+whichever write lands last).
+'''
+
+class cpu(backend):
+	def __init__(self):
+		# Some class members.
+		self.pixelSize = None
+		self.isocenter = None
+		self.extent = None
+		self.zeroExtent = False
+		self._inputBuffer = None
+		self._inputBufferShape = None
+		self._outputBuffer = None
+		self._outputBufferShape = None
+		self._fill = -1000
+		# The loaded array is shared, work submitted from different threads is serialised.
+		self._lock = threading.RLock()
+		logging.info('Using the CPU for computation.')
+
+	def loadData(self,data,extent=None,fill=-1000):
+		"""
+		Load an array.
+		The array is converted to int32 one chunk at a time, so no more than the int32 copy is held.
+		The fill value is used for any voxels outside of the array after it has been rotated.
+		"""
+		data = np.asarray(data)
+		with self._lock:
+			self._inputBufferShape = np.shape(data)
+			self._inputBuffer = np.empty(self._inputBufferShape,dtype=np.int32)
+			rowBytes = int(np.prod(self._inputBufferShape[1:]))*np.dtype(np.int32).itemsize
+			step = max(1,self.chunkSize//max(1,rowBytes))
+			for i in range(0,self._inputBufferShape[0],step):
+				self._inputBuffer[i:i+step] = data[i:i+step]
+			self._fill = fill
+			# If an extent for the array is specified, save that too.
+			if (type(extent) != type(None)) & (len(np.array(extent).shape) == 6):
+				self._inputExtent = extent
+			self._outputBuffer = None
+			self._outputBufferShape = None
+
+	def memoryUsage(self):
+		""" Report the memory held by the backend in bytes (as for gpu.memoryUsage()), this is only the loaded array. """
+		with self._lock:
+			nbytes = 0 if self._inputBuffer is None else self._inputBuffer.nbytes
+			return {'budget':0,'allocated':nbytes,'inUse':nbytes,'resident':0,'free':0,'hits':0,'misses':0,'evictions':0}
+
+	def getData(self):
+		""" Should return the last calculated output. """
+		if type(self._outputBuffer) is type(None):
+			return
+		else:
+			return np.array(self._outputBuffer)
+
+	def rotate(self,rotationMatrix,mode=None):
+		"""
+		Rotate the loaded array, see gpu.rotate().
+		This may be called from any thread.
+		"""
+		with self._lock:
+			gpuRotationMatrix = self.arrayRotation(rotationMatrix)
+			outputShape = self._outputShape(gpuRotationMatrix)
+			self._outputBuffer = self._rotate(gpuRotationMatrix,outputShape,mode)
+			self._outputBufferShape = outputShape
+			return np.array(self._outputBuffer)
+
+	def _rotate(self,gpuRotationMatrix,outputShape,mode=None):
+		""" Rotate the input array (by a rotation in the OCL CS) into a new int32 array of the output shape. """
+		if mode is None:
+			mode = config.gpu.rotation
+		if mode == 'scatter':
+			return self._scatter(gpuRotationMatrix,outputShape)
+		elif mode == 'nearest':
+			return self._gatherNearest(gpuRotationMatrix,outputShape)
+		elif mode == 'linear':
+			# An output index o samples the input at inverse@(o - outputCentre) + inputCentre.
+			inverse = np.linalg.inv(gpuRotationMatrix)
+			inputCentre = (np.array(self._inputBufferShape)-1)/2
+			outputCentre = (np.array(outputShape)-1)/2
+			offset = inputCentre - inverse@outputCentre
+			# Samples beside the array are interpolated with the fill value, as in the kernel.
+			return ndimage.affine_transform(self._inputBuffer,inverse,offset=offset,output_shape=outputShape,output=np.int32,order=1,mode='grid-constant',cval=self._fill)
+		else:
+			raise ValueError("Unknown rotation mode {}.".format(mode))
+
+	def _gatherNearest(self,gpuRotationMatrix,outputShape):
+		""" Sample the input at the nearest voxel to each output voxel mapped back into it, in float32 and in the same order as the gatherNearest kernel, one chunk of rows at a time. """
+		output = np.empty(outputShape,dtype=np.int32)
+		shape = np.array(self._inputBufferShape)
+		inverse = np.linalg.inv(gpuRotationMatrix).astype(np.float32)
+		inputCentre = ((shape-1)/2).astype(np.float32)
+		outputCentre = ((np.array(outputShape)-1)/2).astype(np.float32)
+		j = np.arange(outputShape[1],dtype=np.float32)[:,None] - outputCentre[1]
+		k = np.arange(outputShape[2],dtype=np.float32)[None,:] - outputCentre[2]
+		rowBytes = int(np.prod(outputShape[1:]))*32
+		step = max(1,self.chunkSize//max(1,rowBytes))
+		for start in range(0,outputShape[0],step):
+			i = np.arange(start,min(start+step,outputShape[0]),dtype=np.float32)[:,None,None] - outputCentre[0]
+			# The position in the input, rounded half up (floor(p+0.5)) as in the kernel.
+			index = [np.floor(i*inverse[n,0] + j*inverse[n,1] + k*inverse[n,2] + inputCentre[n] + np.float32(0.5)).astype(np.int64) for n in range(3)]
+			inside = (index[0] >= 0) & (index[0] < shape[0]) & (index[1] >= 0) & (index[1] < shape[1]) & (index[2] >= 0) & (index[2] < shape[2])
+			for n in range(3):
+				np.clip(index[n],0,shape[n]-1,out=index[n])
+			output[start:start+len(i)] = np.where(inside,self._inputBuffer[tuple(index)],self._fill)
+		return output
+
+	def _scatter(self,gpuRotationMatrix,outputShape):
+		""" Write each input voxel to the nearest output voxel (as the rotate3d kernel), one chunk of rows at a time. """
+		output = np.full(outputShape,self._fill,dtype=np.int32)
+		flat = output.reshape(-1)
+		shape = np.array(self._inputBufferShape)
+		# The kernel centres the arrays with integer division.
+		inputOrigin = (shape-1)//2
+		outputOrigin = (np.array(outputShape)-1)//2
+		M = gpuRotationMatrix.astype(np.float32)
+		rowBytes = int(np.prod(shape[1:]))*16
+		step = max(1,self.chunkSize//max(1,rowBytes))
+		for i in range(0,shape[0],step):
+			index = np.indices((min(step,shape[0]-i),shape[1],shape[2]),dtype=np.float32).reshape(3,-1)
+			index[0] += i
+			point = M@(index-inputOrigin[:,None].astype(np.float32))
+			point = np.trunc(point + 0.5 + outputOrigin[:,None]).astype(np.int64)
+			idx = point[2] + outputShape[2]*(point[1] + outputShape[1]*point[0])
+			# Points beyond the end of the array go to the last voxel (as in the kernel).
+			np.clip(idx,0,flat.size-1,out=idx)
+			flat[idx] = self._inputBuffer[i:i+step].reshape(-1)
+		return output
+
+	def rotateBatch(self,rotationMatrices,method='sum',axes=(2,1),box=None,mode=None):
+		"""
+		Rotate the loaded array by a number of rotations and flatten each rotated array, see gpu.rotateBatch().
+		This may be called from any thread.
+		"""
+		with self._lock:
+			results = []
+			for R in rotationMatrices:
+				M = self.arrayRotation(R)
+				shape = self._outputShape(M)
+				volume = self._rotate(M,shape,mode)
+				start, stop = self._box(shape,box)
+				volume = volume[tuple(slice(a,b) for a,b in zip(start,stop))]
+				pose = []
+				for axis in axes:
+					pose.append(self._flatten(volume,axis,method))
+				results.append(pose)
+			return results
+
+	def _flatten(self,volume,axis,method):
+		""" Flatten a volume along an axis, with the output types of the device projections. """
+		if method == 'max':
+			if volume.shape[axis] == 0:
+				return np.full([n for i,n in enumerate(volume.shape) if i != axis],np.iinfo(np.int32).min,dtype=np.int32)
+			return projection.flatten(volume,axis,'max',config.ct.projectionWorkers)
+		total = projection.flatten(volume,axis,'sum',config.ct.projectionWorkers)
+		if method == 'sum':
+			return total
+		elif method == 'mean':
+			return (total/volume.shape[axis]).astype(np.float32)
+		else:
+			raise ValueError("Unknown flattening method {}.".format(method))
+
+	def copy(self):
+		""" Return a copy of the loaded array. """
+		with self._lock:
+			return np.array(self._inputBuffer)
@@ -0,0 +1,173 @@
+import numpy as np
+from tools import projection
+from resources import config
+
+'''
+Digitally reconstructed radiographs (DRRs).
+	Rays are cast from the source through the CT to each detector pixel.
+	Samples are taken at a fixed step along each ray (only over the part
+	of the ray that passes through the volume), converted from stored CT
+	values to linear attenuation coefficients with a lookup table and
+	summed into the line integral of attenuation for the pixel. Rays are
+	processed in chunks, each chunk is fully vectorized and the chunks
+	run on the projection thread pool.
+
+	The imager frame of reference is a RH-CS where +x propagates down the
+	beamline, +y runs across the detector and +z is up. Its origin is the
+	isocenter. Two geometries are supported:
+		parallel: All rays run along +x (a synchrotron beam).
+		divergent: Rays leave a point source at (-sad,0,0) and end on a
+			detector plane at x = sid-sad.
+'''
+
+def attenuationTable(vmin,vmax,slope,intercept,muWater=None):
+	"""
+	A lookup table of the linear attenuation coefficient (per mm) for every stored value in [vmin,vmax].
+	Attenuation is scaled from water by the Hounsfield Unit, mu = muWater*(1+HU/1000), with nothing less attenuating than vacuum.
+	"""
+	if muWater is None:
+		muWater = config.drr.muWater
+	hu = slope*np.arange(vmin,vmax+1,dtype=np.float64) + intercept
+	return np.clip(muWater*(1+hu/1000),0,None).astype(np.float32)
+
+class drr:
+	def __init__(self,array,M,slope=1,intercept=0,muWater=None):
+		"""
+		A DRR generator for a CT volume.
+
+		Parameters
+		----------
+		array : ndarray
+			The CT volume of (integer) stored values.
+		M : ndarray
+			A 4x4 matrix that takes an array index (i,j,k,1) to a position (mm) in the patient.
+		slope, intercept : float
+			The rescale from stored values to Hounsfield Units.
+		muWater : float
+			The linear attenuation coefficient of water (per mm), defaults to config.drr.muWater.
+		"""
+		self.array = array
+		# A flat view of the volume for indexing.
+		self.flat = np.ascontiguousarray(array).reshape(-1)
+		self.M = np.asarray(M,dtype=float)
+		self.Mi = np.linalg.inv(self.M)
+		self.voxelSize = np.linalg.norm(self.M[:3,:3],axis=0)
+		# The lookup table is indexed by the stored value less the minimum value in the volume.
+		self.vmin = int(np.amin(array))
+		self.vmax = int(np.amax(array))
+		self.table = attenuationTable(self.vmin,self.vmax,slope,intercept,muWater)
+
+	def project(self,R,shape,pixelSize,isocenter,geometry='parallel',sad=None,sid=None,step=None):
+		"""
+		Calculate a DRR.
+
+		Parameters
+		----------
+		R : ndarray
+			The 3x3 rotation that takes the imager frame into the patient frame (the pose of the patient relative to the imager).
+		shape : tuple
+			The (rows,columns) of the detector.
+		pixelSize : tuple
+			The (row,column) pixel size in mm on the detector.
+		isocenter : ndarray
+			The isocenter in the patient frame (mm).
+		geometry : str
+			'parallel' or 'divergent'.
+		sad, sid : float
+			Source to axis and source to imager distances in mm for a divergent beam, defaults to config.imager (in metres).
+		step : float
+			The sampling distance along a ray in mm, defaults to config.drr.step of the smallest voxel dimension.
+
+		Returns
+		-------
+		ndarray
+			The line integral of attenuation for each detector pixel, float32 of the detector shape. Row 0 is the top of the detector.
+		"""
+		R = np.asarray(R,dtype=float)
+		isocenter = np.asarray(isocenter,dtype=float)
+		if step is None:
+			step = config.drr.step*np.amin(self.voxelSize)
+		rows, cols = shape
+		# Detector pixel centres in the imager frame.
+		y = (np.arange(cols)-(cols-1)/2)*pixelSize[1]
+		z = ((rows-1)/2-np.arange(rows))*pixelSize[0]
+		y, z = np.meshgrid(y,z)
+		if geometry == 'parallel':
+			# Rays start on the plane through the isocenter, they are extended backwards to cover the whole volume.
+			start = np.stack([np.zeros(y.size),y.ravel(),z.ravel()],axis=1)
+			direction = np.tile([1.0,0.0,0.0],(y.size,1))
+		elif geometry == 'divergent':
+			if sad is None: sad = config.imager.sad*1000
+			if sid is None: sid = config.imager.sid*1000
+			start = np.tile([-sad,0.0,0.0],(y.size,1))
+			end = np.stack([np.full(y.size,sid-sad),y.ravel(),z.ravel()],axis=1)
+			direction = end-start
+			direction /= np.linalg.norm(direction,axis=1)[:,None]
+		else:
+			raise ValueError("Unknown DRR geometry {}.".format(geometry))
+		# Rays in array index space, a unit step in t is 1 mm.
+		A = self.Mi[:3,:3]@R
+		origin = (start@A.T) + (self.Mi[:3,:3]@isocenter + self.Mi[:3,3])
+		direction = direction@A.T
+		tmin, tmax = self._clip(origin,direction)
+		if geometry == 'divergent':
+			# Rays start at the source and stop at the detector.
+			tmin = np.maximum(tmin,0)
+			tmax = np.minimum(tmax,np.linalg.norm(end-start,axis=1))
+		# Split the rays into chunks of config.drr.chunkSize rays.
+		n = config.drr.chunkSize
+		chunks = [(origin[i:i+n],direction[i:i+n],tmin[i:i+n],tmax[i:i+n]) for i in range(0,len(origin),n)]
+		result = np.concatenate(projection.run(lambda chunk: self._integrate(*chunk,step),chunks,config.ct.projectionWorkers))
+		return result.reshape(shape)
+
+	def _clip(self,origin,direction):
+		""" The range of t over which each ray (origin + t*direction) is inside the volume. """
+		lower = np.full(3,-0.5)
+		upper = np.array(self.array.shape)-0.5
+		with np.errstate(divide='ignore',invalid='ignore'):
+			t1 = (lower-origin)/direction
+			t2 = (upper-origin)/direction
+		# Rays parallel to an axis are either always or never inside the slab of that axis.
+		inside = (origin >= lower) & (origin <= upper)
+		parallel = direction == 0
+		t1 = np.where(parallel,np.where(inside,-np.inf,np.inf),t1)
+		t2 = np.where(parallel,np.where(inside,np.inf,-np.inf),t2)
+		tmin = np.amax(np.minimum(t1,t2),axis=1)
+		tmax = np.amin(np.maximum(t1,t2),axis=1)
+		return tmin, tmax
+
+	def _integrate(self,origin,direction,tmin,tmax,step):
+		""" Sum the attenuation along a chunk of rays (nearest neighbour sampling). Each iteration takes one sample from every ray. """
+		result = np.zeros(len(origin),dtype=np.float32)
+		hit = tmax > tmin
+		if not np.any(hit):
+			return result
+		# Work on each axis separately in single precision.
+		origin = np.ascontiguousarray(origin.T,dtype=np.float32)
+		direction = np.ascontiguousarray(direction.T,dtype=np.float32)
+		tmin = tmin.astype(np.float32)
+		tmax = tmax.astype(np.float32)
+		shape = self.array.shape
+		strides = (shape[1]*shape[2],shape[2],1)
+		position = np.empty(len(result),dtype=np.float32)
+		flat = np.empty(len(result),dtype=np.intp)
+		valid = np.empty(len(result),dtype=bool)
+		start = np.amin(tmin[hit])
+		for k in range(int(np.ceil((np.amax(tmax[hit])-start)/step))):
+			t = np.float32(start + (k+0.5)*step)
+			# Samples outside of the ray add nothing.
+			np.greater_equal(t,tmin,out=valid)
+			valid &= (t <= tmax)
+			flat[:] = 0
+			for axis in range(3):
+				np.multiply(direction[axis],t,out=position)
+				position += origin[axis]
+				np.rint(position,out=position)
+				# Nor do samples outside of the volume.
+				valid &= (position >= 0) & (position < shape[axis])
+				flat += position.astype(np.intp)*strides[axis]
+			values = np.take(self.flat,flat,mode='clip')
+			mu = np.take(self.table,values.astype(np.intp)-self.vmin,mode='clip')
+			mu[~valid] = 0
+			result += mu
+		return result*step
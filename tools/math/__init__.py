@@ -1,2 +1,2 @@
-from . import dependencies, math, quaternion, rotations, transform
+from . import dependencies, math, permutation, quaternion, resample, rotations, transform
 from .wcs2wcs import wcs2wcs
\ No newline at end of file
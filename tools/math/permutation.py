@@ -0,0 +1,35 @@
+import numpy as np
+
+'''
+Rotations that are signed permutations of the axes (any multiple of 90
+	degrees about the principal axes) can be applied to an array without
+	any interpolation by reordering and flipping its axes. Numpy does this
+	with strided views, so no data is copied.
+'''
+
+def signedPermutation(matrix,tolerance=1e-6):
+	''' Return `matrix` as an integer signed permutation matrix if it is one (within a tolerance), otherwise return None. '''
+	matrix = np.asarray(matrix,dtype=float)
+	P = np.rint(matrix)
+	if not np.allclose(matrix,P,atol=tolerance):
+		return None
+	P = P.astype(int)
+	# Exactly one +/-1 in every row and column.
+	if np.all(np.sum(np.absolute(P),axis=0) == 1) & np.all(np.sum(np.absolute(P),axis=1) == 1):
+		return P
+	else:
+		return None
+
+def permute(array,P):
+	'''
+	Rotate an array about its centre by a signed permutation matrix, P.
+	The output satisfies out[P@(i-c)+c'] = array[i] where c and c' are the centres of the input and output arrays.
+	Returns a view of the array.
+	'''
+	# Output axis a takes input axis b where P[a,b] = +/-1.
+	axes = np.argmax(np.absolute(P),axis=1)
+	signs = P[np.arange(3),axes]
+	view = np.transpose(array,axes)
+	for axis in np.where(signs < 0)[0]:
+		view = np.flip(view,axis)
+	return view
@@ -0,0 +1,45 @@
+import numpy as np
+
+'''
+Block downsampling of volumes.
+	Each output voxel is the mean of a factor^3 block of input voxels.
+	Blocks at the edges of a volume whose shape is not a multiple of the
+	factor are averaged over the voxels they contain. The volume is
+	processed a slab of planes at a time so only a slab is ever converted
+	to floating point.
+'''
+
+def downsample(array,factor):
+	"""
+	Downsample a 3D array by an integer factor in every axis.
+
+	Parameters
+	----------
+	array : ndarray
+		The 3D volume.
+	factor : int
+		The size of the blocks to average.
+
+	Returns
+	-------
+	ndarray
+		The downsampled volume, of shape ceil(array.shape/factor) and the same type as the input (integer types are rounded).
+	"""
+	shape = tuple(-(-n//factor) for n in array.shape)
+	result = np.zeros(shape,dtype=array.dtype)
+	# Pad the first two axes to a multiple of the factor.
+	padded = (shape[0]*factor,shape[1]*factor)
+	# The number of input voxels in each block of the first two axes.
+	counts = np.zeros(padded,dtype=np.float32)
+	counts[:array.shape[0],:array.shape[1]] = 1
+	counts = counts.reshape(shape[0],factor,shape[1],factor).sum(axis=(1,3))
+	for k in range(shape[2]):
+		slab = array[:,:,k*factor:(k+1)*factor]
+		plane = np.zeros(padded,dtype=np.float32)
+		plane[:array.shape[0],:array.shape[1]] = np.sum(slab,axis=2,dtype=np.float32)
+		plane = plane.reshape(shape[0],factor,shape[1],factor).sum(axis=(1,3))
+		plane /= counts*slab.shape[2]
+		if np.issubdtype(array.dtype,np.integer):
+			np.rint(plane,out=plane)
+		result[:,:,k] = plane
+	return result
@@ -0,0 +1,102 @@
+import pyopencl as cl
+import hashlib
+import threading
+import inspect, os
+from resources import config
+import logging
+
+'''
+A process wide OpenCL context.
+	Devices are discovered and the context is created once, on first use.
+	Programs are built once per device. The compiled binaries are saved
+	in the cache directory keyed by the device (name, vendor, driver and
+	platform versions) and a hash of the kernel source, so a warm start
+	loads the binary instead of compiling the source.
+'''
+
+_context = None
+_lock = threading.Lock()
+
+def get():
+	""" Get the shared compute context, it is created on first use. """
+	global _context
+	with _lock:
+		if _context is None:
+			_context = context()
+		return _context
+
+def devices():
+	""" All of the OpenCL devices, on every platform. """
+	return [device for plt in cl.get_platforms() for device in plt.get_devices()]
+
+def _chooseDevice():
+	""" Choose a device for computation, a GPU if there is one otherwise a CPU. """
+	platforms = cl.get_platforms()
+	cpuList = []
+	gpuList = []
+	for plt in platforms:
+		cpuList += plt.get_devices(cl.device_type.CPU)
+		gpuList += plt.get_devices(cl.device_type.GPU)
+	if len(gpuList) > 0:
+		return gpuList[-1]
+	elif len(cpuList) > 0:
+		return cpuList[0]
+	else:
+		raise RuntimeError("No OpenCL devices were found.")
+
+class context:
+	def __init__(self,device=None):
+		""" Create a context (and a queue) on a device, by default the one chosen by _chooseDevice(). """
+		self.device = device if device is not None else _chooseDevice()
+		self.ctx = cl.Context(devices=[self.device])
+		self.queue = cl.CommandQueue(self.ctx)
+		logging.info('Using '+ str(self.device) +' for computation.')
+		self._programs = {}
+		self._lock = threading.Lock()
+
+	def deviceKey(self):
+		""" A string identifying the device and driver that binaries are compiled for. """
+		d = self.device
+		return '|'.join([d.name,d.vendor,d.version,d.driver_version,d.platform.name,d.platform.version])
+
+	def program(self,name):
+		""" Get the built program for ./kernels/<name>.cl. """
+		with self._lock:
+			if name not in self._programs:
+				fp = os.path.join(os.path.dirname(inspect.getfile(context)),'kernels',name+'.cl')
+				with open(fp,'r') as f:
+					source = f.read()
+				self._programs[name] = self._build(name,source)
+			return self._programs[name]
+
+	def _binaryFile(self,source):
+		""" The location of the cached binary for a kernel source on this device. """
+		h = hashlib.sha1()
+		h.update(self.deviceKey().encode())
+		h.update(cl.VERSION_TEXT.encode())
+		h.update(source.encode())
+		return os.path.join(config.cache.directory,'opencl',h.hexdigest()+'.bin')
+
+	def _build(self,name,source):
+		""" Build a program, loading it from the binary cache if possible. """
+		fn = self._binaryFile(source)
+		try:
+			with open(fn,'rb') as f:
+				binary = f.read()
+			program = cl.Program(self.ctx,[self.device],[binary]).build()
+			logging.debug("Loaded the {} program from the cache.".format(name))
+			return program
+		except (OSError,cl.Error) as e:
+			if not isinstance(e,FileNotFoundError):
+				logging.debug("Could not load the cached {} program: {}".format(name,e))
+		program = cl.Program(self.ctx,source).build()
+		try:
+			binary = program.get_info(cl.program_info.BINARIES)[0]
+			os.makedirs(os.path.dirname(fn),exist_ok=True)
+			# Write to a temporary file first so an interrupted write never leaves a corrupt binary.
+			with open(fn+'.tmp','wb') as f:
+				f.write(binary)
+			os.replace(fn+'.tmp',fn)
+		except (OSError,cl.Error) as e:
+			logging.warning("Could not save the {} program to the cache: {}".format(name,e))
+		return program
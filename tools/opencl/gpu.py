@@ -1,7 +1,10 @@
 import pyopencl as cl
+import pyopencl.cltypes
 import numpy as np
-import inspect, os
-from tools.math import wcs2wcs
+import threading
+from tools.opencl import context, pool
+from tools.backend import backend
+from resources import config
 import logging
 
 '''
@@ -15,12 +18,12 @@ Workflow is:
 	4. Recieve an output
 '''
 
-class gpu:
-	def __init__(self):
+class gpu(backend):
+	def __init__(self,device=None):
 		'''
 		1. Initialise some parameters
-		2. Find a suitable device
-		3. Create a context and queue for work to take place in
+		2. Get the shared context (see context.py), or a new one for a specific device
+		3. Create a queue for work to take place in
 		'''
 		# Some class members.
 		self.pixelSize = None
@@ -28,124 +31,392 @@ class gpu:
 		self.extent = None
 		self.zeroExtent = False
 
-		# Find avail devices.
-		platforms = cl.get_platforms()
-		cpuList = []
-		gpuList = []
-		for plt in platforms:
-			cpuList += plt.get_devices(cl.device_type.CPU)
-			gpuList += plt.get_devices(cl.device_type.GPU)
-		# Create a device context.
-		chosenDevice = None
-		for device in gpuList:
-			try:
-				# if device.vendor.contains('NVIDIA'):
-				chosenDevice = [device]  
-					# self.ctx = cl.Context(devices=[device])
-			except:
-				pass
-		if chosenDevice is None:
-			# Use the CPU if no GPU found.
-			chosenDevice = [cpuList[0]]
-		else:
-			pass
-
-		self.ctx = cl.Context(devices=chosenDevice)
-		logging.info('Using '+ str(chosenDevice) +' for computation.')
-			
+		# Use the process wide context (devices are only discovered once).
+		self.context = context.get() if device is None else context.context(device)
+		self.ctx = self.context.ctx
 		# Create a device queue.
 		self.queue = cl.CommandQueue(self.ctx)
-
-	def loadData(self,data,extent=None):
-		""" Load an array onto the GPU. """
-		array = np.array(data,order='C').astype(np.int32)
-		self._inputBuffer = cl.Buffer(self.ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=array)
-		self._inputBufferShape = np.shape(array)
-		# If an extent for the array is specified, save that too.
-		if (type(extent) != type(None)) & (len(np.array(extent).shape) == 6): 
-			self._inputExtent = extent
-		# Set an output buffer.
-		self._outputBuffer = None
+		# The queue and buffers are shared, work submitted from different threads is serialised.
+		self._lock = threading.RLock()
+		# A second queue so transfers can overlap kernels (see rotateBatch()).
+		self._transferQueue = cl.CommandQueue(self.ctx)
+		# Kernels, keyed by file and function name.
+		self._kernels = {}
+		# Device buffers are reused through a pool (see pool.py), rotated arrays stay resident in it.
+		budget = config.gpu.memory if config.gpu.memory > 0 else 3*self.context.device.global_mem_size//4
+		self._pool = pool.pool(self.ctx,budget)
+		self._inputBuffer = None
+		self._hostData = None
+		self._outputKey = None
 		self._outputBufferShape = None
+		# Small buffers (kernel parameters) that are released once the work queued with them has completed.
+		self._staged = []
+
+	def _kernel(self,name,function):
+		""" Get a kernel from ./kernels/<name>.cl, the program is built once per process. Kernels hold their arguments so they must only be used under the lock. """
+		if (name,function) not in self._kernels:
+			self._kernels[(name,function)] = cl.Kernel(self.context.program(name),function)
+		return self._kernels[(name,function)]
+
+	def loadData(self,data,extent=None,fill=-1000):
+		"""
+		Load an array onto the GPU.
+		The array is converted to int32 one chunk at a time as it is copied, so a full size int32 copy is never made on the host.
+		The fill value is used for any voxels outside of the array after it has been rotated.
+		"""
+		data = np.asarray(data)
+		with self._lock:
+			# The previous array and everything rotated from it go back to the pool.
+			self._pool.release(self._inputBuffer)
+			self._pool.evict()
+			self._inputBufferShape = np.shape(data)
+			nbytes = int(np.prod(self._inputBufferShape))*np.dtype(np.int32).itemsize
+			# The host array is kept for arrays (and rotations of them) that are streamed through the device in tiles.
+			self._hostData = data
+			if self._fits(nbytes):
+				self._inputBuffer = self._pool.allocate(nbytes)
+				# Copy the array in chunks of whole rows.
+				rowBytes = nbytes//self._inputBufferShape[0]
+				step = max(1,self.chunkSize//rowBytes)
+				for i in range(0,self._inputBufferShape[0],step):
+					chunk = np.ascontiguousarray(data[i:i+step],dtype=np.int32)
+					cl.enqueue_copy(self.queue, self._inputBuffer, chunk, device_offset=i*rowBytes)
+			else:
+				self._inputBuffer = None
+				logging.info("The array ({} MB) does not fit on the device, it will be rotated in tiles.".format(nbytes//1024**2))
+			self._fill = fill
+			# If an extent for the array is specified, save that too.
+			if (type(extent) != type(None)) & (len(np.array(extent).shape) == 6): 
+				self._inputExtent = extent
+			# Set an output buffer.
+			self._outputKey = None
+			self._outputBufferShape = None
 
 	def getData(self):
-		""" Should return the last calculated output. """
-		# Only do this if there is an outputBuffer.
-		if type(self._outputBuffer) is type(None):
-			return
-		else:
-			arrOut = np.zeros(self._outputBufferShape)
-			cl.enqueue_copy(self.queue, arrOut, self._outputBuffer)
+		""" Should return the last calculated output (None if it is no longer resident on the device). """
+		with self._lock:
+			buffer = self._pool.fetch(self._outputKey)
+			if buffer is None:
+				return
+			arrOut = np.empty(self._outputBufferShape,dtype=np.int32)
+			cl.enqueue_copy(self.queue, arrOut, buffer)
+			self._pool.store(self._outputKey,buffer)
 			return arrOut
 
-	def rotate(self,rotationMatrix):
+	def memoryUsage(self):
+		""" Report the device memory in use, see pool.report(). """
+		return self._pool.report()
+
+	def rotate(self,rotationMatrix,mode=None):
 		"""
 		Here we give the data to be copied to the GPU and give some deacriptors about the data.
 		We must enforce datatypes as we are dealing with c and memory access/copies.
 		Rotations happen about a pre-defined world coordinate system (x,y,z) axes (as according to HFS patient position in DICOM standard).
+		This may be called from any thread.
+
+		Parameters
+		----------
+		rotationMatrix : ndarray
+			The 3x3 rotation.
+		mode : str
+			How the rotated array is sampled (defaults to config.gpu.rotation):
+				scatter: Each input voxel is written to the nearest output voxel (this leaves holes at non right angles).
+				nearest: Each output voxel takes the nearest input voxel.
+				linear: Each output voxel is trilinearly interpolated from the input.
 		"""
-		# OpenCL Coordinate System w.r.t WCS.
-		OCS = np.array([[0,-1,0],[-1,0,0],[0,0,-1]])
-		# Put the rotation matrix in the context of the OCL CS, then take it back into the frame of reference of the origin RCS.
-		gpuRotationMatrix = (OCS@rotationMatrix)@np.linalg.inv(OCS)
-		# Create a basic box for calculations of a cube. Built off (row,cols,depth).
-		basicBox = np.array([
-			[0,0,0],
-			[1,0,0],
-			[0,1,0],
-			[1,1,0],
-			[0,0,1],
-			[1,0,1],
-			[0,1,1],
-			[1,1,1]
-		])
-		# Input array shape
-		inputShape =  basicBox*self._inputBufferShape
-		# Output array shape after rotation.
-		outputShape = np.empty((8,3),dtype=float)
-		for i in range(8):
-			outputShape[i,:] = gpuRotationMatrix@inputShape[i,:]
-		mins = np.absolute(np.amin(outputShape,axis=0))
-		maxs = np.absolute(np.amax(outputShape,axis=0))
-		outputShape = np.rint(mins+maxs).astype(int)
-		# Create empty output array set to -1000.
-		arrOut = np.zeros(outputShape).astype(np.int32)-1000
-		# Swap the x and y size of the arr shape.
-		arrOutShape = np.array(arrOut.shape).astype(np.int32)
-		"""
-		The GPU wizardry:
-			- First we do the data transfer from host to device.
-			- Then we run the program.
-			- Then we get the results.
-		"""
-		# Create memory flags.
-		mf = cl.mem_flags
-		# GPU buffers.
-		gpuRotation = cl.Buffer(self.ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=gpuRotationMatrix.astype('float32'))
-		self._outputBuffer = cl.Buffer(self.ctx, mf.WRITE_ONLY | mf.COPY_HOST_PTR, hostbuf=arrOut)
-		self._outputBufferShape = cl.Buffer(self.ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=arrOutShape)
-		# Get kernel source.
-		fp = os.path.dirname(inspect.getfile(gpu))
-		kernel = open(fp+"/kernels/rotate.cl", "r").read()
-		# Compile kernel.
-		program = cl.Program(self.ctx,kernel).build()
-		# Kwargs
-		kwargs = ( self._inputBuffer,
-			gpuRotation,
-			self._outputBuffer,
-			self._outputBufferShape
-		)
-		# Run the program.
-		# __call__(queue, global_size, local_size, *args, global_offset=None, wait_for=None, g_times_l=False)
-		program.rotate3d(self.queue,self._inputBufferShape,None,*(kwargs))
+		with self._lock:
+			return self._rotate(rotationMatrix,mode)
+
+	def _rotate(self,rotationMatrix,mode=None):
+		""" Rotate the array on the device, see rotate(). """
+		# Put the rotation matrix in the context of the OCL CS.
+		gpuRotationMatrix = self.arrayRotation(rotationMatrix)
+		outputShape = self._outputShape(gpuRotationMatrix)
+		arrOut = np.empty(outputShape,dtype=np.int32)
+		if self._tiled(outputShape):
+			for outputBuffer, start, stop in self._rotateTiles(gpuRotationMatrix,outputShape,mode):
+				cl.enqueue_copy(self.queue, arrOut[start:stop], outputBuffer)
+			self._outputKey = None
+			self._outputBufferShape = outputShape
+			self._releaseStaged()
+			return arrOut
+		# The rotated array stays resident on the device, so rotating by the same matrix again only copies it back.
+		key = self._rotationKey(gpuRotationMatrix,mode)
+		outputBuffer = self._pool.fetch(key)
+		if outputBuffer is None:
+			outputBuffer = self._pool.allocate(arrOut.nbytes)
+			self._enqueueRotation(gpuRotationMatrix,outputShape,outputBuffer,mode,wait_for=self._enqueueFill(outputBuffer,outputShape,mode))
+		self._outputKey = key
+		self._outputBufferShape = outputShape
 		# Get results
-		cl.enqueue_copy(self.queue, arrOut, self._outputBuffer)
-		# Remove any dirty array values in the output.
-		# arrOut = np.nan_to_num(arrOut)
+		cl.enqueue_copy(self.queue, arrOut, outputBuffer)
+		self._pool.store(key,outputBuffer)
+		self._releaseStaged()
 		return arrOut
 
+	def _fits(self,nbytes):
+		""" Whether an (int32) array of nbytes is held on the device whole, larger arrays are streamed through it in tiles. """
+		if config.gpu.tileSize > 0:
+			return nbytes <= config.gpu.tileSize
+		# Leave room for a rotated copy of the array.
+		return (nbytes <= self.context.device.max_mem_alloc_size) and (2*nbytes <= self._pool.budget)
+
+	def _tileSize(self):
+		""" The most bytes in a tile, two input tiles and an output tile (and its projections) have to fit on the device. """
+		if config.gpu.tileSize > 0:
+			return config.gpu.tileSize
+		return int(min(self.context.device.max_mem_alloc_size,self._pool.budget//4))
+
+	def _tiled(self,outputShape):
+		""" Whether a rotation into an array of outputShape is done in tiles (the input or the output does not fit on the device). """
+		return (self._inputBuffer is None) or not self._fits(int(np.prod(outputShape))*np.dtype(np.int32).itemsize)
+
+	def _rotateTiles(self,gpuRotationMatrix,outputShape,mode=None,rows=None):
+		"""
+		Rotate the array (by a rotation in the OCL CS) one tile of output rows at a time, for arrays or rotations that do not fit on the device.
+		The output rows of a tile only sample a range of input rows, those are streamed from the host in tiles through two device buffers so the copy of one input tile overlaps the rotation of the other.
+		Every output voxel is sampled from the one input tile that holds it (see gather.cl), so the result is identical to rotating the array whole.
+		Yields the output buffer and the (start,stop) output rows it holds, the buffer is overwritten by the next tile.
+		Only the output rows in rows=(start,stop) are rotated, all of them by default.
+		"""
+		if mode is None:
+			mode = config.gpu.rotation
+		if mode == 'scatter':
+			logging.warning("The scatter mode can not be done in tiles, the nearest mode is used instead.")
+			mode = 'nearest'
+		if rows is None:
+			rows = (0,outputShape[0])
+		inputShape = self._inputBufferShape
+		inputRowBytes = int(np.prod(inputShape[1:]))*np.dtype(np.int32).itemsize
+		outputRowBytes = int(np.prod(outputShape[1:]))*np.dtype(np.int32).itemsize
+		# Linear samples also read the row after the last one they belong to.
+		halo = 1 if mode == 'linear' else 0
+		inputRows = max(1,self._tileSize()//inputRowBytes-halo)
+		outputRows = max(1,self._tileSize()//outputRowBytes)
+		# The input tiles as (first row, last+1 row) held and (first row, last+1 row) sampled, the first and last tiles also take the samples outside of the array.
+		edges = list(range(0,inputShape[0],inputRows)) + [inputShape[0]]
+		inputTiles = []
+		for a, b in zip(edges[:-1],edges[1:]):
+			inputTiles.append((a,min(b+halo,inputShape[0]),a if a > 0 else np.iinfo(np.int32).min,b if b < inputShape[0] else np.iinfo(np.int32).max))
+		inverse = np.linalg.inv(gpuRotationMatrix)
+		gpuInverse = self._stage(inverse.astype(np.float32))
+		kernel = self._kernel('gather','gatherNearestTile' if mode == 'nearest' else 'gatherLinearTile')
+		inShape = cl.cltypes.make_int4(*inputShape,0)
+		outShape = cl.cltypes.make_int4(*outputShape,0)
+		buffers = [self._pool.allocate((inputRows+halo)*inputRowBytes) for i in range(2)]
+		output = self._pool.allocate(min(outputRows,outputShape[0])*outputRowBytes)
+		# The last rotation to read each of the input buffers.
+		done = [None,None]
+		n = 0
+		try:
+			for start in range(rows[0],rows[1],outputRows):
+				stop = min(start+outputRows,rows[1])
+				lower, upper = self._sampledRows(inverse,inputShape,outputShape,start,stop)
+				for first, last, owned, ownedStop in inputTiles:
+					if (ownedStop <= lower) or (owned > upper):
+						continue
+					slot = n%2
+					n += 1
+					# Convert the tile while the device works on the other buffer.
+					chunk = np.ascontiguousarray(self._hostData[first:last],dtype=np.int32)
+					upload = cl.enqueue_copy(self._transferQueue, buffers[slot], chunk, is_blocking=False, wait_for=[done[slot]] if done[slot] is not None else None)
+					self._transferQueue.flush()
+					done[slot] = kernel(self.queue,(outputShape[2],outputShape[1],stop-start),None,buffers[slot],gpuInverse,output,inShape,outShape,np.int32(self._fill),cl.cltypes.make_int4(first,owned,ownedStop,start),wait_for=[upload])
+					self.queue.flush()
+				self.queue.finish()
+				yield output, start, stop
+		finally:
+			self.queue.finish()
+			for buffer in buffers + [output]:
+				self._pool.release(buffer)
+
+	@staticmethod
+	def _sampledRows(inverse,inputShape,outputShape,start,stop):
+		""" The (lowest,highest) input row sampled by the output rows [start,stop), with a margin for rounding. """
+		corners = np.array(np.meshgrid([start,stop-1],[0,outputShape[1]-1],[0,outputShape[2]-1],indexing='ij')).reshape(3,-1)
+		x = inverse[0]@(corners-(np.array(outputShape)[:,None]-1)/2) + (inputShape[0]-1)/2
+		return int(np.floor(np.amin(x)))-2, int(np.floor(np.amax(x)))+2
+
+	def _rotationKey(self,gpuRotationMatrix,mode=None):
+		""" The key a rotated array is resident under. """
+		return ('rotation',mode or config.gpu.rotation,np.asarray(gpuRotationMatrix,dtype=np.float32).tobytes())
+
+	def _enqueueFill(self,buffer,shape,mode=None):
+		""" The scatter mode only writes some of the output voxels, queue filling the rest with the fill value. Returns the events to wait for. """
+		if (mode or config.gpu.rotation) == 'scatter':
+			return [cl.enqueue_fill_buffer(self.queue, buffer, np.int32(self._fill), 0, int(np.prod(shape))*4)]
+		return []
+
+	def _stage(self,array):
+		""" Copy a small array (a kernel parameter) to a pooled buffer, it is released by _releaseStaged(). """
+		array = np.ascontiguousarray(array)
+		buffer = self._pool.allocate(array.nbytes)
+		cl.enqueue_copy(self.queue, buffer, array, is_blocking=False)
+		self._staged.append(buffer)
+		return buffer
+
+	def _releaseStaged(self):
+		""" Release the staged buffers, only once all the work queued with them has completed. """
+		for buffer in self._staged:
+			self._pool.release(buffer)
+		self._staged = []
+
+	def _enqueueRotation(self,gpuRotationMatrix,outputShape,outputBuffer,mode=None,wait_for=None):
+		"""
+		Queue a rotation (in the OCL CS) of the input buffer into an output buffer and return the kernel event.
+		For the scatter mode the output buffer must already hold the fill value, the gather modes write every output voxel.
+		"""
+		if mode is None:
+			mode = config.gpu.rotation
+		if mode == 'scatter':
+			gpuRotation = self._stage(gpuRotationMatrix.astype(np.float32))
+			gpuShape = self._stage(np.array(outputShape,dtype=np.int32))
+			# __call__(queue, global_size, local_size, *args, global_offset=None, wait_for=None, g_times_l=False)
+			return self._kernel('rotate','rotate3d')(self.queue,self._inputBufferShape,None,self._inputBuffer,gpuRotation,outputBuffer,gpuShape,wait_for=wait_for)
+		elif mode in ('nearest','linear'):
+			# The gather kernels map each output voxel back into the input with the inverse rotation.
+			gpuInverse = self._stage(np.linalg.inv(gpuRotationMatrix).astype(np.float32))
+			kernel = self._kernel('gather','gatherNearest' if mode == 'nearest' else 'gatherLinear')
+			inShape = cl.cltypes.make_int4(*self._inputBufferShape,0)
+			outShape = cl.cltypes.make_int4(*outputShape,0)
+			# The first global id runs along the last (contiguous) axis of the output.
+			return kernel(self.queue,tuple(outputShape[::-1]),None,self._inputBuffer,gpuInverse,outputBuffer,inShape,outShape,np.int32(self._fill),wait_for=wait_for)
+		else:
+			raise ValueError("Unknown rotation mode {}.".format(mode))
+
+	def rotateBatch(self,rotationMatrices,method='sum',axes=(2,1),box=None,mode=None):
+		"""
+		Rotate the loaded array by a number of rotations and flatten each rotated array.
+		Each rotation is run against the array that is already on the device and is flattened on the device, only the projections are copied back.
+		The copies run on a separate queue so they overlap the rotation of the next pose.
+		The rotated arrays are kept resident (as with rotate()), so a pose that is flattened again is not rotated again.
+		This may be called from any thread.
+
+		Parameters
+		----------
+		rotationMatrices : list
+			A list of 3x3 rotation matrices (as for rotate()).
+		method : str
+			'sum' (int64), 'max' (int32) or 'mean' (float32).
+		axes : tuple
+			The axes of the rotated array to flatten.
+		box : tuple
+			Three slices (one per axis) of the rotated array to flatten, the whole array if None.
+		mode : str
+			The sampling of the rotated arrays, see rotate().
+
+		Returns
+		-------
+		list
+			For each rotation, a list with the (stored value) projection along each of the axes.
+		"""
+		with self._lock:
+			matrices = [self.arrayRotation(R) for R in rotationMatrices]
+			shapes = [self._outputShape(M) for M in matrices]
+			if len(shapes) == 0:
+				return []
+			results = []
+			reads = []
+			for M, shape in zip(matrices,shapes):
+				if self._tiled(shape):
+					results.append(self._projectTiles(M,shape,method,axes,box,mode))
+					continue
+				# Rotated arrays that are already resident are flattened as they are, the others are rotated into a buffer of their own.
+				key = self._rotationKey(M,mode)
+				source = self._pool.fetch(key)
+				if source is not None:
+					wait = None
+				else:
+					source = self._pool.allocate(int(np.prod(shape))*np.dtype(np.int32).itemsize)
+					wait = [self._enqueueRotation(M,shape,source,mode,wait_for=self._enqueueFill(source,shape,mode))]
+				pose = []
+				for axis in axes:
+					image, read = self._enqueueProjection(source,shape,method,axis,box,wait_for=wait)
+					pose.append(image)
+					if read is not None:
+						reads.append(read)
+				results.append(pose)
+				# Keep the rotated array resident straight away, so the pool can evict the older ones to make room for the next pose.
+				# The queue is in order, so a buffer that is evicted and reused is not overwritten until it has been flattened.
+				self._pool.store(key,source)
+				self.queue.flush()
+				self._transferQueue.flush()
+			if len(reads) > 0:
+				cl.wait_for_events(reads)
+			self._releaseStaged()
+			return results
+
+	def _projectTiles(self,gpuRotationMatrix,shape,method,axes,box=None,mode=None):
+		""" Rotate the array in tiles (see _rotateTiles()) and flatten it along each of the axes, the projections of the tiles are combined on the host. """
+		start, stop = self._box(shape,box)
+		reduction = 'max' if method == 'max' else 'sum'
+		dtype = np.int32 if method == 'max' else np.int64
+		images = {}
+		for axis in axes:
+			imageShape = [stop[i]-start[i] for i in range(3) if i != axis]
+			if axis == 0:
+				# The tiles split the flattened axis, their projections are reduced together.
+				images[axis] = np.full(imageShape,np.iinfo(np.int32).min if method == 'max' else 0,dtype=dtype)
+			else:
+				# The tiles split the rows of the projection, their projections are stacked.
+				images[axis] = [np.zeros([0]+imageShape[1:],dtype=dtype)]
+		for outputBuffer, first, last in self._rotateTiles(gpuRotationMatrix,shape,mode,rows=(start[0],max(start[0],stop[0]))):
+			# Only the rows in the box are rotated.
+			tileBox = (slice(0,last-first),slice(start[1],stop[1]),slice(start[2],stop[2]))
+			tiles = []
+			reads = []
+			for axis in axes:
+				image, read = self._enqueueProjection(outputBuffer,(last-first,)+tuple(shape[1:]),reduction,axis,tileBox)
+				tiles.append(image)
+				if read is not None:
+					reads.append(read)
+			if len(reads) > 0:
+				cl.wait_for_events(reads)
+			for axis, image in zip(axes,tiles):
+				if axis == 0:
+					images[axis] = np.maximum(images[axis],image) if method == 'max' else images[axis]+image
+				else:
+					images[axis].append(image)
+		results = []
+		for axis in axes:
+			image = images[axis] if axis == 0 else np.concatenate(images[axis],axis=0)
+			if method == 'mean':
+				# As the device does it, in single precision.
+				with np.errstate(divide='ignore',invalid='ignore'):
+					image = image.astype(np.float32)/np.float32(stop[axis]-start[axis])
+			results.append(image)
+		return results
+
+	def _enqueueProjection(self,volume,shape,method,axis,box=None,wait_for=None):
+		"""
+		Queue the projection of a box of a volume on the device along an axis and a non-blocking copy of it to the host.
+		Returns the (host) output array and the event of the copy, the array must not be used until the copy has completed.
+		"""
+		start, stop = self._box(shape,box)
+		remaining = [i for i in range(3) if i != axis]
+		outputShape = tuple(stop[i]-start[i] for i in remaining)
+		dtype = {'sum':np.int64,'max':np.int32,'mean':np.float32}[method]
+		image = np.zeros(outputShape,dtype=dtype)
+		if image.size == 0:
+			return image, None
+		output = self._pool.allocate(image.nbytes)
+		# The output is released with the staged buffers, once the copy has completed.
+		self._staged.append(output)
+		kernel = self._kernel('project','project'+method.capitalize())
+		event = kernel(self.queue,outputShape[::-1],None,volume,output,
+			cl.cltypes.make_int4(*shape,0),
+			cl.cltypes.make_int4(*start,0),
+			cl.cltypes.make_int4(*stop,0),
+			np.int32(axis),
+			wait_for=wait_for)
+		read = cl.enqueue_copy(self._transferQueue, image, output, is_blocking=False, wait_for=[event])
+		return image, read
+
 	def copy(self):
-		arrOut = np.zeros(self._inputBufferShape).astype(np.int32)-1000
+		if self._inputBuffer is None:
+			# The array is streamed through the device in tiles, the host array is the copy.
+			return np.array(self._hostData,dtype=np.int32)
+		arrOut = np.empty(self._inputBufferShape,dtype=np.int32)
 		# arrOutShape = np.array(arrOut.shape).astype(np.int32)
 		'''
 		The GPU wizardry:
@@ -153,23 +424,18 @@ class gpu:
 			- Then we run the program.
 			- Then we get the results.
 		'''
-		# Create memory flags.
-		mf = cl.mem_flags
-		# GPU buffers.
-		gpuOut = cl.Buffer(self.ctx, mf.WRITE_ONLY | mf.COPY_HOST_PTR, hostbuf=arrOut)
-		# Get kernel source.
-		fp = os.path.dirname(inspect.getfile(gpu))
-		kernel = open(fp+"/kernels/copy.cl", "r").read()
-		# Compile kernel.
-		program = cl.Program(self.ctx,kernel).build()
-		# Kwargs
-		kwargs = ( self._inputBuffer,
-			gpuOut
-		)
 		# Run the program.
-		program.copy(self.queue,self._inputBufferShape,None,*(kwargs))
-		# Get results
-		cl.enqueue_copy(self.queue, arrOut, gpuOut)
+		with self._lock:
+			# GPU buffers.
+			gpuOut = self._pool.allocate(arrOut.nbytes)
+			# Kwargs
+			kwargs = ( self._inputBuffer,
+				gpuOut
+			)
+			self._kernel('copy','copy')(self.queue,self._inputBufferShape,None,*(kwargs))
+			# Get results
+			cl.enqueue_copy(self.queue, arrOut, gpuOut)
+			self._pool.release(gpuOut)
 		# Remove any dirty array values in the output.
 		arrOut = np.nan_to_num(arrOut)
 		return arrOut
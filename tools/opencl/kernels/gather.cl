@@ -0,0 +1,145 @@
+// Inverse mapped (gather) rotation of a volume.
+// Each work item is one output voxel, it is mapped back into the input volume and sampled there.
+// The first global id runs along the last (contiguous) axis of the output so neighbouring work items write neighbouring voxels.
+// Samples outside of the input take the fill value.
+// The tile kernels rotate a volume that is streamed through the device in tiles of whole rows (of the first axis):
+//	tile.x: The first input row held in the buffer.
+//	tile.y, tile.z: The first and last+1 input rows this tile writes samples for, each output voxel belongs to exactly one tile.
+//	tile.w: The first output row of the output buffer.
+// Positions are calculated without contracting multiplies and adds (FMA) so every device (and the CPU backend) rounds them the same way.
+
+#pragma OPENCL FP_CONTRACT OFF
+
+int sampleInput(
+	__global const int *gpuIn,
+	const int4 inShape,
+	const int row0,
+	int x,
+	int y,
+	int z,
+	const int fill)
+{
+	if((x < 0) || (y < 0) || (z < 0) || (x >= inShape.x) || (y >= inShape.y) || (z >= inShape.z))
+	{
+		return fill;
+	}
+	return gpuIn[z + inShape.z*(y + inShape.y*(x - row0))];
+}
+
+float3 inputPosition(
+	__global const float *gpuInverse,
+	const int4 inShape,
+	const int4 outShape,
+	const int outRow0)
+{
+	// Output voxel.
+	float i = (int)get_global_id(2) + outRow0 - (outShape.x-1)/2.0f;
+	float j = get_global_id(1) - (outShape.y-1)/2.0f;
+	float k = get_global_id(0) - (outShape.z-1)/2.0f;
+	// Rotate back into the input and move to the input origin.
+	return (float3)(
+		i*gpuInverse[0] + j*gpuInverse[1] + k*gpuInverse[2] + (inShape.x-1)/2.0f,
+		i*gpuInverse[3] + j*gpuInverse[4] + k*gpuInverse[5] + (inShape.y-1)/2.0f,
+		i*gpuInverse[6] + j*gpuInverse[7] + k*gpuInverse[8] + (inShape.z-1)/2.0f
+	);
+}
+
+int outputIndex(const int4 outShape)
+{
+	return get_global_id(0) + outShape.z*(get_global_id(1) + outShape.y*get_global_id(2));
+}
+
+int nearestSample(
+	__global const int *gpuIn,
+	const int4 inShape,
+	const int row0,
+	const float3 p,
+	const int fill)
+{
+	return sampleInput(gpuIn,inShape,row0,(int)floor(p.x+0.5f),(int)floor(p.y+0.5f),(int)floor(p.z+0.5f),fill);
+}
+
+int linearSample(
+	__global const int *gpuIn,
+	const int4 inShape,
+	const int row0,
+	const float3 p,
+	const int fill)
+{
+	// Lower corner of the cell holding the sample and the weights of the upper corner.
+	float3 f = floor(p);
+	float3 w = p - f;
+	int x = (int)f.x;
+	int y = (int)f.y;
+	int z = (int)f.z;
+	// Interpolate along z, then y, then x.
+	float c00 = mix((float)sampleInput(gpuIn,inShape,row0,x,y,z,fill),(float)sampleInput(gpuIn,inShape,row0,x,y,z+1,fill),w.z);
+	float c01 = mix((float)sampleInput(gpuIn,inShape,row0,x,y+1,z,fill),(float)sampleInput(gpuIn,inShape,row0,x,y+1,z+1,fill),w.z);
+	float c10 = mix((float)sampleInput(gpuIn,inShape,row0,x+1,y,z,fill),(float)sampleInput(gpuIn,inShape,row0,x+1,y,z+1,fill),w.z);
+	float c11 = mix((float)sampleInput(gpuIn,inShape,row0,x+1,y+1,z,fill),(float)sampleInput(gpuIn,inShape,row0,x+1,y+1,z+1,fill),w.z);
+	float c0 = mix(c00,c01,w.y);
+	float c1 = mix(c10,c11,w.y);
+	return (int)rint(mix(c0,c1,w.x));
+}
+
+__kernel void gatherNearest(
+	__global const int *gpuIn,
+	__global const float *gpuInverse,
+	__global int *gpuOut,
+	const int4 inShape,
+	const int4 outShape,
+	const int fill)
+{
+	float3 p = inputPosition(gpuInverse,inShape,outShape,0);
+	gpuOut[outputIndex(outShape)] = nearestSample(gpuIn,inShape,0,p,fill);
+}
+
+__kernel void gatherLinear(
+	__global const int *gpuIn,
+	__global const float *gpuInverse,
+	__global int *gpuOut,
+	const int4 inShape,
+	const int4 outShape,
+	const int fill)
+{
+	float3 p = inputPosition(gpuInverse,inShape,outShape,0);
+	gpuOut[outputIndex(outShape)] = linearSample(gpuIn,inShape,0,p,fill);
+}
+
+__kernel void gatherNearestTile(
+	__global const int *gpuIn,
+	__global const float *gpuInverse,
+	__global int *gpuOut,
+	const int4 inShape,
+	const int4 outShape,
+	const int fill,
+	const int4 tile)
+{
+	float3 p = inputPosition(gpuInverse,inShape,outShape,tile.w);
+	// The sample belongs to the tile holding the nearest row.
+	int x = (int)floor(p.x+0.5f);
+	if((x < tile.y) || (x >= tile.z))
+	{
+		return;
+	}
+	gpuOut[outputIndex(outShape)] = nearestSample(gpuIn,inShape,tile.x,p,fill);
+}
+
+__kernel void gatherLinearTile(
+	__global const int *gpuIn,
+	__global const float *gpuInverse,
+	__global int *gpuOut,
+	const int4 inShape,
+	const int4 outShape,
+	const int fill,
+	const int4 tile)
+{
+	float3 p = inputPosition(gpuInverse,inShape,outShape,tile.w);
+	// The sample belongs to the tile holding the lower of the two rows it interpolates (the tile also holds the row after its last).
+	int x = (int)floor(p.x);
+	if((x < tile.y) || (x >= tile.z))
+	{
+		return;
+	}
+	gpuOut[outputIndex(outShape)] = linearSample(gpuIn,inShape,tile.x,p,fill);
+}
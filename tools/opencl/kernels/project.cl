@@ -0,0 +1,79 @@
+// Projections (reductions along one axis) of a box of a volume.
+// Each work item is one output pixel and loops over the reduced axis.
+// The output axes are the two remaining axes (a < b) of the box, the first global id runs along b so neighbouring work items read neighbouring voxels when b is the contiguous axis.
+
+int voxelIndex(const int4 shape,const int4 start,const int axis,const int k)
+{
+	// Map the work item and the position along the reduced axis into the volume.
+	int p[3];
+	int a = (axis == 0) ? 1 : 0;
+	int b = (axis == 2) ? 1 : 2;
+	int s[3] = {start.x,start.y,start.z};
+	p[axis] = s[axis] + k;
+	p[a] = s[a] + get_global_id(1);
+	p[b] = s[b] + get_global_id(0);
+	return p[2] + shape.z*(p[1] + shape.y*p[0]);
+}
+
+int reducedLength(const int4 start,const int4 stop,const int axis)
+{
+	int s[3] = {start.x,start.y,start.z};
+	int e[3] = {stop.x,stop.y,stop.z};
+	return e[axis] - s[axis];
+}
+
+int outputIndex()
+{
+	return get_global_id(0) + get_global_size(0)*get_global_id(1);
+}
+
+__kernel void projectSum(
+	__global const int *gpuIn,
+	__global long *gpuOut,
+	const int4 shape,
+	const int4 start,
+	const int4 stop,
+	const int axis)
+{
+	int n = reducedLength(start,stop,axis);
+	long total = 0;
+	for(int k = 0; k < n; k++)
+	{
+		total += gpuIn[voxelIndex(shape,start,axis,k)];
+	}
+	gpuOut[outputIndex()] = total;
+}
+
+__kernel void projectMax(
+	__global const int *gpuIn,
+	__global int *gpuOut,
+	const int4 shape,
+	const int4 start,
+	const int4 stop,
+	const int axis)
+{
+	int n = reducedLength(start,stop,axis);
+	int result = INT_MIN;
+	for(int k = 0; k < n; k++)
+	{
+		result = max(result,gpuIn[voxelIndex(shape,start,axis,k)]);
+	}
+	gpuOut[outputIndex()] = result;
+}
+
+__kernel void projectMean(
+	__global const int *gpuIn,
+	__global float *gpuOut,
+	const int4 shape,
+	const int4 start,
+	const int4 stop,
+	const int axis)
+{
+	int n = reducedLength(start,stop,axis);
+	long total = 0;
+	for(int k = 0; k < n; k++)
+	{
+		total += gpuIn[voxelIndex(shape,start,axis,k)];
+	}
+	gpuOut[outputIndex()] = (float)total/(float)n;
+}
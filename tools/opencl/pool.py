@@ -0,0 +1,138 @@
+import pyopencl as cl
+import threading
+from collections import OrderedDict
+import logging
+
+'''
+A pool of device buffers.
+	Buffers are allocated in size classes and released
+	buffers are kept for reuse, so repeatedly loading volumes and rotating
+	them does not keep allocating (and fragmenting) device memory.
+	Resident volumes (e.g. a rotated CT) can be stored in the pool under a
+	key, they are kept on the device until they are evicted in least
+	recently used order to keep the pool under its budget.
+	Buffers in use are never evicted. A buffer must only be released (or
+	stored) once every command that uses it has completed.
+'''
+
+# The smallest size class in bytes.
+_minimumSize = 256
+
+def sizeClass(nbytes):
+	""" The size of the buffer that is allocated for a request of nbytes. There are eight classes between each power of two, so no more than an eighth of a buffer is wasted. """
+	if nbytes <= _minimumSize:
+		return _minimumSize
+	step = (1 << (int(nbytes-1).bit_length()-1))//8
+	return -(-int(nbytes)//step)*step
+
+class pool:
+	def __init__(self,ctx,budget):
+		"""
+		Parameters
+		----------
+		ctx : pyopencl.Context
+			The context buffers are allocated in.
+		budget : int
+			The number of bytes the pool tries to stay under.
+		"""
+		self.ctx = ctx
+		self.budget = int(budget)
+		# Free buffers by size class, resident buffers by key (oldest first) and the buffers in use.
+		self._free = {}
+		self._resident = OrderedDict()
+		self._inUse = set()
+		self.allocated = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._lock = threading.Lock()
+
+	def allocate(self,nbytes):
+		""" Get a buffer of at least nbytes, a free buffer of the same size class is reused if there is one. """
+		size = sizeClass(nbytes)
+		with self._lock:
+			if len(self._free.get(size,[])) > 0:
+				buffer = self._free[size].pop()
+				self.hits += 1
+			else:
+				self.misses += 1
+				self._reclaim(size)
+				try:
+					buffer = cl.Buffer(self.ctx, cl.mem_flags.READ_WRITE, size=size)
+				except cl.MemoryError:
+					# The device is short of memory (it may be shared), give everything that is not in use back to it and try again.
+					self._reclaim(size,limit=0)
+					buffer = cl.Buffer(self.ctx, cl.mem_flags.READ_WRITE, size=size)
+				self.allocated += size
+			self._inUse.add(buffer)
+			return buffer
+
+	def release(self,buffer):
+		""" Return a buffer from allocate() (or fetch()) to the pool for reuse. """
+		if buffer is None:
+			return
+		with self._lock:
+			self._inUse.discard(buffer)
+			self._free.setdefault(buffer.size,[]).append(buffer)
+
+	def store(self,key,buffer):
+		""" Keep a buffer from allocate() resident under a key, it may be evicted when memory is needed. """
+		with self._lock:
+			self._inUse.discard(buffer)
+			if key in self._resident:
+				self._free.setdefault(self._resident[key].size,[]).append(self._resident.pop(key))
+			self._resident[key] = buffer
+
+	def fetch(self,key):
+		""" Take a resident buffer out of the pool (None if it is not resident), release() or store() it again when done. """
+		with self._lock:
+			buffer = self._resident.pop(key,None)
+			if buffer is not None:
+				self._inUse.add(buffer)
+			return buffer
+
+	def evict(self,match=None):
+		""" Move the resident buffers whose key satisfies match (all of them if None) to the free buffers. """
+		with self._lock:
+			for key in [key for key in self._resident if (match is None) or match(key)]:
+				self._free.setdefault(self._resident[key].size,[]).append(self._resident.pop(key))
+
+	def _reclaim(self,nbytes,limit=None):
+		""" Free device memory until nbytes more can be allocated under a limit (the budget by default): free buffers go first, then the least recently used resident buffers. """
+		if limit is None:
+			limit = self.budget
+		while self.allocated + nbytes > limit:
+			sizes = [size for size in self._free if len(self._free[size]) > 0]
+			if len(sizes) > 0:
+				buffer = self._free[max(sizes)].pop()
+			elif len(self._resident) > 0:
+				_, buffer = self._resident.popitem(last=False)
+				self.evictions += 1
+			else:
+				if self.allocated + nbytes > self.budget:
+					logging.warning("The device memory in use exceeds the budget of {} MB.".format(self.budget//1024**2))
+				return
+			self.allocated -= buffer.size
+			buffer.release()
+
+	def report(self):
+		"""
+		Report the device memory held by the pool in bytes.
+			budget: The most the pool tries to hold.
+			allocated: Everything allocated on the device.
+			inUse: Buffers that are in use.
+			resident: Resident volumes.
+			free: Buffers kept for reuse.
+		Also the number of allocations served from the free buffers (hits), allocated on the device (misses) and resident volumes evicted (evictions).
+		"""
+		with self._lock:
+			return {
+				'budget': self.budget,
+				'allocated': self.allocated,
+				'inUse': sum(buffer.size for buffer in self._inUse),
+				'resident': sum(buffer.size for buffer in self._resident.values()),
+				'free': sum(buffer.size for buffers in self._free.values() for buffer in buffers),
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+			}
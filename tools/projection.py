@@ -0,0 +1,212 @@
+import os
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Projections (sum or max along an axis) of a volume.
+	flatten: Reduces the volume along an axis on a thread pool. The volume
+		is split into slabs along one of the other axes and each worker
+		reduces a slab into its part of the output, numpy releases the GIL
+		while it reduces so the slabs run in parallel. Every output value is
+		reduced from the same voxels as a single np.sum/np.amax call, integer
+		sums are bit identical.
+Precomputed tables for fast projections of a sub-box of a volume.
+	summedVolumeTable: A cumulative sum along the projection axis. The sum
+		over any range of the axis is the difference of two planes.
+	maxPyramid: Maxima of aligned slabs (of 1, 2, 4, ... planes) along the
+		projection axis. The maximum over any range of the axis combines at
+		most two slabs from each level of the pyramid.
+Both give results identical to np.sum/np.amax over the sub-box.
+'''
+
+# Volumes smaller than this (in bytes) are reduced in the calling thread.
+_minimumSize = 4*1024**2
+# The shared worker pool, created on first use with a thread for each core. It is never replaced, callers limit how many of its threads they use (see run()).
+_pool = None
+_poolLock = threading.Lock()
+
+def executor():
+	""" Get the shared worker pool. """
+	global _pool
+	with _poolLock:
+		if _pool is None:
+			_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+		return _pool
+
+def run(function,items,workers=0):
+	"""
+	Call a function on each item on the shared pool, using at most a number of workers (0 uses all available cores) at once.
+	Returns the results in the order of the items.
+	"""
+	items = list(items)
+	if workers == 0:
+		workers = os.cpu_count() or 1
+	results = [None]*len(items)
+	remaining = iter(range(len(items)))
+	lock = threading.Lock()
+	def work():
+		# Each worker takes the next item until there are none left, this balances the load.
+		while True:
+			with lock:
+				i = next(remaining,None)
+			if i is None:
+				return
+			results[i] = function(items[i])
+	jobs = [executor().submit(work) for _ in range(min(workers,len(items)))]
+	for job in jobs:
+		job.result()
+	return results
+
+def flatten(array,axis,method='sum',workers=0):
+	"""
+	Sum or take the maximum of an array along an axis using several threads.
+
+	Parameters
+	----------
+	array : ndarray
+		A 3D array (any strided view is accepted).
+	axis : int
+		The axis to reduce.
+	method : str
+		'sum' or 'max'. Integer sums are accumulated as int64, float sums as float64.
+	workers : int
+		Number of threads, 0 uses all available cores.
+
+	Returns
+	-------
+	ndarray
+		The 2D projection, identical to np.sum(array,axis,dtype)/np.amax(array,axis).
+	"""
+	if method == 'sum':
+		dtype = np.int64 if np.issubdtype(array.dtype,np.integer) else np.float64
+		reduce = lambda a,out: np.sum(a,axis=axis,dtype=dtype,out=out)
+	elif method == 'max':
+		dtype = array.dtype
+		reduce = lambda a,out: np.amax(a,axis=axis,out=out)
+	else:
+		raise ValueError("Unknown flattening method {}.".format(method))
+	if workers == 0:
+		workers = os.cpu_count() or 1
+	shape = [n for i,n in enumerate(array.shape) if i != axis]
+	out = np.empty(shape,dtype=dtype)
+	if (workers == 1) or (array.nbytes < _minimumSize) or (array.shape[axis] == 0):
+		reduce(array,out)
+		return out
+	# Split the longest of the remaining axes into slabs, a few per worker to balance the load.
+	slabAxis = max([i for i in range(array.ndim) if i != axis],key=lambda i: array.shape[i])
+	outAxis = slabAxis if slabAxis < axis else slabAxis-1
+	edges = np.linspace(0,array.shape[slabAxis],min(4*workers,array.shape[slabAxis])+1).astype(int)
+	def slab(edge):
+		start, stop = edge
+		index = [slice(None)]*array.ndim
+		index[slabAxis] = slice(start,stop)
+		outIndex = [slice(None)]*out.ndim
+		outIndex[outAxis] = slice(start,stop)
+		reduce(array[tuple(index)],out[tuple(outIndex)])
+	run(slab,zip(edges[:-1],edges[1:]),workers)
+	return out
+
+class summedVolumeTable:
+	def __init__(self,array,axis):
+		""" Calculate the cumulative sum of an (integer) array along an axis. """
+		self.axis = axis
+		self.shape = array.shape
+		n = array.shape[axis]
+		# Use 32 bit integers if no partial sum (or difference of two) can overflow.
+		if np.issubdtype(array.dtype,np.integer):
+			limit = 2*n*max(abs(int(np.amin(array))),abs(int(np.amax(array))))
+			dtype = np.int32 if limit < np.iinfo(np.int32).max else np.int64
+		else:
+			dtype = np.float64
+		# The table has a plane of zeros at the start of the axis so that table[k] is the sum of planes [0,k).
+		shape = list(array.shape)
+		shape[axis] += 1
+		self.table = np.zeros(shape,dtype=dtype)
+		index = [slice(None)]*3
+		index[axis] = slice(1,None)
+		np.cumsum(array,axis=axis,dtype=dtype,out=self.table[tuple(index)])
+
+	def project(self,box):
+		"""
+		Sum the array over a box along the table axis.
+
+		Parameters
+		----------
+		box : tuple
+			Three slices (one per axis) describing the sub-box of the array.
+		"""
+		start, stop, _ = box[self.axis].indices(self.shape[self.axis])
+		stop = max(start,stop)
+		lower = list(box)
+		upper = list(box)
+		lower[self.axis] = start
+		upper[self.axis] = stop
+		dtype = np.int64 if np.issubdtype(self.table.dtype,np.integer) else np.float64
+		return np.subtract(self.table[tuple(upper)],self.table[tuple(lower)],dtype=dtype)
+
+	@property
+	def nbytes(self):
+		return self.table.nbytes
+
+class maxPyramid:
+	def __init__(self,array,axis):
+		""" Calculate the maxima of aligned slabs of an array along an axis. Level k holds the maxima of slabs of 2**k planes. """
+		self.axis = axis
+		self.shape = array.shape
+		self.levels = [array]
+		while self.levels[-1].shape[axis] > 1:
+			level = self.levels[-1]
+			n = level.shape[axis]
+			even = self._take(level,slice(0,n-1,2))
+			odd = self._take(level,slice(1,n,2))
+			reduced = np.maximum(even,odd)
+			if n % 2 == 1:
+				# The last slab of an odd length level has only one plane.
+				reduced = np.concatenate([reduced,self._take(level,slice(n-1,n))],axis=axis)
+			self.levels.append(reduced)
+
+	def _take(self,array,index):
+		""" Index an array along the pyramid axis. """
+		_index = [slice(None)]*3
+		_index[self.axis] = index
+		return array[tuple(_index)]
+
+	def project(self,box):
+		"""
+		Maximum of the array over a box along the pyramid axis.
+
+		Parameters
+		----------
+		box : tuple
+			Three slices (one per axis) describing the sub-box of the array.
+		"""
+		start, stop, _ = box[self.axis].indices(self.shape[self.axis])
+		if stop <= start:
+			raise ValueError("Cannot take the maximum of an empty range.")
+		# The box in the other two axes.
+		plane = [s for i,s in enumerate(box) if i != self.axis]
+		result = None
+		level = 0
+		while start < stop:
+			# Take the unaligned slabs from either end of the range then move up a level.
+			slabs = []
+			if start % 2 == 1:
+				slabs.append(start)
+				start += 1
+			if stop % 2 == 1:
+				stop -= 1
+				slabs.append(stop)
+			for k in slabs:
+				_index = list(plane)
+				_index.insert(self.axis,k)
+				values = self.levels[level][tuple(_index)]
+				result = values.copy() if result is None else np.maximum(result,values,out=result)
+			start //= 2
+			stop //= 2
+			level += 1
+		return result
+
+	@property
+	def nbytes(self):
+		return sum(level.nbytes for level in self.levels[1:])